@@ -16,6 +16,10 @@ from ccm_backup_reader.ccm_error import CcmError
 from ccm_backup_reader.orm import CcmOrm
 
 
+# Store the version index in the backup database, which writes to it. It is rebuilt when the status logs change
+PERSIST_VERSION_INDEX = False
+
+
 class RecursiveIterator:
 
     def __init__(self, ccm_object, relation):
@@ -23,7 +27,7 @@ class RecursiveIterator:
         self._relation = relation
 
         self._work = self._get_nexts(ccm_object)
-        self._done = []
+        self._done = set()
 
     def __iter__(self):
         return self
@@ -38,7 +42,7 @@ class RecursiveIterator:
         item = self._work.pop()
         if item in self._done:
             return self.__next__()
-        self._done.append(item)
+        self._done.add(item)
         self._work += self._get_nexts(item)
 
         return item
@@ -69,32 +73,17 @@ def write_task_commit(fd, task, mark, commit_marks, file_marks):
 
 
 def diff_project_structure(project_a, project_b):
-    # objects and partial names
-    project_a_objects = project_a.structure.keys()
-    project_b_objects = project_b.structure.keys()
-    project_a_part_names = {obj.part_name: obj for obj in project_a_objects}
-    project_b_part_names = {obj.part_name: obj for obj in project_b_objects}
-
-    # determine updated objects, match on partial_name
-    a_names = set(project_a_part_names.keys())
-    b_names = set(project_b_part_names.keys())
-    updated_names = a_names.intersection(b_names)
-    updated = [
-        [project_a_part_names[part_name], project_b_part_names[part_name]]
-        for part_name in updated_names
-        if project_a_part_names[part_name] != project_b_part_names[part_name]
-    ]
-
-    # determine newly added objects
-    added_names = b_names - a_names
-    added = [project_b_part_names[name] for name in added_names]
-
-    # determine removed objects
-    removed_names = a_names - b_names
-    removed = [project_a_part_names[name] for name in removed_names]
-
-    # determine unchanged
-    unchanged = set(project_a_objects).intersection(project_b_objects)
+    orm = project_a._orm
+    updated, added, removed, unchanged = [], [], [], set()
+    for entry in orm.diff_projects(project_a, project_b, stream=True):
+        if entry.change == 'updated':
+            updated.append([orm.object_from_ref(entry.ref_a), orm.object_from_ref(entry.ref_b)])
+        elif entry.change == 'added':
+            added.append(orm.object_from_ref(entry.ref_b))
+        elif entry.change == 'removed':
+            removed.append(orm.object_from_ref(entry.ref_a))
+        else:
+            unchanged.add(orm.object_from_ref(entry.ref_a))
 
     return updated, added, removed, unchanged
 
@@ -118,6 +107,7 @@ def versions_between_objects(object_from, object_to):
 def versions_between_projects(objects, project_from, project_to):
     timestamp_from = project_from.status_time('integrate')
     timestamp_to = project_to.status_time('integrate')
+    project_from._orm.load_status_timelines(objects)
     return [obj
             for obj in objects
             if obj.status == 'integrate' and timestamp_from < obj.status_time('integrate') < timestamp_to]
@@ -148,41 +138,6 @@ def get_project_chain(end_project):
     return projects
 
 
-def version_at_timestamp(timestamp, objects):
-    filtered = [o for o in objects if o.status == 'integrate' or o.status == 'released']
-    time_sorted = sorted(filtered, key=lambda o: o.status_time('integrate'))
-
-    #if objects and objects[0].id == 238158:
-    #    import ipdb; ipdb.set_trace()
-
-    # object with timestamp itself?
-    for obj in time_sorted:
-        if obj.status_time('integrate') == timestamp:
-            return obj
-
-    # determine nearest index before timestamp
-    idx_before = None
-    for idx, obj in enumerate(time_sorted):
-        if obj.status_time('integrate') < timestamp:
-            idx_before = idx
-        else:
-            break
-
-    # determine nearest index after timestamp
-    idx_after = None
-    for idx, obj in reversed(list(enumerate(time_sorted))):
-        if obj.status_time('integrate') > timestamp:
-            idx_after = idx
-        else:
-            break
-
-    # prefer before
-    if idx_before is not None:
-        return time_sorted[idx_before]
-    if idx_after is not None:
-        return time_sorted[idx_after]
-
-
 def expand_directory_changes(src_object, old_dir, new_dir):
     objects = []
 
@@ -196,8 +151,7 @@ def expand_directory_changes(src_object, old_dir, new_dir):
     timestamp = src_object.status_time('integrate')
     # expand added to all objects between baseline_project.timestamp to project.timestamp
     for added_name in added_names:
-        potentials = orm.objects_by_partial_name(added_name)
-        version_at_add = version_at_timestamp(timestamp, potentials)
+        version_at_add = orm.version_at_timestamp(added_name, timestamp)
         if version_at_add:
             objects += [version_at_add]
         else:
@@ -209,8 +163,7 @@ def expand_directory_changes(src_object, old_dir, new_dir):
 
     # expand remove to all objects between baseline_project.timestamp to project.timestamp
     for removed_name in removed_names:
-        potentials = orm.objects_by_partial_name(removed_name)
-        version_at_remove = version_at_timestamp(timestamp, potentials)
+        version_at_remove = orm.version_at_timestamp(removed_name, timestamp)
         if version_at_remove:
             objects += [version_at_remove]
         else:
@@ -299,6 +252,11 @@ def get_tasks_from_objects(project, objects):
     project_structure = project.structure
     tasks_objects = {}
 
+    orm = project._orm
+    orm.prefetch(objects, ['successor', 'associated_cv'])
+    orm.prefetch([project], ['task_in_rp', 'folder_in_rp'], direction='to')
+    orm.prefetch(project.folders, ['task_in_folder'], direction='to')
+
     for obj in objects:
         # get path
         path = None
@@ -331,6 +289,7 @@ def get_tasks_from_objects(project, objects):
 def main():
     db = CcmDb("/cygdrive/d/nobackup/gnr")
     orm = CcmOrm(db)
+    orm.version_index(persist=PERSIST_VERSION_INDEX)
 
     end_project = orm.object_by_fpn('dummy~current:project:1')
     print('Using project as end project: {}'.format(end_project))
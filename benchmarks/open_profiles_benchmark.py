@@ -0,0 +1,96 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Compare the CcmDb open profiles on ORM traversal workloads.
+
+Usage: open_profiles_benchmark.py [backup path]
+
+Without a backup path a synthetic backup is generated in a temporary directory.
+"""
+
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from ccm_backup_reader import CcmDb
+from ccm_backup_reader.ccm_db import OPEN_PROFILES
+from ccm_backup_reader.orm import CcmOrm
+from synthetic_backup import create_synthetic_backup
+
+
+def last_project(db):
+    rows = db.query_sql("SELECT MAX(id) FROM compver WHERE cvtype = 'project'")
+    return rows[0][0]
+
+
+def workload_structure(orm, project_id):
+    project = orm.object_by_id(project_id)
+    return len(project.structure)
+
+
+def workload_history(orm, project_id):
+    project = orm.object_by_id(project_id)
+    count = 0
+    for obj in project.structure:
+        work = list(obj.predecessors)
+        while work:
+            current = work.pop()
+            count += 1
+            work += current.predecessors
+    return count
+
+
+def workload_point_lookups(orm, project_id, lookups=20000):
+    rnd = random.Random(0)
+    max_id = project_id
+    count = 0
+    for _ in range(lookups):
+        obj = orm.object_by_id(rnd.randrange(100, max_id))
+        if obj is not None:
+            count += len(obj.name)
+    return count
+
+
+WORKLOADS = [
+    ('structure', workload_structure),
+    ('history', workload_history),
+    ('point lookups', workload_point_lookups),
+]
+
+
+def run(backup_path):
+    print('{:<16} {:>10} {}'.format('profile', 'open (s)', '  '.join('{:>14}'.format(name + ' (s)') for name, _ in WORKLOADS)))
+    for profile in OPEN_PROFILES:
+        start = time.perf_counter()
+        db = CcmDb(backup_path, profile=profile)
+        open_time = time.perf_counter() - start
+
+        orm = CcmOrm(db)
+        project_id = last_project(db)
+        timings = []
+        for name, workload in WORKLOADS:
+            start = time.perf_counter()
+            workload(orm, project_id)
+            timings.append(time.perf_counter() - start)
+
+        print('{:<16} {:>10.3f} {}'.format(profile, open_time, '  '.join('{:>14.3f}'.format(timing) for timing in timings)))
+
+
+def main():
+    if len(sys.argv) > 1:
+        run(sys.argv[1])
+        return
+
+    with tempfile.TemporaryDirectory() as backup_path:
+        create_synthetic_backup(backup_path)
+        run(backup_path)
+
+
+if __name__ == '__main__':
+    main()
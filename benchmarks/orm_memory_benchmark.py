@@ -0,0 +1,101 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Measure the memory used per ORM object when holding many objects at once.
+
+Usage: orm_memory_benchmark.py [object count]
+
+Compares, each without and with a weak identity map filled the same way:
+- baseline: the object class before __slots__, holding only _orm and _id in its __dict__
+- slots: CcmFile holding only _orm and _id, its row not loaded yet
+- slots+row: CcmFile with its core row, as constructed by the bulk queries
+and refs: CcmObjectRefs, as returned by the bulk listings with refs=True.
+
+Rows are generated like sqlite3 returns them and are dropped unless an object keeps them, the bytes counted
+are what stays alive once all objects are built.
+"""
+
+import os
+import random
+import sys
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from ccm_backup_reader.orm import CcmOrm
+from ccm_backup_reader.orm.ccm_objects import CcmFile
+
+
+CVTYPES = ['csrc', 'incl', 'ascii', 'dir', 'makefile', 'xml']
+OWNERS = ['user{}'.format(idx) for idx in range(50)]
+
+
+class BaselineObject:
+
+    def __init__(self, ccm_orm, id):
+        self._orm = ccm_orm
+        self._id = id
+
+
+def generate_rows(count, seed=0):
+    """ Rows like sqlite3 returns them: every string is a new object """
+    rnd = random.Random(seed)
+    for cv_id in range(count):
+        yield (
+            cv_id,
+            ''.join(rnd.choice(CVTYPES)),
+            ''.join('file_{}.c'.format(rnd.randrange(count // 20 + 1))),
+            ''.join(str(rnd.randrange(1, 40))),
+            ''.join('1'),
+            1262600000 + cv_id,
+            ''.join(rnd.choice(OWNERS)),
+            rnd.randrange(1, 10),
+        )
+
+
+def build_objects(construct, identity_map):
+    """ Objects for all rows, registered in a weak identity map when one is given """
+    def build(rows):
+        orm = CcmOrm(None)
+        strings = {}
+        objects = []
+        for row in rows:
+            ccm_object = construct(orm, row, strings)
+            if identity_map:
+                orm._identity_map[row[0]] = ccm_object
+            objects.append(ccm_object)
+        return orm, objects
+    return build
+
+
+def measure(build, count):
+    tracemalloc.start()
+    objects = build(generate_rows(count))
+    current, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del objects
+    return current / count
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 200000
+
+    constructors = [
+        ('baseline', lambda orm, row, strings: BaselineObject(orm, row[0])),
+        ('slots', lambda orm, row, strings: CcmFile(orm, row[0])),
+        ('slots+row', lambda orm, row, strings: CcmFile(orm, row[0], orm._construct_ref(row, strings))),
+    ]
+    variants = []
+    for name, construct in constructors:
+        variants.append((name, build_objects(construct, identity_map=False)))
+        variants.append((name + ', map', build_objects(construct, identity_map=True)))
+    variants.append(('refs', lambda rows: CcmOrm(None)._construct_objects(rows, refs=True)))
+
+    print('{} objects'.format(count))
+    for name, build in variants:
+        print('{:<16} {:8.1f} bytes/object'.format(name, measure(build, count)))
+
+
+if __name__ == '__main__':
+    main()
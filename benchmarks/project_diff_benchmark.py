@@ -0,0 +1,91 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Compare CcmOrm.diff_projects with the previous diff query, which joined the two recursive structure CTEs and
+referenced each of them twice, on the first and last project of a synthetic backup.
+
+Usage: project_diff_benchmark.py [dirs] [files per dir]
+
+Prints the timings and SQLite's EXPLAIN QUERY PLAN of both queries. Depending on the SQLite version the
+previous query materialises or re-evaluates the CTEs at each reference.
+"""
+
+import os
+import sqlite3
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from ccm_backup_reader import CcmDb
+from ccm_backup_reader.orm import CcmOrm
+from ccm_backup_reader.orm.ccm_objects import CORE_COLUMNS
+from ccm_backup_reader.orm.ccm_orm import core_columns
+from ccm_backup_reader.orm.ccm_orm import project_diff_query
+from ccm_backup_reader.orm.ccm_orm import structure_cte
+from synthetic_backup import create_synthetic_backup
+
+
+MATCH_A = "a.subsystem = b.subsystem AND a.cvtype = b.cvtype AND a.name = b.name"
+
+# LEFT JOIN of a on b plus the members of b without a match, a and b are each evaluated twice
+PREVIOUS_QUERY = \
+    "WITH RECURSIVE " + structure_cte('a') + ", " + structure_cte('b') + " " + \
+    "SELECT " + core_columns('a') + ", a.path, " + core_columns('b') + ", b.path " + \
+    "FROM a LEFT JOIN b ON (" + MATCH_A + ") " + \
+    "UNION ALL " + \
+    "SELECT " + ", ".join(["NULL"] * (len(CORE_COLUMNS) + 1)) + ", " + core_columns('b') + ", b.path " + \
+    "FROM b " + \
+    "WHERE NOT EXISTS (SELECT 1 FROM a WHERE " + MATCH_A + ")"
+
+
+def print_query_plan(db, sql_query, params):
+    for row in db.query_sql("EXPLAIN QUERY PLAN " + sql_query, *params):
+        print('    ' + str(row[-1]))
+
+
+def run(backup_path):
+    db = CcmDb(backup_path)
+    orm = CcmOrm(db)
+    first, last = db.query_sql("SELECT MIN(id), MAX(id) FROM compver WHERE cvtype = 'project'")[0]
+    project_a, project_b = orm.object_by_id(first), orm.object_by_id(last)
+    params = [first, first, first, last, last, last]
+
+    start = time.perf_counter()
+    previous_rows = db.query_sql(PREVIOUS_QUERY, *params)
+    previous_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    db.query_sql(project_diff_query(), *params)
+    query_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    entries = orm.diff_projects(project_a, project_b)
+    diff_time = time.perf_counter() - start
+
+    print('SQLite {}, {} entries'.format(sqlite3.sqlite_version, len(entries)))
+    print('previous query    {:8.3f} s'.format(previous_time))
+    print('diff query        {:8.3f} s'.format(query_time))
+    print('diff_projects     {:8.3f} s  (query and pairing into ProjectDiffEntry)'.format(diff_time))
+
+    print('previous query plan:')
+    print_query_plan(db, PREVIOUS_QUERY, params)
+    print('diff_projects query plan:')
+    print_query_plan(db, project_diff_query(), params)
+
+
+def main():
+    dirs = int(sys.argv[1]) if len(sys.argv) > 1 else 100
+    files_per_dir = int(sys.argv[2]) if len(sys.argv) > 2 else 200
+
+    with tempfile.TemporaryDirectory() as backup_path:
+        create_synthetic_backup(backup_path, projects=3, dirs=dirs, files_per_dir=files_per_dir,
+                                changes_per_project=dirs * files_per_dir // 10)
+        run(backup_path)
+
+
+if __name__ == '__main__':
+    main()
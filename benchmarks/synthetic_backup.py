@@ -0,0 +1,146 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Generate a synthetic backup database for the benchmarks.
+
+The database follows schema version 0114, as created by
+scripts/ccm_backup_to_sqlite.py, and contains a chain of projects. Every
+project holds a directory tree of files; every file has a successor chain of
+versions with a status_log.
+"""
+
+import os.path
+import random
+import sqlite3
+import sys
+import time
+
+
+SCHEMA = [
+    "CREATE TABLE attrib (id INTEGER PRIMARY KEY NOT NULL, name TEXT, modify_time INTEGER, textval TEXT, binval TEXT, strval TEXT, intval INTEGER, floatval TEXT, is_attr_of INTEGER, has_attype INTEGER);",
+    "CREATE TABLE bind (has_asm INTEGER, has_bound_bs INTEGER, has_child INTEGER, has_parent INTEGER, create_time INTEGER, sync_time INTEGER, wa_time INTEGER);",
+    "CREATE TABLE bsite (id INTEGER PRIMARY KEY NOT NULL, name TEXT, info TEXT, ui_info TEXT, is_bsite_of INTEGER, has_bstype INTEGER, has_next_bs INTEGER);",
+    "CREATE TABLE compver (id INTEGER PRIMARY KEY NOT NULL, status TEXT, create_time INTEGER, modify_time INTEGER, owner TEXT, is_asm INTEGER, is_model INTEGER, subsystem TEXT, cvtype TEXT, name TEXT, version TEXT, is_product INTEGER, ui_info INTEGER, release INTEGER, has_cvtype INTEGER, has_model INTEGER, has_super_type INTEGER, acc_key_0 INTEGER, acc_key_1 INTEGER, acc_key_2 INTEGER, acc_key_3 INTEGER, acc_key_4 INTEGER, acc_key_5 INTEGER, acc_key_6 INTEGER, acc_key_7 INTEGER, acc_key_8 INTEGER, acc_key_9 INTEGER, acc_key_10 INTEGER, acc_key_11 INTEGER, acc_key_12 INTEGER, acc_key_13 INTEGER, acc_key_14 INTEGER, acc_key_15 INTEGER, acc_key_16 INTEGER, acc_key_17 INTEGER, acc_key_18 INTEGER, acc_key_19 INTEGER);",
+    "CREATE TABLE control (id INTERGER PRIMARY KEY NOT NULL, nextid INTEGER, info TEXT);",
+    "CREATE TABLE relate (name TEXT, from_cv INTEGER, to_cv INTEGER, create_time INTEGER);",
+    "CREATE TABLE release (id INTEGER PRIMARY KEY NOT NULL, name TEXT);",
+    "CREATE TABLE acckeys (id INTEGER PRIMARY KEY NOT NULL, attr_name TEXT, attr_value TEXT);",
+]
+
+START_TIME = 1262304000  # 2010-01-01
+OWNERS = ['alice', 'bob', 'carol', 'dave']
+CVTYPES = ['csrc', 'incl', 'ascii', 'makefile']
+
+
+def status_log_text(entries):
+    lines = []
+    for timestamp, status, owner in entries:
+        time_str = time.strftime("%a %b %d %H:%M:%S %Y", time.gmtime(timestamp))
+        lines.append("{}: Status set to '{}' by {} in role developer".format(time_str, status, owner))
+    return '\n'.join(lines)
+
+
+class SyntheticBackup:
+
+    def __init__(self, connection, seed=0):
+        self._connection = connection
+        self._random = random.Random(seed)
+        self._next_id = 100
+        self._compvers = []
+        self._attribs = []
+        self._relations = []
+        self._binds = []
+
+    def _new_compver(self, name, version, cvtype, timestamp, release_id, status):
+        cv_id = self._next_id
+        self._next_id += 1
+        owner = self._random.choice(OWNERS)
+        self._compvers.append((cv_id, status, timestamp, timestamp, owner, 0, 0, '1', cvtype, name, version, release_id))
+        log = [(timestamp, 'working', owner), (timestamp + 60, status, owner)]
+        self._attribs.append((cv_id, 'status_log', status_log_text(log), None))
+        return cv_id
+
+    def generate(self, projects, dirs, files_per_dir, changes_per_project):
+        self._attribs.append((1, 'delimiter', '~', '~'))
+        self._compvers.append((1, None, START_TIME, START_TIME, 'ccm_root', 0, 1, 'base', 'model', 'base', '1', None))
+        self._connection.executemany("INSERT INTO release (id, name) VALUES (?, ?)",
+                                     [(release_id + 1, '{}.0'.format(release_id + 1)) for release_id in range(projects)])
+
+        # initial versions of all directories and files
+        timestamp = START_TIME
+        current = {}  # (dir index, file index or None) -> cv_id
+        versions = {}
+        for dir_idx in range(dirs):
+            current[(dir_idx, None)] = self._new_compver('dir{}'.format(dir_idx), '1', 'dir', timestamp, 1, 'integrate')
+            versions[(dir_idx, None)] = 1
+            for file_idx in range(files_per_dir):
+                cvtype = CVTYPES[file_idx % len(CVTYPES)]
+                name = 'file{}_{}'.format(dir_idx, file_idx)
+                current[(dir_idx, file_idx)] = self._new_compver(name, '1', cvtype, timestamp, 1, 'integrate')
+                versions[(dir_idx, file_idx)] = 1
+
+        # project chain, each project changes some of the files
+        previous_project = None
+        for project_idx in range(projects):
+            timestamp += 86400
+            release_id = project_idx + 1
+            if project_idx > 0:
+                for _ in range(changes_per_project):
+                    key = (self._random.randrange(dirs), self._random.randrange(files_per_dir))
+                    versions[key] += 1
+                    name = 'file{}_{}'.format(*key)
+                    cvtype = CVTYPES[key[1] % len(CVTYPES)]
+                    cv_id = self._new_compver(name, str(versions[key]), cvtype, timestamp, release_id, 'integrate')
+                    self._relations.append(('successor', current[key], cv_id))
+                    current[key] = cv_id
+
+            project_id = self._new_compver('proj', str(project_idx + 1), 'project', timestamp + 3600, release_id, 'released')
+            if previous_project:
+                self._relations.append(('successor', previous_project, project_id))
+                self._relations.append(('baseline_project', project_id, previous_project))
+            previous_project = project_id
+
+            for dir_idx in range(dirs):
+                dir_id = current[(dir_idx, None)]
+                self._binds.append((project_id, project_id, dir_id))
+                for file_idx in range(files_per_dir):
+                    self._binds.append((project_id, dir_id, current[(dir_idx, file_idx)]))
+
+        self._flush()
+        return previous_project
+
+    def _flush(self):
+        connection = self._connection
+        connection.executemany(
+            "INSERT INTO compver (id, status, create_time, modify_time, owner, is_asm, is_model, subsystem, cvtype, name, version, is_product) " +
+            "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", self._compvers)
+        connection.executemany("INSERT INTO attrib (is_attr_of, name, textval, strval) VALUES (?, ?, ?, ?)", self._attribs)
+        connection.executemany("INSERT INTO relate (name, from_cv, to_cv) VALUES (?, ?, ?)", self._relations)
+        connection.executemany("INSERT INTO bind (has_asm, has_parent, has_child) VALUES (?, ?, ?)", self._binds)
+        connection.commit()
+
+
+def create_synthetic_backup(backup_path, projects=10, dirs=20, files_per_dir=50, changes_per_project=200, seed=0):
+    """ Create DBdump.sqlite3 in backup_path, return the cv_id of the last project """
+    db_path = os.path.join(backup_path, 'DBdump.sqlite3')
+    connection = sqlite3.connect(db_path)
+    for statement in SCHEMA:
+        connection.execute(statement)
+
+    backup = SyntheticBackup(connection, seed)
+    last_project_id = backup.generate(projects, dirs, files_per_dir, changes_per_project)
+    connection.close()
+    return last_project_id
+
+
+def main():
+    if len(sys.argv) < 2:
+        print('Usage: ' + sys.argv[0] + ' <backup path>')
+        sys.exit(1)
+
+    create_synthetic_backup(sys.argv[1])
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,52 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Compare the memoryview and the stream XDelta appliers.
+
+Usage: xdelta_benchmark.py [source size in MiB]
+
+Patches are generated with small and with large copy instructions, as found in
+text and in binary archives.
+"""
+
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from ccm_backup_reader.ccm_xdelta import apply_patch
+from ccm_backup_reader.ccm_xdelta import apply_patch_stream
+from ccm_backup_reader.ccm_xdelta import encode_instructions
+
+
+def generate_patch(rnd, source_size, min_copy, max_copy):
+    instructions = []
+    pos = 0
+    while pos < source_size - max_copy:
+        length = rnd.randrange(min_copy, max_copy)
+        instructions.append((True, length, pos))
+        pos += length
+        instructions.append((False, 10, b'0123456789'))
+    return encode_instructions(instructions)
+
+
+def main():
+    source_size = int(sys.argv[1]) * 1024 * 1024 if len(sys.argv) > 1 else 20 * 1024 * 1024
+    rnd = random.Random(0)
+    source = bytes(rnd.getrandbits(8) for _ in range(source_size))
+
+    for name, min_copy, max_copy in [('small copies', 5, 40), ('large copies', 100, 4000)]:
+        patch = generate_patch(rnd, source_size, min_copy, max_copy)
+        results = []
+        for applier in (apply_patch, apply_patch_stream):
+            start = time.perf_counter()
+            results.append(applier(source, patch))
+            print('{:<14} {:<20} {:8.3f} s'.format(name, applier.__name__, time.perf_counter() - start))
+        assert results[0] == results[1]
+
+
+if __name__ == '__main__':
+    main()
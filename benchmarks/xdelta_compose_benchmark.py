@@ -0,0 +1,68 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Compare applying a chain of XDelta patches one by one with composing the chain.
+
+Usage: xdelta_compose_benchmark.py [chain length]
+
+Each patch makes a few small edits to its source, as a version of a large file does.
+"""
+
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from ccm_backup_reader.ccm_xdelta import apply_patch
+from ccm_backup_reader.ccm_xdelta import compose_patches
+from ccm_backup_reader.ccm_xdelta import encode_instructions
+
+
+def generate_patch(rnd, source_size, edit_count=5):
+    instructions = []
+    pos = 0
+    for edit in sorted(rnd.randrange(source_size) for _ in range(edit_count)):
+        if edit < pos:
+            continue
+        if edit > pos:
+            instructions.append((True, edit - pos, pos))
+        instructions.append((False, 8, b'edit%04d' % rnd.randrange(10000)))
+        pos = min(source_size, edit + 4)
+    if pos < source_size:
+        instructions.append((True, source_size - pos, pos))
+    return encode_instructions(instructions)
+
+
+def main():
+    chain_length = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    rnd = random.Random(0)
+
+    for size in (1024 * 1024, 16 * 1024 * 1024, 64 * 1024 * 1024):
+        base = rnd.getrandbits(8 * size).to_bytes(size, 'little')
+        patches = []
+        data = base
+        for _ in range(chain_length):
+            patch = generate_patch(rnd, len(data))
+            patches.append(patch)
+            data = apply_patch(data, patch)
+
+        start = time.perf_counter()
+        sequential = base
+        for patch in patches:
+            sequential = apply_patch(sequential, patch)
+        sequential_time = time.perf_counter() - start
+
+        start = time.perf_counter()
+        composed = compose_patches(base, patches)
+        composed_time = time.perf_counter() - start
+
+        assert sequential == composed == data
+        print('{:>4} MiB {:>5} patches  sequential {:8.3f} s  composed {:8.3f} s'.format(
+            size // (1024 * 1024), chain_length, sequential_time, composed_time))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,119 +1,369 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
+import mmap
 import os
+import shutil
 import sys
+import tempfile
+import threading
 import xml.etree.ElementTree as ET
 import zipfile
 
+from contextlib import contextmanager
 from io import BytesIO
 
+from ccm_backup_reader.ccm_error import CcmError
+from ccm_backup_reader.ccm_lru_cache import LruCache
+from ccm_backup_reader.ccm_xdelta import XDeltaApplier
+from ccm_backup_reader.ccm_xdelta import apply_patch
+from ccm_backup_reader.ccm_xdelta import apply_patch_stream
+from ccm_backup_reader.ccm_xdelta import compose_patches
+from ccm_backup_reader.ccm_xdelta import write_patch
 
-class XDeltaApplier:
 
-    @staticmethod
-    def apply(source_fd, target_fd, patch_fd):
-        while True:
-            cmd = patch_fd.read(1)
-            if len(cmd) == 0:
-                return
-            cmd = cmd[0]
-
-            copy_from_source = (cmd & 128) != 0
-            length = XDeltaApplier._read_a(cmd, patch_fd);
-            if copy_from_source:
-                offset = XDeltaApplier._read_b(patch_fd)
-                while length != 0:
-                    # copy from source to target
-                    source_fd.seek(offset)
-                    b = source_fd.read(length)
-                    target_fd.write(b)
-
-                    length -= len(b)
-                    offset += len(b)
-            else:
-                while length != 0:
-                    b = patch_fd.read(length)
-                    target_fd.write(b)
-                    length -= len(b)
-
-    @staticmethod
-    def _read_a(start, fd):
-        number = 0
-        bit_count = 0
-
-        while True:
-            if bit_count > 62:
-                raise Exception("Invalid state")
+# Patch appliers, the stream applier is the fallback for the memoryview applier
+XDELTA_APPLIERS = {
+    'memoryview': apply_patch,
+    'stream': apply_patch_stream,
+}
 
-            if bit_count == 0:
-                number = start & 63
-                if (start & 64) == 0:
-                    break
+# Byte budget of the reconstructed versions shared by all archive readers
+VERSION_CACHE_SIZE = 256 * 1024 * 1024
 
-                bit_count = 6
-            else:
-                read = fd.read(1)[0]
-                number |= (read & 127) << bit_count
-                if (read & 128) == 0:
-                    break
-
-                bit_count += 7
-
-        return number
+# Intermediate versions at this distance from the stored full version are cached
+# while reconstructing, so that other branches of the chain can start from them
+VERSION_CACHE_INTERVAL = 32
 
-    @staticmethod
-    def _read_b(fd):
-        """ read a long """
-        number = 0
-        bit_count = 0
+VERSION_CACHE = LruCache(VERSION_CACHE_SIZE, weigher=len)
 
-        while True:
-            read = fd.read(1)[0]
+# Chains of more patches than this, on versions of at least COMPOSE_MIN_SIZE bytes, are composed into one
+# patch against the start version instead of being applied one by one (memoryview applier only).
+# Below, copying the versions is cheaper than composing.
+COMPOSE_MIN_CHAIN = 50
+COMPOSE_MIN_SIZE = 1024 * 1024
 
-            if bit_count == 56:
-                number |= (read << 56)
-                break
+# In extract_to, versions whose stored full version is smaller than this are reconstructed in memory,
+# larger ones through temporary files read back with mmap
+EXTRACT_TO_MEMORY_SIZE = 32 * 1024 * 1024
 
-            number |= (read & 127) << bit_count
-            if (read & 128) == 0:
-                break
+# Number of open archive readers kept by a CcmArchiveReaderCache, each holds a file handle
+ARCHIVE_READER_CACHE_SIZE = 64
 
-            bit_count += 7
 
-        return number
+class CcmArchiveReader:
 
+    HEADER_NAME = 'META-INF/ARCHIVE-HEADER'
 
-class CcmArchiveReader:
+    def __init__(self, archive, applier='memoryview', cache=VERSION_CACHE, blob_cache=None):
+        """
+        Reconstructed versions are kept in cache, keyed by (archive path, modification time, fullName).
+        By default the cache is shared by all readers, None disables caching.
+        With a CcmBlobCache, extracted versions are also kept on disk across runs.
+        """
+        if applier not in XDELTA_APPLIERS:
+            raise CcmError("Unknown XDelta applier: " + applier)
 
-    def __init__(self, archive):
         self._archive = archive
+        self._archive_path = os.path.abspath(archive)
+        self._mtime = os.stat(archive).st_mtime_ns
+        self._cache = cache
+        self._blob_cache = blob_cache
+        self._apply_patch = XDELTA_APPLIERS[applier]
         self._zip_file = zipfile.ZipFile(archive, 'r')
 
-        metadata_text = self._zip_file.read('META-INF/ARCHIVE-HEADER')
-        self._metadata = ET.fromstring(metadata_text)
+        # leases taken through CcmArchiveReaderCache, a retired reader is closed when the last one is released
+        self._leases = 0
+        self._retired = False
+        self._lease_lock = threading.Lock()
+
+        # entries by fullName and by predecessor, the fullNames in header order
+        # and the fullNames of the successors of each version
+        self._entries = {}
+        self._entries_by_predecessor = {}
+        self._full_names = []
+        self._successors = {}
+        self._read_header()
+
+    def _read_header(self):
+        """ Index the entries of the archive header, parsed incrementally """
+        with self._zip_file.open(self.HEADER_NAME) as header_fd:
+            root = None
+            for event, element in ET.iterparse(header_fd, events=('start', 'end')):
+                if event == 'start':
+                    if root is None:
+                        root = element
+                    continue
+                if element.tag != 'entry' or element is root:
+                    continue
+
+                entry = self._entry_to_dict(element)
+                full_name = entry.get('fullName')
+                self._entries[full_name] = entry
+                self._full_names.append(full_name)
+                if 'predecessor' in entry:
+                    self._entries_by_predecessor.setdefault(entry['predecessor'], entry)
+                    self._successors.setdefault(entry['predecessor'], []).append(full_name)
+
+                # entries are indexed, drop the parsed elements
+                root.clear()
+
+    def close(self):
+        self._zip_file.close()
+
+    def acquire(self):
+        """ Take a lease, the reader stays open until it is released """
+        with self._lease_lock:
+            self._leases += 1
+
+    def release(self):
+        with self._lease_lock:
+            self._leases -= 1
+            close = self._retired and self._leases == 0
+        if close:
+            self.close()
+
+    def retire(self):
+        """ Close the reader now, or when the last lease is released """
+        with self._lease_lock:
+            self._retired = True
+            close = self._leases == 0
+        if close:
+            self.close()
+
+    @property
+    def versions(self):
+        """ fullNames of the versions in the archive, in header order """
+        return list(self._full_names)
+
+    @property
+    def mtime(self):
+        """ Modification time of the archive when it was opened, in ns """
+        return self._mtime
+
+    @property
+    def cache(self):
+        return self._cache
+
+    def cache_stats(self):
+        return self._cache.stats() if self._cache is not None else None
+
+    def _cache_key(self, full_name):
+        return (self._archive_path, self._mtime, full_name)
 
     def extract(self, version):
         # build entry-list to follow
         entries = self._find_entries_to_entry(version)
-        entries.reverse()
 
-        # read data from first entry
-        data = self._extract_version(entries[0])
-        entries = entries[1:]
+        if self._cache is not None:
+            data = self._cache.get(self._cache_key(version))
+            if data is not None:
+                return data
 
-        # keep applying patches
-        for entry in entries:
-            data = self._apply_version(entry, data)
+        data = self._blob_get(version)
+        if data is not None:
+            if self._cache is not None:
+                self._cache.put(self._cache_key(version), data)
+            return data
 
+        # start from the nearest cached ancestor, or read data from the first entry
+        start, data = self._find_cached_ancestor(entries)
+        entries.reverse()
+        if data is None:
+            start = 0
+            data = self._extract_version(entries[0])
+        entries = entries[start + 1:]
+
+        if len(entries) > COMPOSE_MIN_CHAIN and len(data) >= COMPOSE_MIN_SIZE and self._apply_patch is apply_patch:
+            data = self._compose_versions(entries, data)
+        else:
+            # keep applying patches, caching intermediate versions every VERSION_CACHE_INTERVAL steps
+            for idx, entry in enumerate(entries, start + 1):
+                data = self._apply_version(entry, data)
+                if self._cache is not None and idx % VERSION_CACHE_INTERVAL == 0:
+                    self._cache.put(self._cache_key(entry['fullName']), data)
+
+        if self._cache is not None:
+            self._cache.put(self._cache_key(version), data)
+        self._blob_put(version, data)
         return data
 
+    def extract_to(self, version, fileobj):
+        """
+        Write a version to fileobj. The last patch is applied straight to fileobj, the version itself is never held in memory.
+        The predecessor it applies to comes from extract for small files. For large files the intermediate versions are
+        written to temporary files and read back through mmap, so that only the pages in use are resident.
+        """
+        entries = self._find_entries_to_entry(version)
+
+        if self._cache is not None:
+            data = self._cache.get(self._cache_key(version))
+            if data is not None:
+                fileobj.write(data)
+                return
+
+        data = self._blob_get(version)
+        if data is not None:
+            fileobj.write(data)
+            return
+
+        entry = entries[0]
+        if len(entries) == 1:
+            with self._zip_file.open(entry['fullName']) as version_fd:
+                shutil.copyfileobj(version_fd, fileobj)
+            return
+
+        patch = self._extract_version(entry)
+        predecessor = entries[1]['fullName']
+        stored_size = self._zip_file.getinfo(entries[-1]['fullName']).file_size
+        if stored_size < EXTRACT_TO_MEMORY_SIZE or (self._cache is not None and self._cache_key(predecessor) in self._cache):
+            write_patch(self.extract(predecessor), patch, fileobj.write)
+            return
+
+        with self._mapped_version(entries[1:]) as source:
+            write_patch(source, patch, fileobj.write)
+
+    @contextmanager
+    def _mapped_version(self, entries):
+        """
+        Reconstruct the first of entries, ordered back to the stored full version, in a temporary file.
+        Yields its contents mmapped. Each patch reads the previous temporary file through mmap.
+        """
+        source_file = tempfile.TemporaryFile()
+        try:
+            with self._zip_file.open(entries[-1]['fullName']) as version_fd:
+                shutil.copyfileobj(version_fd, source_file)
+
+            for entry in reversed(entries[:-1]):
+                patch = self._extract_version(entry)
+                target_file = tempfile.TemporaryFile()
+                try:
+                    with self._mapped_file(source_file) as source:
+                        write_patch(source, patch, target_file.write)
+                except BaseException:
+                    target_file.close()
+                    raise
+                source_file.close()
+                source_file = target_file
+
+            with self._mapped_file(source_file) as source:
+                yield source
+        finally:
+            source_file.close()
+
+    @staticmethod
+    @contextmanager
+    def _mapped_file(file):
+        file.flush()
+        if os.fstat(file.fileno()).st_size == 0:
+            # empty files cannot be mapped
+            yield b''
+            return
+
+        mapped = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            yield mapped
+        finally:
+            mapped.close()
+
+    def iter_versions(self):
+        """
+        Yield (fullName, data) for every version in the archive, walking the delta tree once.
+        Each patch is applied a single time and only the versions still needed as patch source are
+        kept in memory. Versions are yielded depth first from the stored full versions, not in header order.
+        The shared cache is neither used nor filled. Versions found in the blob cache are read from it instead of
+        being patched, the others are added to it.
+        """
+        blob_versions = self._blob_cache.versions(self._archive_path, self._mtime) if self._blob_cache is not None else set()
+        roots = [full_name for full_name in self._full_names if 'predecessor' not in self._entries[full_name]]
+
+        yielded = 0
+        # (fullName, data of its predecessor), data is None for stored full versions
+        stack = [(full_name, None) for full_name in reversed(roots)]
+        while stack:
+            full_name, source = stack.pop()
+            entry = self._entries[full_name]
+            data = self._blob_get(full_name) if full_name in blob_versions else None
+            if data is None:
+                if source is None:
+                    data = self._extract_version(entry)
+                else:
+                    data = self._apply_version(entry, source)
+                self._blob_put(full_name, data)
+            del source
+
+            yield full_name, data
+            yielded += 1
+
+            for successor in reversed(self._successors.get(full_name, [])):
+                stack.append((successor, data))
+            del data
+
+        if yielded != len(self._entries):
+            unreachable = [full_name for full_name in self._full_names if not self._is_reachable(full_name)]
+            raise CcmError("Versions without stored full version in archive {}: {}".format(self._archive, ', '.join(unreachable)))
+
+    def _is_reachable(self, full_name):
+        try:
+            self._find_entries_to_entry(full_name)
+        except CcmError:
+            return False
+        return True
+
+    def _compose_versions(self, entries, data):
+        """
+        Apply the patches of entries to data by composing them, see compose_patches.
+        Only the intermediate versions the composition builds are cached.
+        """
+        def materialized(idx, version_data):
+            if self._cache is not None:
+                self._cache.put(self._cache_key(entries[idx]['fullName']), version_data)
+
+        patches = (self._extract_version(entry) for entry in entries)
+        return compose_patches(data, patches, materialized)
+
+    def _blob_get(self, full_name):
+        if self._blob_cache is None:
+            return None
+        return self._blob_cache.get(self._archive_path, full_name, self._mtime)
+
+    def _blob_put(self, full_name, data):
+        if self._blob_cache is not None:
+            self._blob_cache.put(self._archive_path, full_name, self._mtime, data)
+
+    def _find_cached_ancestor(self, entries):
+        """
+        Nearest ancestor in the cache, for entries ordered from the version back to the stored full version.
+        Returns its index counted from the stored full version and its data, or (None, None).
+        """
+        if self._cache is None:
+            return None, None
+
+        for idx, entry in enumerate(entries[1:], 1):
+            key = self._cache_key(entry['fullName'])
+            if key in self._cache:
+                data = self._cache.get(key)
+                if data is not None:
+                    return len(entries) - 1 - idx, data
+        return None, None
+
     def _find_entries_to_entry(self, version):
+        """ Entries from version back to the stored full version, following the predecessors """
         entry = self._find_entry(version)
+        if entry is None:
+            raise CcmError("Version not found in archive {}: {}".format(self._archive, version))
+
         entries = [entry]
+        seen = {version}
         while 'predecessor' in entry:
             predecessor = entry['predecessor']
+            if predecessor in seen:
+                raise CcmError("Predecessor cycle in archive {} at: {}".format(self._archive, predecessor))
+            seen.add(predecessor)
+
             entry = self._find_entry(predecessor)
+            if entry is None:
+                raise CcmError("Version not found in archive {}: {}".format(self._archive, predecessor))
             entries.append(entry)
         return entries
 
@@ -123,22 +373,10 @@ class CcmArchiveReader:
 
     def _apply_version(self, entry, data):
         patch = self._extract_version(entry)
-
-        # apply patch
-        source_fd = BytesIO(data)
-        target_fd = BytesIO()
-        patch_fd = BytesIO(patch)
-        XDeltaApplier.apply(source_fd, target_fd, patch_fd)
-        target_fd.seek(0)
-        return target_fd.read()
+        return self._apply_patch(data, patch)
 
     def _find_entry(self, full_name):
-        for entry in self._metadata.findall("entry"):
-            entry_full_name = entry.find('fullName').text
-            if entry_full_name != full_name:
-                continue
-
-            return self._entry_to_dict(entry)
+        return self._entries.get(full_name)
 
     def _entry_to_dict(self, entry):
         d = {}
@@ -149,27 +387,15 @@ class CcmArchiveReader:
         return d
 
     def _find_entry_with_predecessor(self, predecessor):
-        for entry in self._metadata.findall("entry"):
-            if entry.find('predecessor') is None:
-                continue
-
-            entry_predecessor = entry.find('predecessor').text
-            if entry_predecessor != predecessor:
-                continue
-
-            return self._entry_to_dict(entry)
-
-
+        return self._entries_by_predecessor.get(predecessor)
 
     def _find_top_entry(self):
-        last_entry = self._metadata.findall("entry")[-1]
-        return self._entry_to_dict(last_entry)
-
+        last_full_name = self._full_names[-1]
+        return self._entries[last_full_name]
 
     def _extract_top_version(self):
         entry = self._find_top_entry()
-        full_name = entry['fullName']
-        return self._extract_version(full_name)
+        return self._extract_version(entry)
 
     def _extract_predecessor(self, version, data):
         # get metadata
@@ -179,13 +405,73 @@ class CcmArchiveReader:
             raise NotImplementedError("Don't know how to handle format: " + delta_format)
 
         # get patch
-        full_name = entry['fullName']
-        patch = self._extract_version(full_name)
+        patch = self._extract_version(entry)
 
         # apply patch
-        source_fd = BytesIO(data)
-        target_fd = BytesIO()
-        patch_fd = BytesIO(patch)
-        XDeltaApplier.apply(source_fd, target_fd, patch_fd)
-        target_fd.seek(0)
-        return entry, target_fd.read()
+        return entry, self._apply_patch(data, patch)
+
+
+class CcmArchiveReaderCache:
+    """
+    Open archive readers keyed by path and blob cache, so the zip directory and the archive header are read once per archive.
+    A reader is replaced when the modification time of its archive changes. Safe for use from multiple threads.
+    Readers are leased through open(), evicted and replaced readers are closed once no lease is left on them.
+    """
+
+    def __init__(self, capacity=ARCHIVE_READER_CACHE_SIZE, version_cache=VERSION_CACHE):
+        self._readers = LruCache(capacity, on_evict=self._retire)
+        self._version_cache = version_cache
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _retire(key, cached):
+        cached[0].retire()
+
+    @contextmanager
+    def open(self, path, blob_cache=None):
+        """ Yield the reader of an archive, it is not closed before the block is left """
+        reader = self._acquire(path, blob_cache)
+        try:
+            yield reader
+        finally:
+            reader.release()
+
+    def _acquire(self, path, blob_cache):
+        path = os.path.abspath(path)
+        try:
+            mtime = os.stat(path).st_mtime_ns
+        except FileNotFoundError:
+            raise CcmError("File not found in backup archive: " + path)
+
+        key = (path, blob_cache)
+        with self._lock:
+            cached = self._readers.get(key)
+            if cached is not None and cached[1] == mtime:
+                cached[0].acquire()
+                return cached[0]
+
+        # opened outside of the lock, other archives are served meanwhile.
+        # Versions cached by a replaced reader are not found anymore, their key holds the old mtime
+        reader = CcmArchiveReader(path, cache=self._version_cache, blob_cache=blob_cache)
+        with self._lock:
+            cached = self._readers.get(key)
+            if cached is not None and cached[1] == reader.mtime:
+                # opened by another thread meanwhile
+                reader.close()
+                reader = cached[0]
+            else:
+                self._readers.put(key, (reader, reader.mtime))
+            # taken under the lock, the reader cannot be retired before
+            reader.acquire()
+        return reader
+
+    def clear(self):
+        """ Drop all readers, closing them once they are released """
+        with self._lock:
+            self._readers.clear()
+
+    def stats(self):
+        return self._readers.stats()
+
+
+ARCHIVE_READER_CACHE = CcmArchiveReaderCache()
@@ -0,0 +1,230 @@
+# -*- coding: utf-8 -*-
+
+"""
+Persistent cache of extracted file versions.
+
+Blobs are stored once per content hash below the cache directory, blobs/<first 2 hex digits>/<sha256>.
+An SQLite index maps (archive path, version, archive mtime) to the hash, so a rewritten archive misses
+the cache, and records the size and last access of each blob and their total size for eviction.
+Access times of hits are kept in memory and written in batches, a hit does not commit to the index.
+"""
+
+import hashlib
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+
+from ccm_backup_reader.ccm_error import CcmError
+
+
+# Default size budget of the blobs in a cache directory
+BLOB_CACHE_SIZE = 1024 * 1024 * 1024
+
+INDEX_NAME = 'index.sqlite3'
+
+# Number of hits whose access times are kept in memory before they are written to the index
+ACCESS_TIME_BATCH = 256
+
+INDEX_SCHEMA = [
+    "CREATE TABLE IF NOT EXISTS versions (archive TEXT, version TEXT, mtime INTEGER, digest TEXT, " +
+    "PRIMARY KEY (archive, version, mtime))",
+    "CREATE TABLE IF NOT EXISTS blobs (digest TEXT PRIMARY KEY, size INTEGER, access_time REAL)",
+    "CREATE INDEX IF NOT EXISTS versions_digest ON versions (digest)",
+    "CREATE INDEX IF NOT EXISTS blobs_access_time ON blobs (access_time)",
+    # total size of the blobs, kept up to date with the blobs table
+    "CREATE TABLE IF NOT EXISTS total (size INTEGER)",
+    "INSERT INTO total (size) SELECT COALESCE(SUM(size), 0) FROM blobs WHERE NOT EXISTS (SELECT 1 FROM total)",
+]
+
+
+class CcmBlobCacheError(CcmError):
+    pass
+
+
+class CcmBlobCache:
+    """
+    Content addressed cache of file versions in a directory, shared by threads and processes.
+    Blobs beyond size_budget are evicted, least recently used first.
+    """
+
+    def __init__(self, directory, size_budget=BLOB_CACHE_SIZE):
+        self._directory = os.path.abspath(directory)
+        self._size_budget = size_budget
+        self._lock = threading.Lock()
+        self._connection = None
+        self._pid = None
+        self._access_times = {}
+
+        try:
+            os.makedirs(os.path.join(self._directory, 'blobs'), exist_ok=True)
+        except OSError as e:
+            raise CcmBlobCacheError("Cannot create blob cache directory {}: {}".format(self._directory, e))
+
+    def __getstate__(self):
+        # worker processes open their own index connection
+        return {'directory': self._directory, 'size_budget': self._size_budget}
+
+    def __setstate__(self, state):
+        self.__init__(state['directory'], state['size_budget'])
+
+    @property
+    def directory(self):
+        return self._directory
+
+    @property
+    def size_budget(self):
+        return self._size_budget
+
+    def _index(self):
+        """ Connection to the index, opened once per process, a connection must not be used across fork """
+        if self._connection is None or self._pid != os.getpid():
+            connection = sqlite3.connect(os.path.join(self._directory, INDEX_NAME), timeout=30, check_same_thread=False)
+            with connection:
+                for statement in INDEX_SCHEMA:
+                    connection.execute(statement)
+            self._connection = connection
+            self._pid = os.getpid()
+            self._access_times = {}
+        return self._connection
+
+    def _flush_access_times(self, connection):
+        """ Write the pending access times, in the current transaction """
+        connection.executemany("UPDATE blobs SET access_time = ? WHERE digest = ?",
+                               [(access_time, digest) for digest, access_time in self._access_times.items()])
+        self._access_times = {}
+
+    def flush(self):
+        """ Write the access times of the hits since the last flush to the index """
+        with self._lock:
+            if self._access_times:
+                connection = self._index()
+                with connection:
+                    self._flush_access_times(connection)
+
+    def close(self):
+        """ Flush and close the index, it is reopened when the cache is used again """
+        self.flush()
+        with self._lock:
+            if self._connection is not None and self._pid == os.getpid():
+                self._connection.close()
+            self._connection = None
+
+    def _blob_path(self, digest):
+        return os.path.join(self._directory, 'blobs', digest[:2], digest)
+
+    def get(self, archive, version, mtime):
+        """ Data of a version of an archive as it was at mtime, None when not cached """
+        with self._lock:
+            connection = self._index()
+            rows = connection.execute(
+                "SELECT digest FROM versions WHERE archive = ? AND version = ? AND mtime = ?",
+                (archive, version, mtime)).fetchall()
+            if not rows:
+                return None
+            digest = rows[0][0]
+
+            try:
+                with open(self._blob_path(digest), 'rb') as blob_fd:
+                    data = blob_fd.read()
+            except FileNotFoundError:
+                # removed behind our back, forget it
+                with connection:
+                    self._delete_blobs(connection, connection.execute(
+                        "SELECT digest, size FROM blobs WHERE digest = ?", (digest,)).fetchall())
+                    connection.execute("DELETE FROM versions WHERE digest = ?", (digest,))
+                self._access_times.pop(digest, None)
+                return None
+
+            self._access_times[digest] = time.time()
+            if len(self._access_times) >= ACCESS_TIME_BATCH:
+                with connection:
+                    self._flush_access_times(connection)
+            return data
+
+    def versions(self, archive, mtime):
+        """ Versions of an archive as it was at mtime held in the cache """
+        with self._lock:
+            rows = self._index().execute(
+                "SELECT version FROM versions WHERE archive = ? AND mtime = ?", (archive, mtime)).fetchall()
+        return {row[0] for row in rows}
+
+    def put(self, archive, version, mtime, data):
+        """ Store a version, blobs are written once per content """
+        if len(data) > self._size_budget:
+            return
+
+        digest = hashlib.sha256(data).hexdigest()
+        blob_path = self._blob_path(digest)
+        if not os.path.exists(blob_path):
+            self._write_blob(blob_path, data)
+
+        with self._lock:
+            connection = self._index()
+            with connection:
+                # eviction below must see the hits so far
+                self._flush_access_times(connection)
+                connection.execute(
+                    "INSERT OR REPLACE INTO versions (archive, version, mtime, digest) VALUES (?, ?, ?, ?)",
+                    (archive, version, mtime, digest))
+                if connection.execute("SELECT 1 FROM blobs WHERE digest = ?", (digest,)).fetchone():
+                    connection.execute("UPDATE blobs SET access_time = ? WHERE digest = ?", (time.time(), digest))
+                else:
+                    connection.execute("INSERT INTO blobs (digest, size, access_time) VALUES (?, ?, ?)",
+                                       (digest, len(data), time.time()))
+                    connection.execute("UPDATE total SET size = size + ?", (len(data),))
+                total = connection.execute("SELECT size FROM total").fetchone()[0]
+            if total > self._size_budget:
+                self._evict(connection, total)
+
+    def _write_blob(self, blob_path, data):
+        """ Write through a temporary file, readers never see a partial blob """
+        os.makedirs(os.path.dirname(blob_path), exist_ok=True)
+        desc, temp_path = tempfile.mkstemp(dir=os.path.dirname(blob_path))
+        try:
+            with os.fdopen(desc, 'wb') as blob_fd:
+                blob_fd.write(data)
+            os.replace(temp_path, blob_path)
+        except BaseException:
+            if os.path.exists(temp_path):
+                os.unlink(temp_path)
+            raise
+
+    def _delete_blobs(self, connection, blobs):
+        """ Remove blobs, as (digest, size), from the index, in the current transaction """
+        for digest, size in blobs:
+            connection.execute("DELETE FROM blobs WHERE digest = ?", (digest,))
+            connection.execute("UPDATE total SET size = size - ?", (size,))
+
+    def _evict(self, connection, total):
+        """ Remove the least recently used blobs until total is within the budget """
+        evicted = []
+        for digest, size in connection.execute("SELECT digest, size FROM blobs ORDER BY access_time"):
+            if total <= self._size_budget:
+                break
+            evicted.append((digest, size))
+            total -= size
+
+        with connection:
+            self._delete_blobs(connection, evicted)
+            for digest, _ in evicted:
+                connection.execute("DELETE FROM versions WHERE digest = ?", (digest,))
+        for digest, _ in evicted:
+            try:
+                os.unlink(self._blob_path(digest))
+            except FileNotFoundError:
+                pass
+
+    def stats(self):
+        with self._lock:
+            connection = self._index()
+            blob_count = connection.execute("SELECT COUNT(*) FROM blobs").fetchone()[0]
+            size = connection.execute("SELECT size FROM total").fetchone()[0]
+            version_count = connection.execute("SELECT COUNT(*) FROM versions").fetchone()[0]
+        return {
+            'versions': version_count,
+            'blobs': blob_count,
+            'size': size,
+            'size_budget': self._size_budget,
+        }
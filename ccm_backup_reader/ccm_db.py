@@ -5,7 +5,12 @@ import re
 import sqlite3
 
 from collections import OrderedDict
+from collections import namedtuple
+from contextlib import contextmanager
+from urllib.parse import quote
 
+from ccm_backup_reader.ccm_archive_reader import ARCHIVE_READER_CACHE
+from ccm_backup_reader.ccm_error import CcmError
 from ccm_backup_reader.ccm_query_parser import SqlQueryBuilder
 import ccm_backup_reader.ccm_utils as ccm_utils
 
@@ -28,6 +33,45 @@ _COMPVER_ATTR_NAMES = OrderedDict([
 ])
 
 
+# Settings used to open the backup database. The database never changes after
+# import, so the non-default profiles tell SQLite it is immutable and trade
+# memory for speed.
+OPEN_PROFILES = {
+    'default': {
+        'uri_params': [('mode', 'ro')],
+        'pragmas': [],
+        'in_memory': False,
+    },
+    'readonly-fast': {
+        'uri_params': [('mode', 'ro'), ('immutable', '1')],
+        'pragmas': [
+            ('mmap_size', 1 << 30),
+            ('cache_size', -256 * 1024),  # in KiB
+            ('temp_store', 'MEMORY'),
+            ('query_only', 'ON'),
+        ],
+        'in_memory': False,
+    },
+    'in-memory': {
+        'uri_params': [('mode', 'ro'), ('immutable', '1')],
+        'pragmas': [
+            ('temp_store', 'MEMORY'),
+            ('query_only', 'ON'),
+        ],
+        'in_memory': True,
+    },
+}
+
+# Number of prepared statements kept by sqlite3, per connection
+STATEMENT_CACHE_SIZE = 512
+
+# Number of rows fetched at a time when streaming results
+FETCH_SIZE = 256
+
+
+CcmQueryRow = namedtuple('CcmQueryRow', SqlQueryBuilder.COMPVER_COLUMNS)
+
+
 def ccm_status(status_log):
     """ Extract last status change """
     if not status_log:
@@ -40,21 +84,85 @@ def ccm_status(status_log):
 
 class CcmDb(object):
 
-    def __init__(self, backup_path, dbdump_filename='DBdump.sqlite3'):
+    def __init__(self, backup_path, dbdump_filename='DBdump.sqlite3', profile='default', archive_readers=ARCHIVE_READER_CACHE,
+                 blob_cache=None):
+        """
+        archive_readers is the CcmArchiveReaderCache serving archive_reader(),
+        by default the one shared by all databases of the process.
+        blob_cache is an optional CcmBlobCache keeping extracted file versions on disk across runs.
+        """
+        if profile not in OPEN_PROFILES:
+            raise CcmError("Unknown open profile: " + profile)
+
         self._backup_path = backup_path
+        self._db_path = os.path.join(backup_path, dbdump_filename)
+        self._profile = profile
+        self._archive_readers = archive_readers
+        self._blob_cache = blob_cache
 
-        db_path = os.path.join(backup_path, dbdump_filename)
-        db_uri = 'file:' + db_path + '?mode=ro'
-        connection = sqlite3.connect(db_uri, uri=True)
+        connection = self._connect(OPEN_PROFILES[profile])
         connection.create_function("ccm_status", 1, ccm_status)
         self._db_connection = connection
 
+        self._delim = None
+        self._query_builder = None
+
+    def _connect(self, open_profile):
+        """ Open the database according to an entry from OPEN_PROFILES """
+        uri_params = '&'.join(key + '=' + value for key, value in open_profile['uri_params'])
+        db_uri = 'file:' + quote(self._db_path) + '?' + uri_params
+        connection = sqlite3.connect(db_uri, uri=True, cached_statements=STATEMENT_CACHE_SIZE)
+
+        if open_profile['in_memory']:
+            # copy the whole database to memory, the file is not used afterwards
+            memory_connection = sqlite3.connect(':memory:', cached_statements=STATEMENT_CACHE_SIZE)
+            if hasattr(connection, 'backup'):
+                connection.backup(memory_connection)
+            else:
+                # Connection.backup is new in Python 3.7
+                memory_connection.executescript('\n'.join(connection.iterdump()))
+            connection.close()
+            connection = memory_connection
+
+        for pragma, value in open_profile['pragmas']:
+            connection.execute("PRAGMA {} = {}".format(pragma, value))
+
+        return connection
+
     @property
     def backup_path(self):
         return self._backup_path
 
+    @property
+    def db_path(self):
+        return self._db_path
+
+    @property
+    def profile(self):
+        return self._profile
+
+    @property
+    def blob_cache(self):
+        return self._blob_cache
+
+    def st_root_path(self, archive):
+        """ Path of an archive named in a source attribute, raises CcmError when it does not exist """
+        path = os.path.join(self._backup_path, 'st_root', archive)
+        if not os.path.exists(path):
+            raise CcmError("File not found in backup archive: " + path)
+        return path
+
+    @contextmanager
+    def archive_reader(self, archive):
+        """ Yield the CcmArchiveReader of an archive named in a source attribute, shared through the reader cache """
+        with self._archive_readers.open(self.st_root_path(archive), self._blob_cache) as reader:
+            yield reader
+
     def delim(self):
         """ """
+        if self._delim is not None:
+            return self._delim
+
         query = \
 """
 select attrib.strval
@@ -67,8 +175,15 @@ where  compver.name = 'base' and
 """
         cursor = self._db_connection.cursor()
         cursor.execute(query)
-        delim = cursor.fetchone()[0]
-        return delim
+        self._delim = cursor.fetchone()[0]
+        return self._delim
+
+    @property
+    def query_builder(self):
+        """ SqlQueryBuilder for this database, holds the compiled query cache """
+        if self._query_builder is None:
+            self._query_builder = SqlQueryBuilder(self.delim())
+        return self._query_builder
 
     def attrs(self, four_part_name):
         """ """
@@ -137,15 +252,39 @@ WHERE  compver.name = ? AND
 
         return None
 
-    def query(self, ccm_query):
-        """ Parse a CCM query and return resulting compvers """
-        delim = self.delim()
-        query_builder = SqlQueryBuilder(delim)
-        sql_query = query_builder.build(ccm_query)
+    def _iter_cursor(self, cursor):
+        """ Yield rows from an executed cursor, FETCH_SIZE rows at a time """
+        try:
+            while True:
+                rows = cursor.fetchmany(FETCH_SIZE)
+                if not rows:
+                    break
+                yield from rows
+        finally:
+            cursor.close()
+
+    def query(self, ccm_query, stream=False, columns=None):
+        """
+        Parse a CCM query and return resulting compvers.
+        With stream, return an iterator of CcmQueryRows instead of a list of dicts.
+        With columns, only compute these columns, the others are None.
+        """
+        sql_query, params = self.query_builder.build(ccm_query, columns)
+
+        cursor = self._db_connection.cursor()
+        cursor.execute(sql_query, params)
+        if stream:
+            return map(CcmQueryRow._make, self._iter_cursor(cursor))
+        return [dict(zip(SqlQueryBuilder.COMPVER_COLUMNS, row)) for row in cursor.fetchall()]
+
+    def explain(self, ccm_query, columns=None):
+        """ Return the SQL query, its parameters and the SQLite query plan for a CCM query """
+        sql_query, params = self.query_builder.build(ccm_query, columns)
 
         cursor = self._db_connection.cursor()
-        cursor.execute(sql_query)
-        return [dict(zip(query_builder.COMPVER_COLUMNS, row)) for row in cursor.fetchall()]
+        cursor.execute("EXPLAIN QUERY PLAN " + sql_query, params)
+        query_plan = cursor.fetchall()
+        return sql_query, params, query_plan
 
     def finduse_task(self, four_part_name):
         fpn = ccm_utils.parse_fpn(four_part_name, self.delim())
@@ -154,16 +293,17 @@ WHERE  compver.name = ? AND
         # find all task_in_baseline ?
         # find all task_in_folder ?  XXX TODO: is this correct?
         sql_query = \
-            ("SELECT cv2.name || '" + self.delim() + "' || cv2.version || ':' || cv2.cvtype || ':' || cv2.subsystem AS objectname, ccm_status(a1.textval) AS status " + \
-             "FROM compver cv1 INNER JOIN relate r1 ON (cv1.id = r1.to_cv) INNER JOIN relate r2 ON (r1.from_cv = r2.to_cv) INNER JOIN compver cv2 ON (r2.from_cv = cv2.id) LEFT JOIN attrib a1 ON (cv2.id = a1.is_attr_of) " + \
-             "WHERE cv1.name = '{name}' AND cv1.version = '{version}' AND cv1.cvtype = '{type}' AND cv1.subsystem = '{instance}' AND " + \
-                  "r1.name = 'task_in_folder' AND " + \
-                  "r2.name = 'folder_in_rp' AND "+ \
-                  "a1.name = 'status_log'").format(**fpn)
+            "SELECT cv2.name || ? || cv2.version || ':' || cv2.cvtype || ':' || cv2.subsystem AS objectname, ccm_status(a1.textval) AS status " + \
+            "FROM compver cv1 INNER JOIN relate r1 ON (cv1.id = r1.to_cv) INNER JOIN relate r2 ON (r1.from_cv = r2.to_cv) INNER JOIN compver cv2 ON (r2.from_cv = cv2.id) LEFT JOIN attrib a1 ON (cv2.id = a1.is_attr_of) " + \
+            "WHERE cv1.name = ? AND cv1.version = ? AND cv1.cvtype = ? AND cv1.subsystem = ? AND " + \
+                 "r1.name = 'task_in_folder' AND " + \
+                 "r2.name = 'folder_in_rp' AND "+ \
+                 "a1.name = 'status_log'"
+        args = (self.delim(), fpn['name'], fpn['version'], fpn['type'], fpn['instance'])
         # find all dirty_task_in_baseline ?
 
         cursor = self._db_connection.cursor()
-        cursor.execute(sql_query)
+        cursor.execute(sql_query, args)
         return [dict(zip(names, row)) for row in cursor.fetchall()]
 
     def contents_dir(self, four_part_name):
@@ -172,21 +312,27 @@ WHERE  compver.name = ? AND
             raise CcmError('Object is not a directory')
 
         sql_query = \
-            ("SELECT bsite.info " + \
-             "FROM bsite " + \
-             "WHERE bsite.is_bsite_of = (" + \
-             "  SELECT compver.id " + \
-             "  FROM compver " + \
-             "  WHERE compver.name = '{name}' AND compver.version = '{version}' AND compver.cvtype = '{type}' AND compver.subsystem = '{instance}' " + \
-             ") AND bsite.info NOT LIKE '%/dir/%' " + \
-             "ORDER BY bsite.info").format(**fpn)
+            "SELECT bsite.info " + \
+            "FROM bsite " + \
+            "WHERE bsite.is_bsite_of = (" + \
+            "  SELECT compver.id " + \
+            "  FROM compver " + \
+            "  WHERE compver.name = ? AND compver.version = ? AND compver.cvtype = ? AND compver.subsystem = ? " + \
+            ") AND bsite.info NOT LIKE '%/dir/%' " + \
+            "ORDER BY bsite.info"
+        args = (fpn['name'], fpn['version'], fpn['type'], fpn['instance'])
 
         cursor = self._db_connection.cursor()
-        cursor.execute(sql_query)
+        cursor.execute(sql_query, args)
         return [row[0] for row in cursor.fetchall()]
 
-    def query_sql(self, sql_query, *args):
-        """ Execute a SQL query on table compver and return resulting compvers """
+    def query_sql(self, sql_query, *args, stream=False):
+        """
+        Execute a SQL query on table compver and return resulting compvers.
+        With stream, return an iterator over the rows instead of a list.
+        """
         cursor = self._db_connection.cursor()
         cursor.execute(sql_query, args)
+        if stream:
+            return self._iter_cursor(cursor)
         return cursor.fetchall()
@@ -0,0 +1,110 @@
+# -*- coding: utf-8 -*-
+
+import threading
+
+from collections import OrderedDict
+
+
+class LruCache:
+    """
+    Least recently used cache, safe for use from multiple threads.
+
+    Entries are weighed by weigher, which defaults to counting entries. The
+    least recently used entries are evicted once the total weight exceeds
+    capacity. Entries heavier than capacity are not stored at all.
+    on_evict, when given, is called with key and value of every entry dropped by the
+    cache: evicted, replaced by put, not stored for its weight or cleared. It is not
+    called for entries removed with pop.
+    """
+
+    def __init__(self, capacity, weigher=None, on_evict=None):
+        self._capacity = capacity
+        self._weigher = weigher or (lambda value: 1)
+        self._on_evict = on_evict
+        self._entries = OrderedDict()
+        self._weight = 0
+        self._lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @property
+    def capacity(self):
+        return self._capacity
+
+    @property
+    def weight(self):
+        return self._weight
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return default
+
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key, value):
+        weight = self._weigher(value)
+        dropped = []
+        with self._lock:
+            replaced = self._remove(key)
+            if replaced is not None and replaced[0] is not value:
+                dropped.append((key, replaced[0]))
+            if weight > self._capacity:
+                dropped.append((key, value))
+            else:
+                self._entries[key] = (value, weight)
+                self._weight += weight
+                while self._weight > self._capacity:
+                    evicted_key, (evicted_value, evicted_weight) = self._entries.popitem(last=False)
+                    self._weight -= evicted_weight
+                    self.evictions += 1
+                    dropped.append((evicted_key, evicted_value))
+        self._dropped(dropped)
+
+    def _dropped(self, entries):
+        """ Pass dropped entries to on_evict, outside of the lock """
+        if self._on_evict is not None:
+            for key, value in entries:
+                self._on_evict(key, value)
+
+    def pop(self, key, default=None):
+        with self._lock:
+            entry = self._remove(key)
+        return entry[0] if entry is not None else default
+
+    def _remove(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self._weight -= entry[1]
+        return entry
+
+    def clear(self):
+        with self._lock:
+            dropped = [(key, entry[0]) for key, entry in self._entries.items()]
+            self._entries.clear()
+            self._weight = 0
+        self._dropped(dropped)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'entries': len(self._entries),
+                'weight': self._weight,
+                'capacity': self._capacity,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+            }
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._entries
+
+    def __len__(self):
+        return len(self._entries)
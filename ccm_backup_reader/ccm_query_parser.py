@@ -1,47 +1,48 @@
 #!/usr/bin/env python2
 
+import re
 
 from parsimonious import Grammar
 from parsimonious import NodeVisitor
 
-from ccm_backup_reader import ccm_utils
+from ccm_backup_reader.ccm_lru_cache import LruCache
+from ccm_backup_reader.ccm_query_planner import COMPVER_COLUMNS
+from ccm_backup_reader.ccm_query_planner import And
+from ccm_backup_reader.ccm_query_planner import AttributeMatch
+from ccm_backup_reader.ccm_query_planner import FunctionCall
+from ccm_backup_reader.ccm_query_planner import Not
+from ccm_backup_reader.ccm_query_planner import Or
+from ccm_backup_reader.ccm_query_planner import QueryPlanner
 
 
 ccm_query_grammar = Grammar(
-"""
-    query = or_term
-    or_term = paren_l? and_term paren_r? _ (or _ paren_l? and_term paren_r?)*
-    and_term = paren_l? not_term paren_r? _ (and _ paren_l? not_term paren_r?)*
-    not_term = not? term
+r"""
+    query = _ or_expr
+    or_expr = and_expr (or and_expr)*
+    and_expr = not_expr (and not_expr)*
+    not_expr = not* primary
+    primary = paren_expr / term
+    paren_expr = paren_l or_expr paren_r
     paren_l = "(" _
     paren_r = ")" _
-    or = "or" _
-    and = "and" _
-    not = "not" _
+    or = ~"or\\b" _
+    and = ~"and\\b" _
+    not = ~"not\\b" _
 
     term = function_call / attribute_match
-    function_call = identifier "(" _ string _ ("," _ string _)* ")" _
-    attribute_match = identifier _ comparator _ atom _
-    comparator = "=" / "match"
+    function_call = identifier "(" _ string ("," _ string)* ")" _
+    attribute_match = identifier comparator _ atom
+    comparator = "=" / ~"match\\b"
 
     atom = identifier / string
     identifier = ~"[a-z_]+"i _
-    string = ~"'[^']*'"i _
-    _ = ' '*
+    string = ~"'(?:[^']|'')*'" _
+    _ = ~" *"
 """)
 
 
-ATTRIBUTE_TABLE = {
-    'cvid': 'cv.cvid',
-    'objectname': 'objectname',
-    'name': 'cv.name',
-    'version': 'cv.version',
-    'instance': 'cv.subsystem',
-    'type': 'cv.cvtype',
-    'owner': 'cv.owner',
-    'create_time': 'cv.create_time',
-    'status': 'ccm_status(attrib.textval)',
-}
+# string literals, a quote inside a literal is written as ''
+STRING_LITERAL_RE = re.compile(r"'((?:[^']|'')*)'")
 
 
 def descendants_with_expr_name(node, expr_name):
@@ -55,137 +56,132 @@ def descendants_with_expr_name(node, expr_name):
     return descendants
 
 
+def normalize_query(ccm_query):
+    """
+    Split a CCM query in its shape and its literals.
+    The shape is the query with every string literal replaced by a numbered placeholder,
+    queries differing only in their literals have the same shape.
+    """
+    literals = []
+
+    def replace_literal(match):
+        literals.append(match.group(1).replace("''", "'"))
+        return "'#{}'".format(len(literals) - 1)
+
+    shape = STRING_LITERAL_RE.sub(replace_literal, ccm_query)
+    shape = re.sub(' +', ' ', shape).strip()
+    return shape, literals
+
+
+class CompiledQuery:
+    """ SQL for a query shape, with the recipe to build its parameters from the literals """
+
+    def __init__(self, sql_query, param_getters):
+        self.sql_query = sql_query
+        self._param_getters = param_getters
+
+    def params(self, literals):
+        return [getter(literals) for getter in self._param_getters]
+
+
 class SqlQueryBuilder:
 
-    COMPVER_COLUMNS = [
-        'cvid',
-        'objectname',
-        'name',
-        'version',
-        'instance',
-        'type',
-        'owner',
-        'create_time',
-        'status',
-    ]
-
-    def __init__(self, delim):
+    COMPVER_COLUMNS = COMPVER_COLUMNS
+
+    def __init__(self, delim, cache_size=256):
         self._delim = delim
+        self._cache = LruCache(cache_size)
 
-    def build(self, ccm_query):
-        node = ccm_query_grammar.parse(ccm_query)
+    @property
+    def cache(self):
+        return self._cache
 
-        visitor = SqlQueryBuilderVisitor(self._delim)
-        visitor.visit(node)
+    def build(self, ccm_query, columns=None):
+        """
+        Build SQL query for a CCM query, returns the SQL query and its parameters.
+        Only the given columns are computed, the others are NULL.
+        """
+        columns = tuple(self.COMPVER_COLUMNS if columns is None else columns)
+        shape, literals = normalize_query(ccm_query)
+        compiled_query = self._cache.get((shape, columns))
+        if compiled_query is None:
+            compiled_query = self.compile(shape, columns)
+            self._cache.put((shape, columns), compiled_query)
 
-        return visitor.sql_query
+        return compiled_query.sql_query, compiled_query.params(literals)
 
+    def compile(self, shape, columns):
+        """ Compile a normalized query to a CompiledQuery """
+        predicate = self.parse(shape)
 
-class SqlQueryBuilderVisitor(NodeVisitor):
+        planner = QueryPlanner(self._delim)
+        plan = planner.plan(predicate, [column for column in self.COMPVER_COLUMNS if column in columns])
 
-    def __init__(self, delim):
-        self._delim = delim
-        self.sql_query = \
-            "SELECT cv.id AS cvid, cv.name || '" + delim + "' || cv.version || ':' || cv.cvtype || ':' || cv.subsystem AS objectname, cv.name, cv.version, cv.subsystem AS instance, cv.cvtype AS type, cv.owner, cv.create_time, ccm_status(attrib.textval) AS status " + \
-            "FROM compver cv LEFT JOIN attrib ON (cv.id = attrib.is_attr_of) " + \
-            "WHERE attrib.name = 'status_log' AND "
+        return CompiledQuery(plan.sql_query, plan.param_getters)
+
+    def parse(self, shape):
+        """ Parse a normalized query to a predicate tree """
+        node = ccm_query_grammar.parse(shape)
 
-    def visit_paren_l(self, node, visited_nodes):
-        self.sql_query += "("
-        return node
+        visitor = PredicateBuilderVisitor()
+        return visitor.visit(node)
 
-    def visit_paren_r(self, node, visited_nodes):
-        self.sql_query += ")"
-        return node
 
-    def visit_or(self, node, visited_nodes):
-        self.sql_query += " OR "
-        return node
+class PredicateBuilderVisitor(NodeVisitor):
+    """ Build a predicate tree from a parsed, normalized query """
 
-    def visit_and(self, node, visited_nodes):
-        self.sql_query += " AND "
-        return node
+    @staticmethod
+    def _literal_index(string_node):
+        """ Index of the literal a placeholder string node refers to """
+        return int(string_node.text.rstrip()[2:-1])
 
-    def visit_not(self, node, visited_nodes):
-        self.sql_query += " NOT "
-        return node
+    def visit_query(self, node, visited_nodes):
+        return visited_nodes[1]
+
+    def visit_or_expr(self, node, visited_nodes):
+        first, rest = visited_nodes
+        children = [first] + [predicate for _, predicate in rest]
+        return children[0] if len(children) == 1 else Or(children)
+
+    def visit_and_expr(self, node, visited_nodes):
+        first, rest = visited_nodes
+        children = [first] + [predicate for _, predicate in rest]
+        return children[0] if len(children) == 1 else And(children)
+
+    def visit_not_expr(self, node, visited_nodes):
+        nots, predicate = visited_nodes
+        for _ in nots:
+            predicate = Not(predicate)
+        return predicate
+
+    def visit_primary(self, node, visited_nodes):
+        return visited_nodes[0]
+
+    def visit_paren_expr(self, node, visited_nodes):
+        return visited_nodes[1]
+
+    def visit_term(self, node, visited_nodes):
+        return visited_nodes[0]
 
     def visit_attribute_match(self, node, visited_nodes):
         identifier = node.children[0].text.rstrip()
-        op = node.children[2].text.rstrip()
-        value = node.children[4].text.rstrip()
-
-        identifier = ATTRIBUTE_TABLE.get(identifier, identifier)
-        sql_op = 'like' if op == 'match' else op
-        value = value.repalce("*", "%") if op == 'match' else value
+        op = node.children[1].text
+        atom = node.children[3].children[0]
 
-        self.sql_query += "{} {} {}".format(identifier, sql_op, value)
+        if atom.expr_name == 'string':
+            index = self._literal_index(atom)
+            value_getter = lambda literals: literals[index]
+        else:
+            # bare word, treat as a literal
+            value = atom.text.rstrip()
+            value_getter = lambda literals: value
 
-        return node
+        return AttributeMatch(identifier, op, value_getter)
 
     def visit_function_call(self, node, visited_nodes):
         function = node.children[0].text.rstrip()
-        args = [n.text.rstrip()[1:-1] for n in descendants_with_expr_name(node, 'string')]
-
-        if function == 'is_successor_of':
-            fpn = ccm_utils.parse_fpn(args[0], self._delim)
-            self.sql_query += ("cv.id = (" + \
-                "SELECT relate.to_cv " + \
-                "FROM compver INNER JOIN relate ON (compver.id = relate.from_cv) " + \
-                "WHERE compver.name = '{name}' AND compver.version = '{version}' AND compver.cvtype = '{type}' AND compver.subsystem = '{instance}' AND " + \
-                      "relate.name = 'successor'" + \
-                ")").format(**fpn)
-        elif function == 'is_predecessor_of':
-            fpn = ccm_utils.parse_fpn(args[0], self._delim)
-            self.sql_query += ("cv.id = (" + \
-                "SELECT relate.from_cv " + \
-                "FROM compver INNER JOIN relate ON (compver.id = relate.to_cv) " + \
-                "WHERE compver.name = '{name}' AND compver.version = '{version}' AND compver.cvtype = '{type}' AND compver.subsystem = '{instance}' AND " + \
-                      "relate.name = 'successor'" + \
-                ")").format(**fpn)
-        elif function == 'is_child_of':
-            fpn = ccm_utils.parse_fpn(args[0], self._delim)
-            project_fpn = ccm_utils.parse_fpn(args[1], self._delim)
-            self.sql_query += ("cv.id IN (" + \
-                "SELECT bind.has_child " + \
-                "FROM bind INNER JOIN compver cv1 ON (bind.has_asm = cv1.id) INNER JOIN compver cv2 on (bind.has_parent = cv2.id) " + \
-                "WHERE cv1.name = '{0[name]}' AND cv1.version = '{0[version]}' AND cv1.cvtype = '{0[type]}' AND cv1.subsystem = '{0[instance]}' AND " + \
-                      "cv2.name = '{1[name]}' AND cv2.version = '{1[version]}' AND cv2.cvtype = '{1[type]}' AND cv2.subsystem = '{1[instance]}'" + \
-                ")").format(project_fpn, fpn)
-        elif function == 'is_member_of':
-            fpn = ccm_utils.parse_fpn(args[0], self._delim)
-            self.sql_query += ("cv.id IN (" + \
-                "SELECT cv2.id " + \
-                "FROM compver cv1 INNER JOIN bind ON (cv1.id = bind.has_asm) INNER JOIN compver cv2 ON (bind.has_child = cv2.id) " + \
-                "WHERE cv1.name = '{name}' AND cv1.version = '{version}' AND cv1.cvtype = '{type}' AND cv1.subsystem = '{instance}'" + \
-                ")").format(**fpn)
-        elif function == 'has_member':
-            fpn = ccm_utils.parse_fpn(args[0], self._delim)
-            self.sql_query += ("cv.id IN (" + \
-                "SELECT cv1.id " + \
-                "FROM bind INNER JOIN compver cv1 ON (bind.has_asm = cv1.id) INNER JOIN compver cv2 ON (bind.has_child = cv2.id) " + \
-                "WHERE cv2.name = '{name}' AND cv2.version = '{version}' AND cv2.cvtype = '{type}' AND cv2.subsystem = '{instance}'" + \
-                ")").format(**fpn)
-        elif function == 'is_baseline_project_of':
-            fpn = ccm_utils.parse_fpn(args[0], self._delim)
-            self.sql_query += ("cv.id = (" + \
-                "SELECT relate.to_cv " + \
-                "FROM compver INNER JOIN relate ON (compver.id = relate.from_cv) " + \
-                "WHERE compver.name = '{name}' AND compver.version = '{version}' AND compver.cvtype = '{type}' AND compver.subsystem = '{instance}' AND " + \
-                      "relate.name = 'baseline_project'" + \
-                ")").format(**fpn)
-        elif function == 'has_baseline_project':
-            fpn = ccm_utils.parse_fpn(args[0], self._delim)
-            self.sql_query += ("cv.id IN (" + \
-                "SELECT relate.from_cv " + \
-                "FROM relate INNER JOIN compver ON (relate.to_cv = compver.id) " + \
-                "WHERE compver.name = '{name}' AND compver.version = '{version}' AND compver.cvtype = '{type}' AND compver.subsystem = '{instance}' AND " + \
-                      "relate.name = 'baseline_project'"
-                ")").format(**fpn)
-        else:
-            raise NotImplementedError()
-
-        return node
+        args = [self._literal_index(n) for n in descendants_with_expr_name(node, 'string')]
+        return FunctionCall(function, args)
 
     def generic_visit(self, node, visited_nodes):
-        return node
+        return visited_nodes
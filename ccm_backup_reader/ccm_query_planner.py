@@ -0,0 +1,403 @@
+# -*- coding: utf-8 -*-
+
+from ccm_backup_reader import ccm_utils
+
+
+class And:
+
+    def __init__(self, children):
+        self.children = children
+
+    def __repr__(self):
+        return 'And({})'.format(self.children)
+
+
+class Or:
+
+    def __init__(self, children):
+        self.children = children
+
+    def __repr__(self):
+        return 'Or({})'.format(self.children)
+
+
+class Not:
+
+    def __init__(self, child):
+        self.child = child
+
+    def __repr__(self):
+        return 'Not({})'.format(self.child)
+
+
+class AttributeMatch:
+    """ attribute = value or attribute match value, value_getter gets the value from the literals """
+
+    def __init__(self, attribute, op, value_getter):
+        self.attribute = attribute
+        self.op = op
+        self.value_getter = value_getter
+
+    def __repr__(self):
+        return 'AttributeMatch({}, {})'.format(self.attribute, self.op)
+
+
+class FunctionCall:
+    """ function('...', ...), args are the indices of the literals passed """
+
+    def __init__(self, function, args):
+        self.function = function
+        self.args = args
+
+    def __repr__(self):
+        return 'FunctionCall({}, {})'.format(self.function, self.args)
+
+
+# columns of the query results
+COMPVER_COLUMNS = [
+    'cvid',
+    'objectname',
+    'name',
+    'version',
+    'instance',
+    'type',
+    'owner',
+    'create_time',
+    'status',
+]
+
+# attributes stored as compver columns
+ATTRIBUTE_TABLE = {
+    'cvid': 'cv.id',
+    'name': 'cv.name',
+    'version': 'cv.version',
+    'instance': 'cv.subsystem',
+    'subsystem': 'cv.subsystem',
+    'type': 'cv.cvtype',
+    'cvtype': 'cv.cvtype',
+    'owner': 'cv.owner',
+    'create_time': 'cv.create_time',
+    'modify_time': 'cv.modify_time',
+}
+
+# objectname is built from compver columns and the delimiter
+OBJECTNAME_EXPRESSION = "cv.name || ? || cv.version || ':' || cv.cvtype || ':' || cv.subsystem"
+
+# attributes which need a join, attribute: (join, expression)
+# the joins are outer joins: objects without the attribute, e.g. without a status_log, are returned with NULL
+JOINED_ATTRIBUTE_TABLE = {
+    'status': (
+        "LEFT JOIN attrib st ON (st.is_attr_of = cv.id AND st.name = 'status_log')",
+        "ccm_status(st.textval)"),
+    'release': (
+        "LEFT JOIN release rel ON (rel.id = cv.is_product)",
+        "rel.name"),
+}
+
+# any other attribute is looked up in the attrib table
+ATTRIB_JOIN = "LEFT JOIN attrib {0} ON ({0}.is_attr_of = cv.id AND {0}.name = ?)"
+ATTRIB_EXPRESSION = "{0}.textval"
+
+# WHERE clause matching a four part name on a compver alias, in FPN_PARAM_KEYS order
+FPN_CONDITION = "{0}.name = ? AND {0}.version = ? AND {0}.cvtype = ? AND {0}.subsystem = ?"
+FPN_PARAM_KEYS = ['name', 'version', 'type', 'instance']
+
+# Functions, function: (subquery selecting the matching ids as id,
+#                       [(compver alias to match argument on, argument index), ...] in order of use in the subquery)
+FUNCTION_TABLE = {
+    'is_successor_of': (
+        "SELECT relate.to_cv AS id " + \
+        "FROM compver INNER JOIN relate ON (compver.id = relate.from_cv) " + \
+        "WHERE {0} AND relate.name = 'successor'",
+        [('compver', 0)]),
+    'is_predecessor_of': (
+        "SELECT relate.from_cv AS id " + \
+        "FROM compver INNER JOIN relate ON (compver.id = relate.to_cv) " + \
+        "WHERE {0} AND relate.name = 'successor'",
+        [('compver', 0)]),
+    'is_baseline_project_of': (
+        "SELECT relate.to_cv AS id " + \
+        "FROM compver INNER JOIN relate ON (compver.id = relate.from_cv) " + \
+        "WHERE {0} AND relate.name = 'baseline_project'",
+        [('compver', 0)]),
+    'has_baseline_project': (
+        "SELECT relate.from_cv AS id " + \
+        "FROM relate INNER JOIN compver ON (relate.to_cv = compver.id) " + \
+        "WHERE {0} AND relate.name = 'baseline_project'",
+        [('compver', 0)]),
+    'is_child_of': (
+        "SELECT bind.has_child AS id " + \
+        "FROM bind INNER JOIN compver cv1 ON (bind.has_asm = cv1.id) INNER JOIN compver cv2 ON (bind.has_parent = cv2.id) " + \
+        "WHERE {0} AND {1}",
+        [('cv1', 1), ('cv2', 0)]),
+    'is_member_of': (
+        "SELECT bind.has_child AS id " + \
+        "FROM compver cv1 INNER JOIN bind ON (cv1.id = bind.has_asm) " + \
+        "WHERE {0}",
+        [('cv1', 0)]),
+    'has_member': (
+        "SELECT bind.has_asm AS id " + \
+        "FROM bind INNER JOIN compver cv2 ON (bind.has_child = cv2.id) " + \
+        "WHERE {0}",
+        [('cv2', 0)]),
+    'is_hist_successor_of': (
+        "WITH RECURSIVE hist(id) AS (" + \
+            "SELECT relate.to_cv " + \
+            "FROM compver INNER JOIN relate ON (compver.id = relate.from_cv) " + \
+            "WHERE {0} AND relate.name = 'successor' " + \
+            "UNION " + \
+            "SELECT relate.to_cv " + \
+            "FROM hist INNER JOIN relate ON (hist.id = relate.from_cv) " + \
+            "WHERE relate.name = 'successor'" + \
+        ") SELECT id FROM hist",
+        [('compver', 0)]),
+    'is_hist_predecessor_of': (
+        "WITH RECURSIVE hist(id) AS (" + \
+            "SELECT relate.from_cv " + \
+            "FROM compver INNER JOIN relate ON (compver.id = relate.to_cv) " + \
+            "WHERE {0} AND relate.name = 'successor' " + \
+            "UNION " + \
+            "SELECT relate.from_cv " + \
+            "FROM hist INNER JOIN relate ON (hist.id = relate.to_cv) " + \
+            "WHERE relate.name = 'successor'" + \
+        ") SELECT id FROM hist",
+        [('compver', 0)]),
+    'is_recursive_member_of': (
+        "WITH RECURSIVE members(id) AS (" + \
+            "SELECT bind.has_child " + \
+            "FROM compver cv1 INNER JOIN bind ON (cv1.id = bind.has_asm) " + \
+            "WHERE {0} " + \
+            "UNION " + \
+            "SELECT bind.has_child " + \
+            "FROM members INNER JOIN compver sub ON (members.id = sub.id) INNER JOIN bind ON (sub.id = bind.has_asm) " + \
+            "WHERE sub.cvtype = 'project'" + \
+        ") SELECT id FROM members",
+        [('cv1', 0)]),
+}
+
+# Ranks of predicates, lower is more selective and is evaluated first
+RANK_SELECTIVE = 0
+RANK_COLUMN = 1
+RANK_MATCH = 2
+RANK_ATTRIB = 3
+RANK_STATUS = 4
+
+SELECTIVE_ATTRIBUTES = {'cvid', 'objectname', 'name', 'instance', 'subsystem', 'type', 'cvtype'}
+
+
+class SqlWriter:
+    """ Collects SQL text and the getters of the parameters, in order of appearance """
+
+    def __init__(self):
+        self._parts = []
+        self.param_getters = []
+
+    def write(self, sql, *param_getters):
+        self._parts.append(sql)
+        self.param_getters.extend(param_getters)
+
+    @property
+    def sql(self):
+        return ''.join(self._parts)
+
+
+class QueryPlan:
+    """
+    Logical plan of a query: the columns to compute, the joins needed and the
+    ordered predicate. Rendered to SQL by QueryPlanner.
+    """
+
+    def __init__(self, columns, predicate, driving_function, joined_attributes):
+        self.columns = columns
+        self.predicate = predicate
+        self.driving_function = driving_function
+        self.joined_attributes = joined_attributes
+        self.sql_query = None
+        self.param_getters = None
+
+
+class QueryPlanner:
+    """
+    Turns a predicate tree into a QueryPlan and renders it to SQL.
+
+    - Only the attributes referenced by the predicate or the columns are joined.
+    - Conjunctions are ordered by selectivity, see rank().
+    - A function which is among the most selective conjuncts of the query
+      drives the query as a join, instead of being tested with IN for every
+      compver.
+    """
+
+    def __init__(self, delim):
+        self._delim = delim
+
+    def plan(self, predicate, columns):
+        predicate = self._order(predicate)
+
+        # drive the query from the first function, if it is among the most selective conjuncts
+        driving_function = None
+        conjuncts = predicate.children if isinstance(predicate, And) else [predicate]
+        for conjunct in conjuncts:
+            if self.rank(conjunct) != RANK_SELECTIVE:
+                break
+            if isinstance(conjunct, FunctionCall):
+                driving_function = conjunct
+                break
+        if driving_function:
+            conjuncts = [conjunct for conjunct in conjuncts if conjunct is not driving_function]
+            if not conjuncts:
+                predicate = None
+            elif len(conjuncts) == 1:
+                predicate = conjuncts[0]
+            else:
+                predicate = And(conjuncts)
+
+        attributes = set(columns)
+        if predicate is not None:
+            self._referenced_attributes(predicate, attributes)
+        joined_attributes = sorted(attribute for attribute in attributes
+                                   if attribute not in ATTRIBUTE_TABLE and attribute != 'objectname')
+
+        plan = QueryPlan(columns, predicate, driving_function, joined_attributes)
+        self._render(plan)
+        return plan
+
+    def rank(self, predicate):
+        if isinstance(predicate, AttributeMatch):
+            if predicate.attribute == 'status':
+                return RANK_STATUS
+            if predicate.attribute not in ATTRIBUTE_TABLE and predicate.attribute != 'objectname':
+                return RANK_ATTRIB
+            if predicate.op == 'match':
+                return RANK_MATCH
+            if predicate.attribute in SELECTIVE_ATTRIBUTES:
+                return RANK_SELECTIVE
+            return RANK_COLUMN
+        if isinstance(predicate, FunctionCall):
+            # arguments are four part names, the resulting set is small
+            return RANK_SELECTIVE
+        if isinstance(predicate, And):
+            return min(self.rank(child) for child in predicate.children)
+        if isinstance(predicate, Or):
+            return max(self.rank(child) for child in predicate.children)
+        if isinstance(predicate, Not):
+            return max(self.rank(predicate.child), RANK_MATCH)
+
+    def _order(self, predicate):
+        """ Order conjunctions by rank, flattening nested conjunctions """
+        if isinstance(predicate, And):
+            children = []
+            for child in predicate.children:
+                child = self._order(child)
+                if isinstance(child, And):
+                    children += child.children
+                else:
+                    children.append(child)
+            return And(sorted(children, key=self.rank))
+        if isinstance(predicate, Or):
+            return Or([self._order(child) for child in predicate.children])
+        if isinstance(predicate, Not):
+            return Not(self._order(predicate.child))
+        if isinstance(predicate, FunctionCall) and predicate.function not in FUNCTION_TABLE:
+            raise NotImplementedError("Unknown function: " + predicate.function)
+        return predicate
+
+    def _referenced_attributes(self, predicate, attributes):
+        if isinstance(predicate, AttributeMatch):
+            attributes.add(predicate.attribute)
+        elif isinstance(predicate, (And, Or)):
+            for child in predicate.children:
+                self._referenced_attributes(child, attributes)
+        elif isinstance(predicate, Not):
+            self._referenced_attributes(predicate.child, attributes)
+
+    def _attribute_expression(self, plan, attribute):
+        """ SQL expression and its parameter getters for an attribute """
+        if attribute == 'objectname':
+            delim = self._delim
+            return OBJECTNAME_EXPRESSION, [lambda literals: delim]
+        if attribute in ATTRIBUTE_TABLE:
+            return ATTRIBUTE_TABLE[attribute], []
+        if attribute in JOINED_ATTRIBUTE_TABLE:
+            return JOINED_ATTRIBUTE_TABLE[attribute][1], []
+        alias = 'a{}'.format(plan.joined_attributes.index(attribute))
+        return ATTRIB_EXPRESSION.format(alias), []
+
+    def _render(self, plan):
+        writer = SqlWriter()
+
+        # columns
+        writer.write("SELECT ")
+        for idx, column in enumerate(COMPVER_COLUMNS):
+            if idx:
+                writer.write(", ")
+            if column not in plan.columns:
+                writer.write("NULL AS " + column)
+                continue
+            expression, param_getters = self._attribute_expression(plan, column)
+            writer.write(expression + " AS " + column, *param_getters)
+
+        # driving function and joins
+        if plan.driving_function:
+            writer.write(" FROM (SELECT DISTINCT id FROM (")
+            self._write_function_subquery(writer, plan.driving_function)
+            writer.write(")) d INNER JOIN compver cv ON (cv.id = d.id)")
+        else:
+            writer.write(" FROM compver cv")
+
+        for attribute in plan.joined_attributes:
+            if attribute in JOINED_ATTRIBUTE_TABLE:
+                writer.write(" " + JOINED_ATTRIBUTE_TABLE[attribute][0])
+            else:
+                alias = 'a{}'.format(plan.joined_attributes.index(attribute))
+                writer.write(" " + ATTRIB_JOIN.format(alias), lambda literals, attribute=attribute: attribute)
+
+        # predicate
+        if plan.predicate is not None:
+            writer.write(" WHERE ")
+            self._write_predicate(writer, plan, plan.predicate)
+
+        plan.sql_query = writer.sql
+        plan.param_getters = writer.param_getters
+
+    def _write_predicate(self, writer, plan, predicate):
+        if isinstance(predicate, (And, Or)):
+            operator = " AND " if isinstance(predicate, And) else " OR "
+            for idx, child in enumerate(predicate.children):
+                if idx:
+                    writer.write(operator)
+                self._write_nested_predicate(writer, plan, child)
+        elif isinstance(predicate, Not):
+            writer.write("NOT ")
+            self._write_nested_predicate(writer, plan, predicate.child)
+        elif isinstance(predicate, AttributeMatch):
+            expression, param_getters = self._attribute_expression(plan, predicate.attribute)
+            if predicate.op == 'match':
+                value_getter = predicate.value_getter
+                writer.write(expression + " LIKE ?", *param_getters, lambda literals: value_getter(literals).replace('*', '%'))
+            else:
+                writer.write(expression + " = ?", *param_getters, predicate.value_getter)
+        elif isinstance(predicate, FunctionCall):
+            writer.write("cv.id IN (")
+            self._write_function_subquery(writer, predicate)
+            writer.write(")")
+
+    def _write_nested_predicate(self, writer, plan, predicate):
+        if isinstance(predicate, (And, Or)):
+            writer.write("(")
+            self._write_predicate(writer, plan, predicate)
+            writer.write(")")
+        else:
+            self._write_predicate(writer, plan, predicate)
+
+    def _write_function_subquery(self, writer, function_call):
+        subquery, fpn_args = FUNCTION_TABLE[function_call.function]
+        conditions = [FPN_CONDITION.format(alias) for alias, _ in fpn_args]
+        param_getters = []
+        for _, arg in fpn_args:
+            param_getters += self._fpn_param_getters(function_call.args[arg])
+        writer.write(subquery.format(*conditions), *param_getters)
+
+    def _fpn_param_getters(self, index):
+        delim = self._delim
+        return [lambda literals, key=key: ccm_utils.parse_fpn(literals[index], delim)[key]
+                for key in FPN_PARAM_KEYS]
@@ -0,0 +1,470 @@
+# -*- coding: utf-8 -*-
+
+"""
+Versions stored in RCS files (ccm_rcs sources).
+
+An RCS file holds the head revision of the trunk in full. Each older trunk revision is stored as a reverse diff
+against its successor, and each branch revision as a forward diff against its predecessor, the first one against the
+trunk revision it branches from. Diffs are in 'diff -n' form: 'a<line> <count>' followed by count lines to add after
+line, and 'd<line> <count>' to delete count lines starting at line, line numbers counted in the source text.
+
+Revisions are reconstructed in memory, and RCS keywords are expanded the way 'rcs co -p' does for the expansion
+mode of the file. Reading revisions with 'rcs co' is only done on request.
+"""
+
+import os
+import re
+import subprocess
+from collections import namedtuple
+
+from ccm_backup_reader.ccm_error import CcmError
+from ccm_backup_reader.ccm_lru_cache import LruCache
+
+
+class RcsError(CcmError):
+    pass
+
+
+# Delta of the revision tree, branches are the first revisions of the branches starting at this revision
+RcsDelta = namedtuple('RcsDelta', ['rev', 'date', 'author', 'state', 'branches', 'next'])
+
+# Keywords expanded by 'rcs co' unless the expansion mode is b (binary) or o (old value)
+KEYWORD_RE = re.compile(rb'\$(Author|Date|Header|Id|Locker|Log|Name|RCSfile|Revision|Source|State)(:[^$\n]*)?\$')
+UNEXPANDED_MODES = (b'b', b'o')
+DEFAULT_EXPAND_MODE = b'kv'
+
+DIFF_COMMAND_RE = re.compile(rb'([ad])(\d+) (\d+)')
+
+_TOKEN_RE = re.compile(rb'\s*(?:(@)|([;:])|([^\s;:@]+))')
+
+# Byte budget of the parsed RCS files kept by open_rcs_file
+RCS_FILE_CACHE_SIZE = 64 * 1024 * 1024
+
+RCS_FILE_CACHE = LruCache(RCS_FILE_CACHE_SIZE, weigher=lambda entry: entry[1].size)
+
+
+def split_lines(text):
+    """ Lines of text including their line feed, the last line may lack it """
+    lines = text.split(b'\n')
+    last = lines.pop()
+    lines = [line + b'\n' for line in lines]
+    if last:
+        lines.append(last)
+    return lines
+
+
+def apply_diff(lines, diff):
+    """ Apply an RCS diff to lines, returns the new lines """
+    diff_lines = split_lines(diff)
+    result = []
+    pos = 0
+    idx = 0
+    while idx < len(diff_lines):
+        match = DIFF_COMMAND_RE.match(diff_lines[idx])
+        if match is None:
+            raise RcsError("Invalid diff command: {!r}".format(diff_lines[idx]))
+        idx += 1
+        op, line, count = match.group(1), int(match.group(2)), int(match.group(3))
+
+        if op == b'd':
+            start = line - 1
+            if start < pos or start + count > len(lines):
+                raise RcsError("Invalid delete in diff: {!r}".format(match.group(0)))
+            result.extend(lines[pos:start])
+            pos = start + count
+        else:
+            if line < pos or line > len(lines) or idx + count > len(diff_lines):
+                raise RcsError("Invalid add in diff: {!r}".format(match.group(0)))
+            result.extend(lines[pos:line])
+            pos = line
+            result.extend(diff_lines[idx:idx + count])
+            idx += count
+
+    result.extend(lines[pos:])
+    return result
+
+
+def _keyword_date(date):
+    """ Date of a delta, 'YY.MM.DD.hh.mm.ss' with 2 digit years before 2000, as expanded: 'YYYY/MM/DD hh:mm:ss' """
+    fields = date.split('.')
+    if len(fields[0]) == 2:
+        fields[0] = '19' + fields[0]
+    return '{}/{}/{} {}:{}:{}'.format(*fields)
+
+
+def _branch_of(rev):
+    """ Branch number of a revision, '1.2.1' for '1.2.1.3' and '' for trunk revisions """
+    return rev.rsplit('.', 1)[0] if rev.count('.') > 1 else ''
+
+
+class _RcsLexer:
+
+    def __init__(self, data):
+        self._data = data
+        self._pos = 0
+        self._peeked = None
+
+    def peek(self):
+        if self._peeked is None:
+            self._peeked = self._read()
+        return self._peeked
+
+    def next(self):
+        token = self.peek()
+        self._peeked = None
+        return token
+
+    def _read(self):
+        """ Next token as (kind, value), kind is 'string', 'special', 'word' or None at the end """
+        match = _TOKEN_RE.match(self._data, self._pos)
+        if match is None:
+            if self._data[self._pos:].strip():
+                raise RcsError("Invalid RCS file at offset {}".format(self._pos))
+            return None, None
+        self._pos = match.end()
+        if match.group(1):
+            return 'string', self._read_string()
+        if match.group(2):
+            return 'special', match.group(2)
+        return 'word', match.group(3)
+
+    def _read_string(self):
+        """ String after its opening @, a doubled @ stands for a single one """
+        data = self._data
+        start = pos = self._pos
+        while True:
+            pos = data.find(b'@', pos)
+            if pos < 0:
+                raise RcsError("Unterminated string at offset {}".format(start))
+            if data[pos + 1:pos + 2] != b'@':
+                break
+            pos += 2
+        self._pos = pos + 1
+        return data[start:pos].replace(b'@@', b'@')
+
+    def expect(self, kind, value=None):
+        token_kind, token_value = self.next()
+        if token_kind != kind or (value is not None and token_value != value):
+            raise RcsError("Expected {} {!r}, found {} {!r}".format(kind, value, token_kind, token_value))
+        return token_value
+
+    def phrase(self):
+        """ Values of a phrase up to its ';', after its keyword """
+        values = []
+        while True:
+            kind, value = self.next()
+            if kind is None:
+                raise RcsError("Unterminated phrase")
+            if kind == 'special' and value == b';':
+                return values
+            if kind != 'special':
+                values.append(value)
+
+
+class RcsFile:
+    """ Parsed RCS file: the revision tree and the deltatexts """
+
+    def __init__(self, data):
+        self.size = len(data)
+        self.head = None
+        self.expand = None
+        self.deltas = {}
+        self._logs = {}
+        self._texts = {}
+        self._parse(_RcsLexer(data))
+
+    @classmethod
+    def from_path(cls, path):
+        with open(path, 'rb') as fd:
+            return cls(fd.read())
+
+    def _parse(self, lexer):
+        # admin phrases, up to the first revision number
+        while True:
+            kind, value = lexer.peek()
+            if kind != 'word' or value[:1].isdigit():
+                break
+            lexer.next()
+            values = lexer.phrase()
+            if value == b'head':
+                self.head = values[0].decode() if values else None
+            elif value == b'expand':
+                self.expand = values[0] if values else None
+
+        # revision tree, up to desc
+        while True:
+            kind, value = lexer.peek()
+            if kind != 'word' or value == b'desc':
+                break
+            self._parse_delta(lexer)
+        lexer.expect('word', b'desc')
+        lexer.expect('string')
+
+        # deltatexts
+        while lexer.peek()[0] is not None:
+            rev = lexer.expect('word').decode()
+            lexer.expect('word', b'log')
+            self._logs[rev] = lexer.expect('string')
+            while True:
+                keyword = lexer.expect('word')
+                if keyword == b'text':
+                    self._texts[rev] = lexer.expect('string')
+                    break
+                lexer.phrase()
+
+    def _parse_delta(self, lexer):
+        rev = lexer.expect('word').decode()
+        phrases = {}
+        while True:
+            kind, value = lexer.peek()
+            if kind != 'word' or value[:1].isdigit() or value == b'desc':
+                break
+            lexer.next()
+            phrases[value] = lexer.phrase()
+
+        def single(keyword):
+            values = phrases.get(keyword)
+            return values[0].decode() if values else None
+
+        self.deltas[rev] = RcsDelta(
+            rev,
+            single(b'date'),
+            single(b'author'),
+            single(b'state'),
+            [branch.decode() for branch in phrases.get(b'branches', [])],
+            single(b'next'))
+
+    @property
+    def revisions(self):
+        return list(self.deltas.keys())
+
+    def _text(self, rev):
+        text = self._texts.get(rev)
+        if text is None:
+            raise RcsError("No text for revision: " + rev)
+        return text
+
+    def _delta(self, rev):
+        delta = self.deltas.get(rev)
+        if delta is None:
+            raise RcsError("Revision not found: " + rev)
+        return delta
+
+    def revision(self, rev):
+        """ Contents of a revision as bytes, without keyword expansion """
+        return b''.join(self._revision_lines(rev))
+
+    def _revision_lines(self, rev):
+        self._delta(rev)
+        branch = _branch_of(rev)
+        if not branch:
+            # down the trunk from the head, applying reverse diffs
+            current = self.head
+            lines = split_lines(self._text(current))
+            while current != rev:
+                current = self._delta(current).next
+                if current is None or _branch_of(current):
+                    raise RcsError("Revision not on trunk: " + rev)
+                lines = apply_diff(lines, self._text(current))
+            return lines
+
+        # up the branch from the revision it starts at, applying forward diffs
+        branch_point = branch.rsplit('.', 1)[0]
+        lines = self._revision_lines(branch_point)
+        current = next((start for start in self._delta(branch_point).branches if _branch_of(start) == branch), None)
+        while current is not None:
+            lines = apply_diff(lines, self._text(current))
+            if current == rev:
+                return lines
+            current = self._delta(current).next
+        raise RcsError("Revision not found on branch: " + rev)
+
+    def iter_revisions(self):
+        """
+        Yield (rev, data) for every revision, walking the trunk from the head once and each branch once from
+        the revision it starts at. Revisions are not expanded.
+        """
+        if self.head is None:
+            return
+
+        # (first revision of a line of development, lines its diff applies to or None for the head)
+        work = [(self.head, None)]
+        while work:
+            current, lines = work.pop()
+            while current is not None:
+                text = self._text(current)
+                lines = split_lines(text) if lines is None else apply_diff(lines, text)
+                yield current, b''.join(lines)
+                for start in reversed(self._delta(current).branches):
+                    work.append((start, lines))
+                current = self._delta(current).next
+
+    def needs_expansion(self, data):
+        """ Whether 'rcs co' would expand keywords in this revision """
+        return self.expand not in UNEXPANDED_MODES and KEYWORD_RE.search(data) is not None
+
+    def expand_keywords(self, data, rev, path):
+        """
+        Expand the keywords in data, revision rev of the RCS file at path, as 'rcs co -p' does.
+        Revisions are checked out without locks, so Locker and Name are empty.
+        After a $Log$ line the log message of the revision is inserted, each line prefixed with the text before
+        $Log$ on that line.
+        """
+        mode = self.expand or DEFAULT_EXPAND_MODE
+        if mode in UNEXPANDED_MODES or KEYWORD_RE.search(data) is None:
+            return data
+
+        delta = self._delta(rev)
+        date = _keyword_date(delta.date)
+        filename = os.path.basename(path)
+        values = {
+            b'Author': delta.author,
+            b'Date': date,
+            b'Header': ' '.join([path, rev, date, delta.author, delta.state]),
+            b'Id': ' '.join([filename, rev, date, delta.author, delta.state]),
+            b'Locker': '',
+            b'Log': filename,
+            b'Name': '',
+            b'RCSfile': filename,
+            b'Revision': rev,
+            b'Source': path,
+            b'State': delta.state,
+        }
+
+        parts = []
+        pos = 0
+        # end of the line after which the log is inserted, and the log lines
+        log_end, log_lines = None, None
+        for match in KEYWORD_RE.finditer(data):
+            if log_end is not None and match.start() > log_end:
+                parts += [data[pos:log_end]] + log_lines
+                pos, log_end = log_end, None
+
+            keyword = match.group(1)
+            value = values[keyword].encode()
+            parts.append(data[pos:match.start()])
+            if mode == b'k':
+                parts.append(b'$' + keyword + b'$')
+            elif mode == b'v':
+                parts.append(value)
+            else:
+                parts.append(b'$' + keyword + b': ' + value + b' $')
+            pos = match.end()
+
+            if keyword == b'Log' and log_end is None:
+                line_start = data.rfind(b'\n', 0, match.start()) + 1
+                log_end = data.find(b'\n', match.end()) + 1 or len(data)
+                log_lines = self._log_lines(delta, date, data[line_start:match.start()])
+                if not data.endswith(b'\n') and log_end == len(data):
+                    log_lines.insert(0, b'\n')
+
+        if log_end is not None:
+            parts += [data[pos:log_end]] + log_lines
+            pos = log_end
+        parts.append(data[pos:])
+        return b''.join(parts)
+
+    def _log_lines(self, delta, date, prefix):
+        """ Lines inserted after a $Log$ line: a revision header, the log message and an empty comment line """
+        lines = [prefix + 'Revision {}  {}  {}\n'.format(delta.rev, date, delta.author).encode()]
+        for line in split_lines(self._logs.get(delta.rev, b'')):
+            if not line.endswith(b'\n'):
+                line += b'\n'
+            lines.append((prefix.rstrip() if line == b'\n' else prefix) + line)
+        lines.append(prefix.rstrip() + b'\n')
+        return lines
+
+
+def open_rcs_file(path):
+    """ Parsed RCS file, shared through RCS_FILE_CACHE while its modification time is unchanged """
+    path = os.path.abspath(path)
+    mtime = _mtime(path)
+
+    cached = RCS_FILE_CACHE.get(path)
+    if cached is not None and cached[0] == mtime:
+        return cached[1]
+
+    rcs_file = RcsFile.from_path(path)
+    RCS_FILE_CACHE.put(path, (mtime, rcs_file))
+    return rcs_file
+
+
+def _mtime(path):
+    try:
+        return os.stat(path).st_mtime_ns
+    except FileNotFoundError:
+        raise RcsError("File not found: " + path)
+
+
+def checkout(path, revision, blob_cache=None, rcs_co=False):
+    """
+    Contents of a revision of an RCS file, as bytes, as 'rcs co' returns them.
+    With a CcmBlobCache, the revision is read from it when cached and added to it otherwise.
+    """
+    return checkout_many(path, [revision], blob_cache=blob_cache, rcs_co=rcs_co)[revision]
+
+
+def checkout_many(path, revisions, walk_ratio=0.25, blob_cache=None, rcs_co=False):
+    """
+    Contents of revisions of an RCS file, as {revision: data}.
+    Above walk_ratio of the revisions in the file, all revisions are reconstructed in a single walk.
+    Revisions in the blob cache are not reconstructed.
+    With rcs_co, revisions with keywords to expand are read with 'rcs co' instead of being expanded in-process.
+    """
+    path = os.path.abspath(path)
+    found = {}
+    wanted = set(revisions)
+    if blob_cache is not None:
+        mtime = _mtime(path)
+        for revision in wanted.intersection(blob_cache.versions(path, mtime)):
+            data = blob_cache.get(path, revision, mtime)
+            if data is not None:
+                found[revision] = data
+        wanted.difference_update(found)
+        if not wanted:
+            return found
+
+    found.update(_checkout_many(path, wanted, walk_ratio, rcs_co))
+    if blob_cache is not None:
+        for revision in wanted:
+            blob_cache.put(path, revision, mtime, found[revision])
+    return found
+
+
+def _checkout_many(path, wanted, walk_ratio, rcs_co):
+    rcs_file = open_rcs_file(path)
+    missing = wanted.difference(rcs_file.deltas)
+    if missing:
+        raise RcsError("Revisions not found in {}: {}".format(path, ', '.join(sorted(missing))))
+
+    if len(wanted) <= len(rcs_file.deltas) * walk_ratio:
+        found = {revision: rcs_file.revision(revision) for revision in wanted}
+    else:
+        found = {}
+        for revision, data in rcs_file.iter_revisions():
+            if revision in wanted:
+                found[revision] = data
+                if len(found) == len(wanted):
+                    break
+
+    for revision, data in found.items():
+        if not rcs_file.needs_expansion(data):
+            continue
+        if rcs_co:
+            found[revision] = rcs_checkout(path, revision)
+        else:
+            found[revision] = rcs_file.expand_keywords(data, revision, path)
+    return found
+
+
+def rcs_checkout(path, revision):
+    """ Contents of a revision of an RCS file, as bytes, read with 'rcs co' """
+    cmd = ['rcs', 'co', '-q', '-p' + revision, path]
+    try:
+        sp = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    except OSError as e:
+        raise RcsError("Error calling: {}: {}".format(' '.join(cmd), e))
+    out, err = sp.communicate()
+    if sp.returncode != 0:
+        raise RcsError("Error calling: {}: {}".format(' '.join(cmd), err.decode(errors='replace').strip()))
+    return out
@@ -20,6 +20,23 @@ def parse_full_name(full_name):
     }
 
 
+STATUS_LOG_LINE_RE = re.compile(r"^(.*): Status set to '(\w+)' by (\S+)")
+
+STATUS_LOG_TIME_FORMAT = "%a %b %d %H:%M:%S %Y"
+
+
+def parse_status_log(status_log):
+    """ Parse a status_log attribute to a list of (time, status, user) tuples, in log order """
+    entries = []
+    for line in status_log.split('\n'):
+        m = STATUS_LOG_LINE_RE.match(line)
+        if not m:
+            continue
+        time = datetime.strptime(m.group(1), STATUS_LOG_TIME_FORMAT)
+        entries.append((time, m.group(2), m.group(3)))
+    return entries
+
+
 UNESCAPE_TEXT_OL_TABLE = {
     r"'(.)": lambda m: chr(ord(m.group(1)) - 0x20),
     r'`(.)`(.)': lambda m: bytes([ord(m.group(1)) + 0x80, ord(m.group(2)) + 0x80]).decode('utf-8'),
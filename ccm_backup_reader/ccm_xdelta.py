@@ -0,0 +1,358 @@
+# -*- coding: utf-8 -*-
+
+"""
+XDelta patches as stored in ccm_delta archives.
+
+A patch is a sequence of instructions. The first byte of an instruction holds the copy flag (bit 7),
+a continuation flag (bit 6) and the low 6 bits of the length, further length bytes hold 7 bits each.
+A copy instruction is followed by the offset in the source, 7 bits per byte with a continuation flag
+and a full 9th byte. An insert instruction is followed by the data to insert.
+"""
+
+from bisect import bisect_right
+from io import BytesIO
+from itertools import accumulate
+
+from ccm_backup_reader.ccm_error import CcmError
+
+
+class XDeltaError(CcmError):
+    pass
+
+
+class XDeltaApplier:
+    """ Stream based applier, reads the patch byte by byte from file objects """
+
+    @staticmethod
+    def apply(source_fd, target_fd, patch_fd):
+        while True:
+            cmd = patch_fd.read(1)
+            if len(cmd) == 0:
+                return
+            cmd = cmd[0]
+
+            copy_from_source = (cmd & 128) != 0
+            length = XDeltaApplier._read_a(cmd, patch_fd);
+            if copy_from_source:
+                offset = XDeltaApplier._read_b(patch_fd)
+                while length != 0:
+                    # copy from source to target
+                    source_fd.seek(offset)
+                    b = source_fd.read(length)
+                    target_fd.write(b)
+
+                    length -= len(b)
+                    offset += len(b)
+            else:
+                while length != 0:
+                    b = patch_fd.read(length)
+                    target_fd.write(b)
+                    length -= len(b)
+
+    @staticmethod
+    def _read_a(start, fd):
+        number = 0
+        bit_count = 0
+
+        while True:
+            if bit_count > 62:
+                raise Exception("Invalid state")
+
+            if bit_count == 0:
+                number = start & 63
+                if (start & 64) == 0:
+                    break
+
+                bit_count = 6
+            else:
+                read = fd.read(1)[0]
+                number |= (read & 127) << bit_count
+                if (read & 128) == 0:
+                    break
+
+                bit_count += 7
+
+        return number
+
+    @staticmethod
+    def _read_b(fd):
+        """ read a long """
+        number = 0
+        bit_count = 0
+
+        while True:
+            read = fd.read(1)[0]
+
+            if bit_count == 56:
+                number |= (read << 56)
+                break
+
+            number |= (read & 127) << bit_count
+            if (read & 128) == 0:
+                break
+
+            bit_count += 7
+
+        return number
+
+
+def decode_instructions(patch):
+    """
+    Decode the instructions of a patch.
+    Yields (copy, length, offset) tuples, offset is in the source for a copy and in the patch for an insert.
+    """
+    pos = 0
+    size = len(patch)
+    try:
+        while pos < size:
+            cmd = patch[pos]
+            pos += 1
+
+            length = cmd & 63
+            if cmd & 64:
+                shift = 6
+                while True:
+                    if shift > 62:
+                        raise XDeltaError("Invalid instruction length at {}".format(pos))
+                    byte = patch[pos]
+                    pos += 1
+                    length |= (byte & 127) << shift
+                    if not byte & 128:
+                        break
+                    shift += 7
+
+            if cmd & 128:
+                offset = 0
+                shift = 0
+                while True:
+                    byte = patch[pos]
+                    pos += 1
+                    if shift == 56:
+                        offset |= byte << 56
+                        break
+                    offset |= (byte & 127) << shift
+                    if not byte & 128:
+                        break
+                    shift += 7
+                yield True, length, offset
+            else:
+                yield False, length, pos
+                pos += length
+    except IndexError:
+        raise XDeltaError("Truncated patch")
+
+
+# Copies shorter than this are sliced from bytes, longer ones from a memoryview to avoid a second copy
+SMALL_COPY_SIZE = 256
+
+
+def apply_patch(source, patch):
+    """
+    Apply a patch to source, both bytes, and return the target as bytes.
+    The target is assembled from the slices written by write_patch with a single join.
+    """
+    parts = []
+    write_patch(source, patch, parts.append)
+    return b''.join(parts)
+
+
+def write_patch(source, patch, write):
+    """
+    Apply a patch to source, passing the target piecewise to write, so the target is never held as a whole.
+    source is any buffer, e.g. bytes or an mmap. The instructions are decoded inline with integer indexing
+    (see decode_instructions), write receives slices of source and patch.
+    """
+    # the views are released on errors too, a traceback must not keep an mmap source exported
+    with memoryview(source) as source_view, memoryview(patch) as patch_view:
+        source_size = len(source)
+        patch_size = len(patch)
+
+        pos = 0
+        try:
+            while pos < patch_size:
+                cmd = patch[pos]
+                pos += 1
+
+                length = cmd & 63
+                if cmd & 64:
+                    shift = 6
+                    while True:
+                        if shift > 62:
+                            raise XDeltaError("Invalid instruction length at {}".format(pos))
+                        byte = patch[pos]
+                        pos += 1
+                        length |= (byte & 127) << shift
+                        if byte < 128:
+                            break
+                        shift += 7
+
+                if cmd & 128:
+                    byte = patch[pos]
+                    pos += 1
+                    offset = byte & 127
+                    shift = 7
+                    while byte >= 128:
+                        byte = patch[pos]
+                        pos += 1
+                        if shift == 56:
+                            offset |= byte << 56
+                            break
+                        offset |= (byte & 127) << shift
+                        shift += 7
+
+                    if offset + length > source_size:
+                        raise XDeltaError("Copy beyond end of source")
+                    write(source[offset:offset + length] if length < SMALL_COPY_SIZE else source_view[offset:offset + length])
+                else:
+                    if pos + length > patch_size:
+                        raise XDeltaError("Truncated patch")
+                    write(patch[pos:pos + length] if length < SMALL_COPY_SIZE else patch_view[pos:pos + length])
+                    pos += length
+        except IndexError:
+            raise XDeltaError("Truncated patch")
+
+
+class ComposedPatch:
+    """
+    Chain of patches composed into pieces of the last target, each taken from the base version or from a patch.
+    A piece is (buffer, offset, length), buffer None for the base. The end offsets of the pieces in the target are
+    kept sorted, so the pieces overlapping a copy of the next patch are found by bisection instead of materialising
+    the intermediate version.
+    """
+
+    def __init__(self, base_size):
+        self._buffers = [None] if base_size else []
+        self._offsets = [0] if base_size else []
+        self._lengths = [base_size] if base_size else []
+        self._ends = [base_size] if base_size else []
+
+    def __len__(self):
+        """ Number of pieces """
+        return len(self._lengths)
+
+    @property
+    def size(self):
+        """ Size of the target """
+        return self._ends[-1] if self._ends else 0
+
+    def add(self, patch):
+        """ Compose a patch applying to the current target """
+        buffers, offsets, lengths, ends = self._buffers, self._offsets, self._lengths, self._ends
+        size = self.size
+        new_buffers = []
+        new_offsets = []
+        new_lengths = []
+
+        def append(buffer, offset, length):
+            # merge with the previous piece when contiguous in the same buffer
+            if new_lengths and new_buffers[-1] is buffer and new_offsets[-1] + new_lengths[-1] == offset:
+                new_lengths[-1] += length
+            else:
+                new_buffers.append(buffer)
+                new_offsets.append(offset)
+                new_lengths.append(length)
+
+        for copy, length, offset in decode_instructions(patch):
+            if not length:
+                continue
+            if not copy:
+                if offset + length > len(patch):
+                    raise XDeltaError("Truncated patch")
+                append(patch, offset, length)
+                continue
+
+            end = offset + length
+            if end > size:
+                raise XDeltaError("Copy beyond end of source")
+            first = bisect_right(ends, offset)
+            last = bisect_right(ends, end - 1)
+            first_start = ends[first] - lengths[first]
+            if first == last:
+                append(buffers[first], offsets[first] + offset - first_start, length)
+                continue
+
+            # head of the first piece, the pieces in between unchanged, tail of the last piece
+            append(buffers[first], offsets[first] + offset - first_start, ends[first] - offset)
+            new_buffers += buffers[first + 1:last]
+            new_offsets += offsets[first + 1:last]
+            new_lengths += lengths[first + 1:last]
+            append(buffers[last], offsets[last], end - ends[last - 1])
+
+        self._buffers = new_buffers
+        self._offsets = new_offsets
+        self._lengths = new_lengths
+        self._ends = list(accumulate(new_lengths))
+
+    def apply(self, base):
+        """ The target, assembled from base and the patches in one pass """
+        parts = []
+        append = parts.append
+        for buffer, offset, length in zip(self._buffers, self._offsets, self._lengths):
+            if buffer is None:
+                buffer = base
+            append(buffer[offset:offset + length] if length < SMALL_COPY_SIZE else memoryview(buffer)[offset:offset + length])
+        return b''.join(parts)
+
+
+# Composing is continued while the target has at least this many bytes per piece. Beyond, bisecting and copying
+# the piece lists costs more than copying the target, so the target is built and composing restarts from it.
+COMPOSE_BYTES_PER_PIECE = 1024
+
+
+def compose_patches(base, patches, materialized=None):
+    """
+    Apply a chain of patches to base by composing them, without building most intermediate versions.
+    Intermediate versions that do get built, when the composition becomes too fragmented,
+    are passed to materialized as (index of the patch, data).
+    """
+    data = base
+    composed = ComposedPatch(len(data))
+    for idx, patch in enumerate(patches):
+        composed.add(patch)
+        if len(composed) * COMPOSE_BYTES_PER_PIECE > composed.size:
+            data = composed.apply(data)
+            composed = ComposedPatch(len(data))
+            if materialized is not None:
+                materialized(idx, data)
+    return composed.apply(data)
+
+
+def apply_patch_stream(source, patch):
+    """ Apply a patch with the stream based XDeltaApplier """
+    target_fd = BytesIO()
+    XDeltaApplier.apply(BytesIO(source), target_fd, BytesIO(patch))
+    return target_fd.getvalue()
+
+
+def encode_instructions(instructions):
+    """
+    Encode instructions to a patch.
+    Instructions are (True, length, source offset) for a copy and (False, length, data) for an insert.
+    """
+    patch = bytearray()
+    for copy, length, value in instructions:
+        first = (128 if copy else 0) | (length & 63)
+        length >>= 6
+        if length:
+            first |= 64
+        patch.append(first)
+        while length:
+            byte = length & 127
+            length >>= 7
+            patch.append(byte | 128 if length else byte)
+
+        if copy:
+            offset = value
+            for shift in range(0, 56, 7):
+                byte = (offset >> shift) & 127
+                if offset >> (shift + 7):
+                    patch.append(byte | 128)
+                else:
+                    patch.append(byte)
+                    break
+            else:
+                patch.append((offset >> 56) & 255)
+        else:
+            patch += value
+
+    return bytes(patch)
@@ -6,6 +6,7 @@ from ccm_backup_reader.commands.ccm_command import CcmCommand
 from ccm_backup_reader.commands.ccm_command_error import CcmCommandError
 from ccm_backup_reader.commands.ccm_delim import CcmDelim
 from ccm_backup_reader.commands.ccm_diff import CcmDiff
+from ccm_backup_reader.commands.ccm_export import CcmExport
 from ccm_backup_reader.commands.ccm_finduse import CcmFinduse
 from ccm_backup_reader.commands.ccm_query import CcmQuery
 from ccm_backup_reader.commands.ccm_start import CcmStart
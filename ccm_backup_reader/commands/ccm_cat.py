@@ -1,12 +1,11 @@
 # -*- coding: utf-8 -*-
 
 import argparse
-import os.path
+import os
 import re
-import subprocess
 import sys
 
-from ccm_backup_reader.ccm_archive_reader import CcmArchiveReader
+from ccm_backup_reader import ccm_rcs
 from ccm_backup_reader.commands.ccm_command import CcmCommand
 from ccm_backup_reader.commands.ccm_command_error import CcmCommandError
 
@@ -22,34 +21,30 @@ class CcmCat(CcmCommand):
         parser.add_argument('file_spec')
         return parser
 
-    def _read_ccm_rcs(self, rcs_file, version):
-        # ensure file exists
-        backup_path = self._db.backup_path
-        path = os.path.join(backup_path, 'st_root', path)
+    def _st_root_path(self, archive):
+        """ Path of an archive, raises CcmCatError when it does not exist """
+        path = os.path.join(self._db.backup_path, 'st_root', archive)
         if not os.path.exists(path):
             raise CcmCatError("File not found in backup archive: " + path)
+        return path
+
+    def _read_ccm_rcs(self, rcs_file, version):
+        # ensure file exists
+        path = self._st_root_path(rcs_file)
 
-        # cat file and pipe to stdout
-        cmd = ['rcs', 'co', '-p' + version, path]
-        sp = subprocess.Popen(cmd, stderr=subprocess.PIPE)
-        out, err = sp.communicate()
-        ret_code = sp.returncode
-        if ret_code != 0:
-            raise CcmCatError("Error calling 'rcs co'")
-        print(out)
+        buffer = ccm_rcs.checkout(path, version, self._db.blob_cache)
+
+        sys.stdout.buffer.write(buffer)
+        sys.stdout.buffer.flush()
 
     def _read_ccm_delta(self, archive, version):
         # ensure file exists
-        backup_path = self._db.backup_path
-        path = os.path.join(backup_path, 'st_root', archive)
-        if not os.path.exists(path):
-            raise CcmCatError("File not found in backup archive: " + path)
-
-        archive_reader = CcmArchiveReader(path)
-        buffer = archive_reader.extract(version)
+        self._st_root_path(archive)
 
-        fp = os.fdopen(sys.stdout.fileno(), 'wb')
-        fp.write(buffer)
+        with self._db.archive_reader(archive) as archive_reader:
+            fp = os.fdopen(sys.stdout.fileno(), 'wb')
+            archive_reader.extract_to(version, fp)
+            fp.flush()
 
     def run(self):
         # get source attrib for fpn
@@ -0,0 +1,50 @@
+# -*- coding: utf-8 -*-
+
+import argparse
+import os
+import os.path
+
+from ccm_backup_reader.commands.ccm_command import CcmCommand
+from ccm_backup_reader.commands.ccm_command_error import CcmCommandError
+
+
+class CcmExportError(CcmCommandError):
+    pass
+
+
+class CcmExport(CcmCommand):
+    """ Write every version in the archive of a file to a directory, named by their fullName """
+
+    def _init_arg_parser(self):
+        parser = argparse.ArgumentParser(description='ccm export')
+        parser.add_argument('file_spec')
+        parser.add_argument('output_dir')
+        return parser
+
+    def _export_ccm_delta(self, archive, output_dir):
+        output_dir = os.path.abspath(output_dir)
+        with self._db.archive_reader(archive) as archive_reader:
+            for full_name, data in archive_reader.iter_versions():
+                target = os.path.normpath(os.path.join(output_dir, full_name))
+                if not target.startswith(output_dir + os.sep):
+                    raise CcmExportError("Version name outside of output directory: " + full_name)
+
+                os.makedirs(os.path.dirname(target), exist_ok=True)
+                with open(target, 'wb') as fp:
+                    fp.write(data)
+                print(full_name)
+
+    def run(self):
+        # get source attrib for fpn
+        fpn = self._args.file_spec
+        source = self._db.attr(fpn, 'source')
+        if not source:
+            raise CcmExportError("Object not found: " + fpn)
+
+        # parse results
+        lines = source.split('\n')
+        path = lines[2]
+        if lines[0] == 'ccm_delta':
+            self._export_ccm_delta(path, self._args.output_dir)
+        else:
+            raise CcmExportError("Don't know how to export this:\n" + source)
@@ -13,22 +13,39 @@ class CcmQuery(CcmCommand):
         parser.add_argument('-f', '--format', default='%objectname')
         parser.add_argument('-nf', '--noformat', action='store_true')
         parser.add_argument('-u', '--unnumbered', action='store_true')
+        parser.add_argument('--explain', action='store_true', help="Show the SQL query and its query plan")
         parser.add_argument('query')
         return parser
 
     def run(self):
         ccm_query = self._args.query
-        rows = self._db.query(ccm_query)
 
-        # upgrade pattern to something usable
+        # upgrade pattern to something usable, only query the columns used
         pattern = re.compile('%([a-z]+)')
         format = self._args.format
-        format = pattern.sub(lambda m: "{" + m.group(1) + "}", format)
+        columns = pattern.findall(format)
+        format = pattern.sub(lambda m: "{0." + m.group(1) + "}", format)
 
-        # print results
+        if self._args.explain:
+            self._explain(ccm_query, columns)
+            return
+
+        rows = self._db.query(ccm_query, stream=True, columns=columns)
+
+        # print results as they arrive
         for idx, row in enumerate(rows):
-            out = format.format(**row)
+            out = format.format(row)
             if self._args.unnumbered:
                 print("{}".format(out))
             else:
                 print("{}) {}".format(idx + 1, out))
+
+    def _explain(self, ccm_query, columns):
+        sql_query, params, query_plan = self._db.explain(ccm_query, columns)
+        print("SQL query:")
+        print("\t{}".format(sql_query))
+        print("Parameters:")
+        print("\t{}".format(params))
+        print("Query plan:")
+        for row in query_plan:
+            print("\t{}".format(row[-1]))
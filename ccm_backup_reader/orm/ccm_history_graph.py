@@ -0,0 +1,192 @@
+# -*- coding: utf-8 -*-
+
+from array import array
+from bisect import bisect_left
+from collections import deque
+from heapq import merge
+
+from ccm_backup_reader.ccm_error import CcmError
+
+
+# Number of cv_ids sorted at a time while building a graph
+SORT_CHUNK_SIZE = 1 << 20
+
+
+class HistoryGraph:
+    """
+    Version history (successor relations) held in memory.
+    Nodes are stored as a sorted array of cv_ids, their position is the node index.
+    Successors and predecessors are kept in CSR form: the neighbours of node i are
+    targets[offsets[i]:offsets[i + 1]].
+    All methods take and return cv_ids.
+    """
+
+    def __init__(self, edges):
+        """ Build the graph from (from_cv, to_cv) successor edges """
+        sources = array('q')
+        targets = array('q')
+        for from_cv, to_cv in edges:
+            sources.append(from_cv)
+            targets.append(to_cv)
+
+        self._cv_ids = self._sorted_unique(sources + targets)
+
+        # map cv_ids to node indices by bisecting the sorted cv_ids, as _index does
+        cv_ids = self._cv_ids
+        source_indices = array('l', (bisect_left(cv_ids, cv_id) for cv_id in sources))
+        del sources
+        target_indices = array('l', (bisect_left(cv_ids, cv_id) for cv_id in targets))
+        del targets
+
+        self._succ_offsets, self._succ_targets = self._csr(source_indices, target_indices)
+        self._pred_offsets, self._pred_targets = self._csr(target_indices, source_indices)
+
+    @staticmethod
+    def _sorted_unique(values):
+        """
+        Sorted distinct values of an array('q'), as array('q').
+        Sorted in chunks of SORT_CHUNK_SIZE and merged, so only one chunk at a time is held as Python ints.
+        """
+        chunks = [array('q', sorted(values[idx:idx + SORT_CHUNK_SIZE])) for idx in range(0, len(values), SORT_CHUNK_SIZE)]
+        unique = array('q')
+        last = None
+        for value in merge(*chunks):
+            if value != last:
+                unique.append(value)
+                last = value
+        return unique
+
+    @classmethod
+    def from_db(cls, ccm_db):
+        sql_query = \
+            "SELECT rel.from_cv, rel.to_cv " + \
+            "FROM relate rel " + \
+            "WHERE rel.name = 'successor'"
+        return cls(ccm_db.query_sql(sql_query, stream=True))
+
+    def _csr(self, sources, targets):
+        """ Counting sort of the edges on source index """
+        node_count = len(self._cv_ids)
+        offsets = array('l', bytes(array('l').itemsize * (node_count + 1)))
+        for source in sources:
+            offsets[source + 1] += 1
+        for idx in range(node_count):
+            offsets[idx + 1] += offsets[idx]
+
+        positions = array('l', offsets[:-1])
+        csr_targets = array('l', bytes(array('l').itemsize * len(targets)))
+        for source, target in zip(sources, targets):
+            csr_targets[positions[source]] = target
+            positions[source] += 1
+
+        return offsets, csr_targets
+
+    def _index(self, cv_id):
+        idx = bisect_left(self._cv_ids, cv_id)
+        if idx == len(self._cv_ids) or self._cv_ids[idx] != cv_id:
+            return None
+        return idx
+
+    def _node(self, cv_id):
+        idx = self._index(cv_id)
+        if idx is None:
+            raise KeyError(cv_id)
+        return idx
+
+    def _reachable(self, start_indices, offsets, targets):
+        """ Indices reachable from the start indices, excluding the start indices themselves unless on a cycle """
+        visited = bytearray(len(self._cv_ids))
+        reached = []
+        work = deque(start_indices)
+        while work:
+            idx = work.popleft()
+            for target in targets[offsets[idx]:offsets[idx + 1]]:
+                if not visited[target]:
+                    visited[target] = 1
+                    reached.append(target)
+                    work.append(target)
+        return reached
+
+    def __len__(self):
+        return len(self._cv_ids)
+
+    def __contains__(self, cv_id):
+        return self._index(cv_id) is not None
+
+    @property
+    def edge_count(self):
+        return len(self._succ_targets)
+
+    def successors(self, cv_id):
+        idx = self._index(cv_id)
+        if idx is None:
+            return []
+        return [self._cv_ids[target] for target in self._succ_targets[self._succ_offsets[idx]:self._succ_offsets[idx + 1]]]
+
+    def predecessors(self, cv_id):
+        idx = self._index(cv_id)
+        if idx is None:
+            return []
+        return [self._cv_ids[target] for target in self._pred_targets[self._pred_offsets[idx]:self._pred_offsets[idx + 1]]]
+
+    def descendants(self, cv_id):
+        """ All versions following a version, in breadth first order """
+        idx = self._index(cv_id)
+        if idx is None:
+            return []
+        return [self._cv_ids[i] for i in self._reachable([idx], self._succ_offsets, self._succ_targets)]
+
+    def ancestors(self, cv_id):
+        """ All versions preceding a version, in breadth first order """
+        idx = self._index(cv_id)
+        if idx is None:
+            return []
+        return [self._cv_ids[i] for i in self._reachable([idx], self._pred_offsets, self._pred_targets)]
+
+    def topological_order(self, cv_ids=None):
+        """
+        Versions ordered so every version comes after its predecessors.
+        With cv_ids, only these versions are ordered, using the order of the full history.
+        """
+        node_count = len(self._cv_ids)
+        in_degrees = array('l', (self._pred_offsets[idx + 1] - self._pred_offsets[idx] for idx in range(node_count)))
+        work = deque(idx for idx in range(node_count) if in_degrees[idx] == 0)
+        order = array('l')
+        while work:
+            idx = work.popleft()
+            order.append(idx)
+            for target in self._succ_targets[self._succ_offsets[idx]:self._succ_offsets[idx + 1]]:
+                in_degrees[target] -= 1
+                if in_degrees[target] == 0:
+                    work.append(target)
+
+        if len(order) != node_count:
+            raise CcmError("History contains a cycle")
+
+        if cv_ids is None:
+            return [self._cv_ids[idx] for idx in order]
+
+        wanted = bytearray(node_count)
+        for cv_id in cv_ids:
+            wanted[self._node(cv_id)] = 1
+        return [self._cv_ids[idx] for idx in order if wanted[idx]]
+
+    def common_ancestors(self, cv_id_a, cv_id_b):
+        """ Versions that are an ancestor of both versions, a version counting as its own ancestor """
+        ancestors_a = set(self.ancestors(cv_id_a))
+        ancestors_a.add(cv_id_a)
+        ancestors_b = set(self.ancestors(cv_id_b))
+        ancestors_b.add(cv_id_b)
+        return ancestors_a & ancestors_b
+
+    def lowest_common_ancestors(self, cv_id_a, cv_id_b):
+        """ Common ancestors that are not an ancestor of another common ancestor """
+        common = self.common_ancestors(cv_id_a, cv_id_b)
+        indices = [self._node(cv_id) for cv_id in common]
+        dominated = self._reachable(indices, self._pred_offsets, self._pred_targets)
+        return common - {self._cv_ids[idx] for idx in dominated}
+
+    def between(self, cv_id_from, cv_id_to):
+        """ Versions that are a descendant of cv_id_from and an ancestor of cv_id_to, excluding both """
+        descendants = set(self.descendants(cv_id_from))
+        return [cv_id for cv_id in self.ancestors(cv_id_to) if cv_id in descendants and cv_id not in (cv_id_from, cv_id_to)]
@@ -1,16 +1,45 @@
 # -*- coding: utf-8 -*-
 
-import os.path
-import re
-from datetime import datetime
+from collections import namedtuple
 
+from ccm_backup_reader import ccm_rcs
 from ccm_backup_reader import ccm_utils
 from ccm_backup_reader.ccm_error import CcmError
-from ccm_backup_reader.ccm_archive_reader import CcmArchiveReader
+
+
+# Core compver columns, loaded with every query constructing objects
+CORE_COLUMNS = ['id', 'cvtype', 'name', 'version', 'subsystem', 'create_time', 'owner', 'is_product']
+
+
+class CcmObjectRef(namedtuple('CcmObjectRef', CORE_COLUMNS)):
+    """
+    Lightweight, read-only reference to a compver, holding its core columns.
+    Used as the cached row of objects and returned by bulk listings.
+    """
+
+    __slots__ = ()
+
+    @property
+    def type(self):
+        return self.cvtype
+
+    @property
+    def instance(self):
+        return self.subsystem
+
+    @property
+    def full_name(self):
+        return '{}/{}/{}/{}'.format(self.subsystem, self.cvtype, self.name, self.version)
+
+    @property
+    def part_name(self):
+        return '{}/{}/{}'.format(self.subsystem, self.cvtype, self.name)
 
 
 class CcmRelease:
 
+    __slots__ = ('_orm', '_id', '__weakref__')
+
     def __init__(self, ccm_orm, id):
         self._orm = ccm_orm
         self._id = id
@@ -35,49 +64,69 @@ class CcmRelease:
 
 
 class CcmObject:
+    """
+    Compver of a session. Besides its id, an object only holds its core row, status timelines and attributes
+    are memoised by the session.
+    """
 
-    def __init__(self, ccm_orm, id):
+    __slots__ = ('_orm', '_id', '_row', '__weakref__')
+
+    def __init__(self, ccm_orm, id, row=None):
         self._orm = ccm_orm
         self._id = id
+        self._row = row
 
     @property
     def id(self):
         return self._id
 
+    @property
+    def row(self):
+        """ Core compver row, loaded once """
+        if self._row is None:
+            self._row = self._orm.object_row(self)
+        return self._row
+
     @property
     def fpn(self):
         return self._orm.object_fpn(self)
 
     @property
     def four_part_name(self):
-        delim = self._orm.delim
-        return "{name}{delim}{version}:{type}:{instance}".format(**self.fpn, delim=delim)
+        row = self.row
+        return "{}{}{}:{}:{}".format(row.name, self._orm.delim, row.version, row.cvtype, row.subsystem)
 
     @property
     def full_name(self):
-        fpn = self.fpn
-        return '{}/{}/{}/{}'.format(self.instance, self.type, self.name, self.version)
+        return self.row.full_name
 
     @property
     def part_name(self):
-        parts = self.full_name.split('/')
-        return '/'.join(parts[0:3])
+        return self.row.part_name
 
     @property
     def name(self):
-        return self.fpn['name']
+        return self.row.name
 
     @property
     def version(self):
-        return self.fpn['version']
+        return self.row.version
 
     @property
     def type(self):
-        return self.fpn['type']
+        return self.row.cvtype
 
     @property
     def instance(self):
-        return self.fpn['instance']
+        return self.row.subsystem
+
+    @property
+    def create_time(self):
+        return self.row.create_time
+
+    @property
+    def owner(self):
+        return self.row.owner
 
     @property
     def attributes(self):
@@ -90,16 +139,17 @@ class CcmObject:
         return attribs
 
     def attribute(self, name):
-        return self.attributes[name]
+        """ Single attribute, fetched on first access, raises KeyError for a missing attribute """
+        return self._orm.cached_attribute(self, name)
 
     def __getitem__(self, key):
         return self.attribute(key)
 
-    def related_from(self, relation_name):
-        return self._orm.related_from(self, relation_name)
+    def related_from(self, relation_name, refs=False):
+        return self._orm.related_from(self, relation_name, refs)
 
-    def related_to(self, relation_name):
-        return self._orm.related_to(self, relation_name)
+    def related_to(self, relation_name, refs=False):
+        return self._orm.related_to(self, relation_name, refs)
 
     def related_all(self):
         return self._orm.related_all(self)
@@ -112,27 +162,17 @@ class CcmObject:
     def predecessors(self):
         return self.related_from('successor')
 
+    @property
+    def timeline(self):
+        """ Parsed status_log, loaded once """
+        return self._orm.status_timeline(self)
+
     @property
     def status(self):
-        status_log = self['status_log']
-        entries = status_log.split('\n')
-        last_entry = entries[-1]
-        return re.match(r".*'(\w+)'.*", last_entry).group(1)
+        return self.timeline.status
 
     def status_time(self, status):
-        last_time = datetime(1, 1, 1)
-        status_log = self['status_log']
-        entries = status_log.split('\n')
-        for entry in reversed(entries):
-            entry_status = re.match(r".*'(\w+)'.*", entry).group(1)
-            time_str = re.match(r"(.*): Status set to", entry).group(1)
-            time = datetime.strptime(time_str, "%a %b %d %H:%M:%S %Y")
-            last_time = max(last_time, time)
-
-            if entry_status == status:
-                return time
-
-        #return last_time
+        return self.timeline.status_time(status)
 
     @property
     def release(self):
@@ -153,21 +193,27 @@ class CcmObject:
 
 class CcmBaseline(CcmObject):
 
+    __slots__ = ()
+
     @property
     def tasks(self):
         return self.related_to('task_in_baseline')
 
 
 class CcmReleaseDef(CcmObject):
-    pass
+
+    __slots__ = ()
 
 
 class CcmProjectGrouping(CcmObject):
-    pass
+
+    __slots__ = ()
 
 
 class CcmProcessRule(CcmObject):
 
+    __slots__ = ()
+
     @property
     def release(self):
         return self.related_from('pr_in_release')[0]
@@ -183,6 +229,8 @@ class CcmProcessRule(CcmObject):
 
 class CcmProject(CcmObject):
 
+    __slots__ = ()
+
     @property
     def baseline_project(self):
         baseline_projects = self.related_to('baseline_project')
@@ -203,27 +251,11 @@ class CcmProject(CcmObject):
 
     @property
     def structure(self):
-        structure = {}
-
-        # build top level
-        children = self._orm.bound_children(self, self)
-        for child in children:
-            structure[child] = '/' + child.name
-
-        # recurse over all children
-        work = list(children)
-        while work:
-            current = work.pop()
-            if current.type != 'dir':
-                continue
+        return dict(self._orm.project_structure(self))
 
-            children = self._orm.bound_children(self, current)
-            for child in children:
-                structure[child] = structure[current] + '/' + child.name
-
-            work += children
-
-        return structure
+    def iter_structure(self):
+        """ Stream the (object, path) entries of the project structure """
+        return self._orm.project_structure(self, stream=True)
 
     @property
     def tasks(self):
@@ -236,6 +268,8 @@ class CcmProject(CcmObject):
 
 class CcmFolder(CcmObject):
 
+    __slots__ = ()
+
     @property
     def projects(self):
         return self.related_from('folder_in_rp')
@@ -246,15 +280,19 @@ class CcmFolder(CcmObject):
 
 
 class CcmFolderTemplate(CcmObject):
-    pass
+
+    __slots__ = ()
 
 
 class CcmProblem(CcmObject):
-    pass
+
+    __slots__ = ()
 
 
 class CcmTask(CcmObject):
 
+    __slots__ = ()
+
     @property
     def completed_time(self):
         return self.status_time('completed')
@@ -266,6 +304,8 @@ class CcmTask(CcmObject):
 
 class CcmDirectory(CcmObject):
 
+    __slots__ = ()
+
     @property
     def integrate_time(self):
         return self.status_time('integrate')
@@ -282,6 +322,8 @@ class CcmDirectory(CcmObject):
 
 class CcmFile(CcmObject):
 
+    __slots__ = ()
+
     @property
     def integrate_time(self):
         return self.status_time('integrate')
@@ -298,19 +340,9 @@ class CcmFile(CcmObject):
 
         lines = source.split('\n')
         type_, version, archive_path = lines[0], lines[1], lines[2]
-        backup_path = self._orm._db.backup_path
-        path = os.path.join(backup_path, 'st_root', archive_path)
-        if not os.path.exists(path):
-            raise Error("File not found in backup archive: " + path)
         if type_ == 'ccm_delta':
-            archive_reader = CcmArchiveReader(path)
-            buffer = archive_reader.extract(version)
-            return buffer
+            with self._orm._db.archive_reader(archive_path) as archive_reader:
+                return archive_reader.extract(version)
         else:
-            cmd = ['rcs', 'co', '-p' + version, path]
-            sp = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-            out, err = sp.communicate()
-            ret_code = sp.returncode
-            if ret_code != 0:
-                raise Exception("Error calling: " + ' '.join(cmd))
-            return out
+            path = self._orm._db.st_root_path(archive_path)
+            return ccm_rcs.checkout(path, version, self._orm._db.blob_cache)
@@ -1,14 +1,28 @@
 # -*- coding: utf-8 -*-
 
+import os
+import sys
 from collections import defaultdict
+from collections import namedtuple
+from concurrent.futures import FIRST_COMPLETED
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures import wait
+from itertools import groupby
+from itertools import islice
+from weakref import WeakValueDictionary
 
+from ccm_backup_reader import ccm_rcs
 from ccm_backup_reader import ccm_utils
+from ccm_backup_reader.ccm_archive_reader import CcmArchiveReader
 from ccm_backup_reader.ccm_db import _COMPVER_ATTR_NAMES
+from ccm_backup_reader.ccm_error import CcmError
+from ccm_backup_reader.orm.ccm_objects import CORE_COLUMNS
 from ccm_backup_reader.orm.ccm_objects import CcmBaseline
 from ccm_backup_reader.orm.ccm_objects import CcmDirectory
 from ccm_backup_reader.orm.ccm_objects import CcmFile
 from ccm_backup_reader.orm.ccm_objects import CcmFolder
 from ccm_backup_reader.orm.ccm_objects import CcmFolderTemplate
+from ccm_backup_reader.orm.ccm_objects import CcmObjectRef
 from ccm_backup_reader.orm.ccm_objects import CcmProcessRule
 from ccm_backup_reader.orm.ccm_objects import CcmProblem
 from ccm_backup_reader.orm.ccm_objects import CcmProject
@@ -16,6 +30,9 @@ from ccm_backup_reader.orm.ccm_objects import CcmProjectGrouping
 from ccm_backup_reader.orm.ccm_objects import CcmRelease
 from ccm_backup_reader.orm.ccm_objects import CcmReleaseDef
 from ccm_backup_reader.orm.ccm_objects import CcmTask
+from ccm_backup_reader.orm.ccm_history_graph import HistoryGraph
+from ccm_backup_reader.orm.ccm_status_timeline import StatusTimeline
+from ccm_backup_reader.orm.ccm_version_index import VersionIndex
 
 
 CCM_ORM_OBJECT_TYPE_MAP = {
@@ -32,184 +49,612 @@ CCM_ORM_OBJECT_TYPE_MAP = {
 }
 
 
+# Number of objects per query when prefetching, keeps below the SQLite parameter limit
+PREFETCH_CHUNK_SIZE = 500
+
+# For each direction, the relate column of the given objects and of the related objects
+RELATION_DIRECTIONS = {
+    'to': ('from_cv', 'to_cv'),
+    'from': ('to_cv', 'from_cv'),
+}
+
+
+# Above this fraction of the versions of an archive or RCS file, extract_versions walks it whole once
+EXTRACT_WALK_RATIO = 0.25
+
+# Archives in flight per worker in extract_many
+EXTRACT_PENDING_PER_WORKER = 2
+
+
+# Entry of a project diff, change is one of 'added', 'removed', 'updated' or 'unchanged'
+ProjectDiffEntry = namedtuple('ProjectDiffEntry', ['change', 'ref_a', 'ref_b', 'path_a', 'path_b'])
+
+# members of two projects are matched on these columns by diff_projects
+DIFF_MATCH_COLUMNS = ['subsystem', 'cvtype', 'name']
+
+
+def core_columns(alias):
+    return ", ".join("{}.{}".format(alias, column) for column in CORE_COLUMNS)
+
+
+def structure_cte(name):
+    """
+    Recursive common table expression with the core columns and path of the members of a project.
+    Takes the project id three times as parameter.
+    """
+    return \
+        name + "(" + ", ".join(CORE_COLUMNS) + ", path) AS (" + \
+            "SELECT " + core_columns('cv') + ", '/' || cv.name " + \
+            "FROM bind INNER JOIN compver cv ON (bind.has_child = cv.id) " + \
+            "WHERE bind.has_asm = ? AND bind.has_parent = ? " + \
+            "UNION ALL " + \
+            "SELECT " + core_columns('cv') + ", parent.path || '/' || cv.name " + \
+            "FROM " + name + " parent INNER JOIN bind ON (bind.has_parent = parent.id) INNER JOIN compver cv ON (bind.has_child = cv.id) " + \
+            "WHERE parent.cvtype = 'dir' AND bind.has_asm = ?" + \
+        ")"
+
+
+def project_diff_query():
+    """
+    Members of two projects as (side, core columns, path), side 0 or 1, ordered on DIFF_MATCH_COLUMNS and side.
+    Takes the id of the first project three times, then the id of the second one three times as parameters.
+    """
+    order = ", ".join(str(CORE_COLUMNS.index(column) + 2) for column in DIFF_MATCH_COLUMNS)
+    return \
+        "WITH RECURSIVE " + structure_cte('a') + ", " + structure_cte('b') + " " + \
+        "SELECT 0, " + core_columns('a') + ", a.path FROM a " + \
+        "UNION ALL " + \
+        "SELECT 1, " + core_columns('b') + ", b.path FROM b " + \
+        "ORDER BY " + order + ", 1"
+
+
+def parse_source(source):
+    """ (source type, version, archive path below st_root) of a source attribute, None without source """
+    if not source:
+        return None
+    lines = source.split('\n')
+    if len(lines) < 3:
+        raise CcmError("Invalid source attribute:\n" + source)
+    return lines[0], lines[1], lines[2]
+
+
+def extract_versions(source_type, path, versions, blob_cache=None):
+    """
+    Contents of versions of one archive, as {version: data}.
+    Run by the worker processes of CcmOrm.extract_many, many versions of an archive are
+    extracted in a single walk of its delta tree. Versions are read from and added to blob_cache.
+    """
+    if source_type == 'ccm_rcs':
+        return ccm_rcs.checkout_many(path, versions, EXTRACT_WALK_RATIO, blob_cache)
+    if source_type != 'ccm_delta':
+        raise CcmError("Don't know how to handle source type: " + source_type)
+
+    reader = CcmArchiveReader(path, blob_cache=blob_cache)
+    wanted = set(versions)
+    missing = wanted.difference(reader.versions)
+    if missing:
+        raise CcmError("Versions not found in archive {}: {}".format(path, ', '.join(sorted(missing))))
+
+    if len(wanted) <= len(reader.versions) * EXTRACT_WALK_RATIO:
+        return {version: reader.extract(version) for version in wanted}
+
+    found = {}
+    for full_name, data in reader.iter_versions():
+        if full_name in wanted:
+            found[full_name] = data
+            if len(found) == len(wanted):
+                break
+    return found
+
+
 class CcmOrm:
+    """
+    Session on a CCM backup database.
+    Objects are kept in an identity map, a compver is represented by at most one object per session.
+    """
 
     def __init__(self, ccm_db):
         self._db = ccm_db
+        self._identity_map = WeakValueDictionary()
+        # (direction, cv_id) -> (prefetched relation names or None for all, {relation name: [objects]})
+        self._relation_cache = {}
+        # cv_id -> StatusTimeline and cv_id -> {attribute name: value}, kept off the objects
+        self._timelines = {}
+        self._attributes = {}
+        self._history_graph = None
+        self._version_index = None
+        self._release_names = None
+        self._releases = {}
 
     @property
     def delim(self):
         return self._db.delim()
 
-    def _construct_object(self, cv_id, cv_type):
-        type_ = CCM_ORM_OBJECT_TYPE_MAP.get(cv_type, CcmFile)
-        return type_(self, cv_id)
+    def history_graph(self):
+        """ Successor graph of all versions, built once per session """
+        if self._history_graph is None:
+            self._history_graph = HistoryGraph.from_db(self._db)
+        return self._history_graph
 
-    def _construct_release(self, release_id):
-        return CcmRelease(self, release_id)
+    def version_index(self, persist=False):
+        """
+        Index of the integrated and released versions per partial name, built once per session.
+        An index persisted from the current status logs is loaded from the database, with persist a built index
+        is stored in it. Persisting needs the default open profile, see VersionIndex.save.
+        """
+        if self._version_index is None:
+            self._version_index = VersionIndex.from_db(self._db)
+        if persist and not VersionIndex.is_persisted(self._db):
+            self._version_index.save(self._db)
+        return self._version_index
 
-    def release_from_object(self, ccm_object):
-        compver_id = ccm_object.id
+    def version_at_timestamp(self, partial_name, timestamp):
+        """ Version of a partial name (instance/type/name) current at timestamp, see VersionIndex.version_at """
+        key = tuple(partial_name.split('/'))
+        cv_id = self.version_index().version_at(key, timestamp)
+        if cv_id is None:
+            return None
+        return self.object_by_id(cv_id)
+
+    def _construct_ref(self, row, strings=None):
+        """
+        CcmObjectRef for a core compver row.
+        The low cardinality columns are interned, so rows share them. Names and versions are shared through
+        strings, a dict living as long as one result: interning them would keep every distinct value alive.
+        """
+        if isinstance(row, CcmObjectRef):
+            return row
+        cv_id, cvtype, name, version, subsystem, create_time, owner, is_product = row
+        if strings is not None:
+            name = strings.setdefault(name, name)
+            version = strings.setdefault(version, version)
+        return CcmObjectRef(
+            cv_id,
+            sys.intern(cvtype) if cvtype is not None else None,
+            name,
+            version,
+            sys.intern(subsystem) if subsystem is not None else None,
+            create_time,
+            sys.intern(owner) if owner is not None else None,
+            is_product)
+
+    def _construct_object(self, row, strings=None):
+        ccm_object = self._identity_map.get(row[0])
+        if ccm_object is None:
+            ref = self._construct_ref(row, strings)
+            type_ = CCM_ORM_OBJECT_TYPE_MAP.get(ref.cvtype, CcmFile)
+            ccm_object = type_(self, ref.id, ref)
+            self._identity_map[ref.id] = ccm_object
+        return ccm_object
+
+    def _construct_objects(self, rows, refs=False):
+        """ Objects for core compver rows, or CcmObjectRefs with refs, sharing the strings of the rows """
+        strings = {}
+        if refs:
+            return [self._construct_ref(row, strings) for row in rows]
+        return [self._construct_object(row, strings) for row in rows]
+
+    def object_from_ref(self, ref):
+        return self._construct_object(ref)
+
+    def object_row(self, ccm_object):
+        """ Core compver row of an object """
         sql_query = \
-            "SELECT r.id " + \
-            "FROM compver cv INNER JOIN release r ON (cv.is_product = r.id) " + \
+            "SELECT " + core_columns('cv') + " " + \
+            "FROM compver cv " + \
             "WHERE cv.id = ?"
-        rows = self._db.query_sql(sql_query, compver_id)
+        rows = self._db.query_sql(sql_query, ccm_object.id)
         if not rows:
             return None
-        row = rows[0]
-        return self._construct_release(row[0])
+        return self._construct_ref(rows[0])
+
+    def release_names(self):
+        """ Map of release id to release name, loaded once per session """
+        if self._release_names is None:
+            sql_query = \
+                "SELECT r.id, r.name " + \
+                "FROM release r"
+            self._release_names = dict(self._db.query_sql(sql_query))
+        return self._release_names
+
+    def _construct_release(self, release_id):
+        ccm_release = self._releases.get(release_id)
+        if ccm_release is None:
+            ccm_release = CcmRelease(self, release_id)
+            self._releases[release_id] = ccm_release
+        return ccm_release
+
+    def release_from_object(self, ccm_object):
+        is_product = ccm_object.row.is_product
+        if is_product not in self.release_names():
+            return None
+        return self._construct_release(is_product)
 
     def release_name(self, ccm_release):
-        sql_query = \
-            "SELECT name " + \
-            "FROM release " + \
-            "WHERE id = ?"
-        rows = self._db.query_sql(sql_query, ccm_release.id)
-        if not rows:
+        if ccm_release is None:
             return None
-        return rows[0][0]
+        return self.release_names().get(ccm_release.id)
 
     def object_by_id(self, compver_id):
+        ccm_object = self._identity_map.get(compver_id)
+        if ccm_object is not None:
+            return ccm_object
+
         sql_query = \
-            "SELECT cv.id AS cvid, cv.cvtype " + \
+            "SELECT " + core_columns('cv') + " " + \
             "FROM compver cv " + \
             "WHERE cv.id = ?"
         rows = self._db.query_sql(sql_query, compver_id)
         if not rows:
             return None
-        row = rows[0]
-        cv_id = row[0]
-        cv_type = row[1]
-        return self._construct_object(cv_id, cv_type)
+        return self._construct_object(rows[0])
 
     def object_by_fpn(self, four_part_name):
         fpn = four_part_name if isinstance(four_part_name, dict) else ccm_utils.parse_fpn(four_part_name, self.delim) 
         sql_query = \
-            "SELECT cv.id, cv.cvtype " + \
+            "SELECT " + core_columns('cv') + " " + \
             "FROM compver cv " + \
             "WHERE cv.name = ? AND cv.version = ? AND cv.cvtype = ? and cv.subsystem = ?"
         rows = self._db.query_sql(sql_query, fpn['name'], fpn['version'], fpn['type'], fpn['instance'])
         if not rows:
             return None
-        row = rows[0]
-        cv_id = row[0]
-        cv_type = row[1]
-        return self._construct_object(cv_id, cv_type)
+        return self._construct_object(rows[0])
 
     def object_by_full_name(self, full_name):
         fpn = ccm_utils.parse_full_name(full_name)
         return self.object_by_fpn(fpn)
 
-    def objects_by_partial_name(self, partial_name):
+    def objects_by_partial_name(self, partial_name, refs=False):
         subsystem, cvtype, name = partial_name.split('/')
         sql_query = \
-            "SELECT cv.id, cv.cvtype " + \
+            "SELECT " + core_columns('cv') + " " + \
             "FROM compver cv " + \
             "WHERE cv.name = ? AND cv.cvtype = ? and cv.subsystem = ?"
         rows = self._db.query_sql(sql_query, name, cvtype, subsystem)
-        return [self._construct_object(row[0], row[1]) for row in rows]
+        return self._construct_objects(rows, refs)
 
-    def objects_by_release(self, release):
+    def objects_by_release(self, release, refs=False):
         is_product = release.id
         sql_query = \
-            "SELECT cv.id, cv.cvtype " + \
+            "SELECT " + core_columns('cv') + " " + \
             "FROM compver cv " + \
             "WHERE cv.is_product = ?"
         rows = self._db.query_sql(sql_query, is_product)
-        return [self._construct_object(row[0], row[1]) for row in rows]
+        return self._construct_objects(rows, refs)
 
     def object_fpn(self, ccm_object):
-        compver_id = ccm_object.id
-        sql_query = \
-            "SELECT cv.name, cv.version, cv.cvtype AS type, cv.subsystem AS instance " + \
-            "FROM compver cv " + \
-            "WHERE cv.id = ?"
-        rows = self._db.query_sql(sql_query, compver_id)
-        if not rows:
+        row = ccm_object.row
+        if row is None:
             return None
-        row = rows[0]
         return {
-            'name': row[0],
-            'version': row[1],
-            'type': row[2],
-            'instance': row[3],
+            'name': row.name,
+            'version': row.version,
+            'type': row.cvtype,
+            'instance': row.subsystem,
         }
 
     def object_attributes(self, ccm_object):
-        # from attr table
+        # compver columns and attr table in one query, compver columns are repeated on each attribute row
         cv_id = ccm_object.id
         sql_query = \
-            "SELECT attr.name, attr.textval " + \
-            "FROM attrib AS attr " + \
-            "WHERE attr.is_attr_of = ?"
-        rows = self._db.query_sql(sql_query, cv_id)
-        attrib_attrs = {row[0]: row[1] for row in rows}
-
-        # from compver table
-        sql_query = \
-            "SELECT " + ", ".join(_COMPVER_ATTR_NAMES.keys()) + " " + \
-            "FROM compver " + \
-            "WHERE id = ?"
+            "SELECT " + ", ".join("cv." + name for name in _COMPVER_ATTR_NAMES.keys()) + ", attr.name, attr.textval " + \
+            "FROM compver cv LEFT JOIN attrib AS attr ON (attr.is_attr_of = cv.id) " + \
+            "WHERE cv.id = ?"
         rows = self._db.query_sql(sql_query, cv_id)
-        cv_attrs = dict(zip(_COMPVER_ATTR_NAMES.keys(), rows[0]))
+        if not rows:
+            return {}
+        column_count = len(_COMPVER_ATTR_NAMES)
+        attrib_attrs = {row[column_count]: row[column_count + 1] for row in rows if row[column_count] is not None}
+        cv_attrs = dict(zip(_COMPVER_ATTR_NAMES.keys(), rows[0][:column_count]))
 
-        # release
+        # release, from the release map
         ccm_release = self.release_from_object(ccm_object)
-        ccm_release_name = self.release_name(ccm_release)
-        release_attrs = {'release': ccm_release_name}
+        release_attrs = {'release': self.release_name(ccm_release)}
 
         return {**attrib_attrs, **cv_attrs, **release_attrs}
 
-    def related_from(self, ccm_object, relation_name):
+    def object_attribute(self, ccm_object, name):
+        """ Single attribute of an object, compver columns take precedence as in object_attributes """
+        if name == 'release':
+            return self.release_name(self.release_from_object(ccm_object))
+
+        if name in _COMPVER_ATTR_NAMES:
+            sql_query = \
+                "SELECT cv.{} ".format(name) + \
+                "FROM compver cv " + \
+                "WHERE cv.id = ?"
+            args = [ccm_object.id]
+        else:
+            sql_query = \
+                "SELECT attr.textval " + \
+                "FROM attrib AS attr " + \
+                "WHERE attr.is_attr_of = ? AND attr.name = ?"
+            args = [ccm_object.id, name]
+        rows = self._db.query_sql(sql_query, *args)
+        if not rows:
+            raise KeyError(name)
+        return rows[0][0]
+
+    def cached_attribute(self, ccm_object, name):
+        """ Deserialized single attribute of an object, fetched once per session """
+        attributes = self._attributes.setdefault(ccm_object.id, {})
+        if name not in attributes:
+            value = self.object_attribute(ccm_object, name)
+            if isinstance(value, str):
+                value = ccm_utils.deserialize_textval(value)
+            attributes[name] = value
+        return attributes[name]
+
+    def prefetch(self, objects, relations=None, direction='both'):
+        """
+        Load the relations of many objects in a few queries.
+        Afterwards related_to and related_from are answered from memory for these objects.
+        Without relations, all relations are loaded.
+        Direction is 'to', 'from' or 'both'.
+        """
+        if direction == 'both':
+            directions = ['to', 'from']
+        elif direction in RELATION_DIRECTIONS:
+            directions = [direction]
+        else:
+            raise ValueError("Unknown direction: {}".format(direction))
+
+        cv_ids = list({ccm_object.id for ccm_object in objects})
+        for direction in directions:
+            for idx in range(0, len(cv_ids), PREFETCH_CHUNK_SIZE):
+                self._prefetch_chunk(cv_ids[idx:idx + PREFETCH_CHUNK_SIZE], relations, direction)
+
+    def _prefetch_chunk(self, cv_ids, relations, direction):
+        own_column, other_column = RELATION_DIRECTIONS[direction]
+        sql_query = \
+            "SELECT rel.{}, rel.name, ".format(own_column) + core_columns('cv') + " " + \
+            "FROM relate rel INNER JOIN compver cv ON (rel.{} = cv.id) ".format(other_column) + \
+            "WHERE rel.{} IN ({})".format(own_column, ", ".join("?" * len(cv_ids)))
+        args = list(cv_ids)
+        if relations is not None:
+            sql_query += " AND rel.name IN ({})".format(", ".join("?" * len(relations)))
+            args += relations
+
+        related = {cv_id: defaultdict(list) for cv_id in cv_ids}
+        strings = {}
+        for row in self._db.query_sql(sql_query, *args, stream=True):
+            related[row[0]][row[1]].append(self._construct_object(row[2:], strings))
+
+        for cv_id in cv_ids:
+            names, cached = self._relation_cache.get((direction, cv_id), (set(), {}))
+            if relations is None:
+                names = None
+                cached = {}
+            elif names is not None:
+                names = names.union(relations)
+                for relation_name in relations:
+                    cached.pop(relation_name, None)
+            cached.update(related[cv_id])
+            self._relation_cache[(direction, cv_id)] = (names, cached)
+
+    def _cached_related(self, direction, ccm_object, relation_name):
+        """ Prefetched related objects, None when not prefetched """
+        entry = self._relation_cache.get((direction, ccm_object.id))
+        if entry is None:
+            return None
+        names, related = entry
+        if names is not None and relation_name not in names:
+            return None
+        return list(related.get(relation_name, []))
+
+    def object_sources(self, objects):
+        """ Map of cv_id to the parsed source attribute (see parse_source) of many objects, in a few queries """
+        cv_ids = list({ccm_object.id for ccm_object in objects})
+        sources = {}
+        for idx in range(0, len(cv_ids), PREFETCH_CHUNK_SIZE):
+            chunk = cv_ids[idx:idx + PREFETCH_CHUNK_SIZE]
+            sql_query = \
+                "SELECT attr.is_attr_of, attr.textval " + \
+                "FROM attrib AS attr " + \
+                "WHERE attr.is_attr_of IN ({}) AND attr.name = 'source'".format(", ".join("?" * len(chunk)))
+            for cv_id, textval in self._db.query_sql(sql_query, *chunk, stream=True):
+                sources[cv_id] = parse_source(ccm_utils.deserialize_textval(textval) if textval else None)
+        return sources
+
+    def extract_many(self, objects, workers=None, max_pending=None):
+        """
+        Contents of many files, yields (object, data) as they are extracted, data is None for objects without source.
+        The versions are grouped by archive and each archive is extracted by one task in a pool of worker processes,
+        so its delta tree is walked once. workers defaults to the CPU count, with 1 everything runs in this process.
+        At most max_pending archives are in flight (default EXTRACT_PENDING_PER_WORKER per worker),
+        bounding the memory held by finished results.
+        """
+        objects = list(objects)
+        sources = self.object_sources(objects)
+
+        # (source type, archive) -> version -> objects
+        groups = defaultdict(lambda: defaultdict(list))
+        for ccm_object in objects:
+            source = sources.get(ccm_object.id)
+            if source is None:
+                yield ccm_object, None
+                continue
+            source_type, version, archive = source
+            groups[(source_type, archive)][version].append(ccm_object)
+
+        tasks = ((source_type, self._db.st_root_path(archive), versions) for (source_type, archive), versions in groups.items())
+
+        blob_cache = self._db.blob_cache
+        workers = workers or os.cpu_count() or 1
+        if workers == 1:
+            for source_type, path, versions in tasks:
+                for version, data in extract_versions(source_type, path, list(versions), blob_cache).items():
+                    for ccm_object in versions[version]:
+                        yield ccm_object, data
+            return
+
+        max_pending = max_pending or workers * EXTRACT_PENDING_PER_WORKER
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            pending = {}
+            try:
+                while True:
+                    for source_type, path, versions in islice(tasks, max_pending - len(pending)):
+                        pending[executor.submit(extract_versions, source_type, path, list(versions), blob_cache)] = versions
+                    if not pending:
+                        break
+
+                    done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        versions = pending.pop(future)
+                        for version, data in future.result().items():
+                            for ccm_object in versions[version]:
+                                yield ccm_object, data
+            finally:
+                # stopped early or failed, drop the tasks that did not start
+                for future in pending:
+                    future.cancel()
+
+    def status_timeline(self, ccm_object):
+        """ Parsed status_log of an object, loaded once per session """
+        timeline = self._timelines.get(ccm_object.id)
+        if timeline is None:
+            sql_query = \
+                "SELECT attr.textval " + \
+                "FROM attrib AS attr " + \
+                "WHERE attr.is_attr_of = ? AND attr.name = 'status_log'"
+            rows = self._db.query_sql(sql_query, ccm_object.id)
+            status_log = ccm_utils.deserialize_textval(rows[0][0]) if rows and rows[0][0] else None
+            timeline = StatusTimeline.from_status_log(status_log)
+            self._timelines[ccm_object.id] = timeline
+        return timeline
+
+    def load_status_timelines(self, objects):
+        """ Load the status timelines of many objects in a few queries """
+        cv_ids = list({ccm_object.id for ccm_object in objects if ccm_object.id not in self._timelines})
+        for idx in range(0, len(cv_ids), PREFETCH_CHUNK_SIZE):
+            chunk = cv_ids[idx:idx + PREFETCH_CHUNK_SIZE]
+            sql_query = \
+                "SELECT attr.is_attr_of, attr.textval " + \
+                "FROM attrib AS attr " + \
+                "WHERE attr.is_attr_of IN ({}) AND attr.name = 'status_log'".format(", ".join("?" * len(chunk)))
+            status_logs = {}
+            for cv_id, textval in self._db.query_sql(sql_query, *chunk, stream=True):
+                status_logs[cv_id] = ccm_utils.deserialize_textval(textval) if textval else None
+
+            for cv_id in chunk:
+                self._timelines[cv_id] = StatusTimeline.from_status_log(status_logs.get(cv_id))
+
+    def related_from(self, ccm_object, relation_name, refs=False):
+        cached = self._cached_related('from', ccm_object, relation_name)
+        if cached is not None:
+            return [obj.row for obj in cached] if refs else cached
+
         from_cv = ccm_object.id
         sql_query = \
-            "SELECT cv.id, cv.cvtype " + \
+            "SELECT " + core_columns('cv') + " " + \
             "FROM relate rel INNER JOIN compver cv ON (rel.from_cv = cv.id) " + \
             "WHERE rel.to_cv = ? AND rel.name = ?"
         rows = self._db.query_sql(sql_query, from_cv, relation_name)
-        return [self._construct_object(row[0], row[1]) for row in rows]
+        return self._construct_objects(rows, refs)
+
+    def related_to(self, ccm_object, relation_name, refs=False):
+        cached = self._cached_related('to', ccm_object, relation_name)
+        if cached is not None:
+            return [obj.row for obj in cached] if refs else cached
 
-    def related_to(self, ccm_object, relation_name):
         from_cv = ccm_object.id
         sql_query = \
-            "SELECT cv.id, cv.cvtype " + \
+            "SELECT " + core_columns('cv') + " " + \
             "FROM relate rel INNER JOIN compver cv ON (rel.to_cv = cv.id) " + \
             "WHERE rel.from_cv = ? AND rel.name = ?"
         rows = self._db.query_sql(sql_query, from_cv, relation_name)
-        return [self._construct_object(row[0], row[1]) for row in rows]
+        return self._construct_objects(rows, refs)
 
     def related_all(self, ccm_object):
         relateds = {'from': {}, 'to': {}}
         cv_id = ccm_object.id
 
         sql_query = \
-            "SELECT 'to', rel.name, cv.id, cv.cvtype " + \
+            "SELECT 'to', rel.name, " + core_columns('cv') + " " + \
             "FROM relate rel INNER JOIN compver cv ON (rel.to_cv = cv.id) " + \
             "WHERE rel.from_cv = ? " + \
             "UNION " + \
-            "SELECT 'from', rel.name, cv.id, cv.cvtype " + \
+            "SELECT 'from', rel.name, " + core_columns('cv') + " " + \
             "FROM relate rel INNER JOIN compver cv ON (rel.from_cv = cv.id) " + \
             "WHERE rel.to_cv = ? "
         rows = self._db.query_sql(sql_query, cv_id, cv_id)
         for row in rows:
             direction = row[0]
             rel_name = row[1]
-            ccm_obj = self._construct_object(row[2], row[3])
+            ccm_obj = self._construct_object(row[2:])
             relateds[direction][rel_name] = relateds[direction].get(rel_name, [])
             relateds[direction][rel_name].append(ccm_obj)
 
         return relateds
 
-    def bound_children(self, has_asm, has_parent):
+    def bound_children(self, has_asm, has_parent, refs=False):
         asm_id = has_asm.id
         parent_id = has_parent.id
         sql_query = \
-            "SELECT cv.id, cv.cvtype " + \
+            "SELECT " + core_columns('cv') + " " + \
             "FROM bind INNER JOIN compver cv ON (bind.has_child = cv.id) " + \
             "WHERE has_asm = ? AND has_parent = ?"
         rows = self._db.query_sql(sql_query, asm_id, parent_id)
-        return [self._construct_object(row[0], row[1]) for row in rows]
+        return self._construct_objects(rows, refs)
+
+    def project_structure(self, ccm_project, stream=False):
+        """
+        Members of a project with their path in the project, computed in a single query.
+        Directories are descended into, sub projects are not.
+        Returns a list of (object, path) tuples, with stream an iterator.
+        """
+        project_id = ccm_project.id
+        sql_query = \
+            "WITH RECURSIVE " + structure_cte('tree') + " " + \
+            "SELECT " + core_columns('tree') + ", tree.path " + \
+            "FROM tree"
+        rows = self._db.query_sql(sql_query, project_id, project_id, project_id, stream=stream)
+        strings = {}
+        entries = ((self._construct_object(row[:-1], strings), row[-1]) for row in rows)
+        return entries if stream else list(entries)
+
+    def diff_projects(self, project_a, project_b, stream=False):
+        """
+        Compare the structures of two projects in a single query.
+        Members are matched on (instance, type, name). Each structure is walked once, the members of both
+        are sorted on the match key and paired while reading.
+        Returns a list of ProjectDiffEntry with CcmObjectRefs, with stream an iterator.
+        """
+        id_a, id_b = project_a.id, project_b.id
+        rows = self._db.query_sql(project_diff_query(), id_a, id_a, id_a, id_b, id_b, id_b, stream=stream)
+        entries = self._pair_diff_rows(rows)
+        return entries if stream else list(entries)
+
+    def _pair_diff_rows(self, rows):
+        """ ProjectDiffEntry for rows (side, core columns, path) ordered on the match key """
+        key_indices = [CORE_COLUMNS.index(column) + 1 for column in DIFF_MATCH_COLUMNS]
+        strings = {}
+        for _, group in groupby(rows, key=lambda row: [row[idx] for idx in key_indices]):
+            rows_a, rows_b = [], []
+            for row in group:
+                (rows_b if row[0] else rows_a).append(row)
+            for row_a in rows_a:
+                for row_b in rows_b or [None]:
+                    yield self._construct_diff_entry(row_a, row_b, strings)
+            if not rows_a:
+                for row_b in rows_b:
+                    yield self._construct_diff_entry(None, row_b, strings)
+
+    def _construct_diff_entry(self, row_a, row_b, strings=None):
+        ref_a = self._construct_ref(row_a[1:-1], strings) if row_a is not None else None
+        path_a = row_a[-1] if row_a is not None else None
+        ref_b = self._construct_ref(row_b[1:-1], strings) if row_b is not None else None
+        path_b = row_b[-1] if row_b is not None else None
+
+        if ref_a is None:
+            change = 'added'
+        elif ref_b is None:
+            change = 'removed'
+        elif ref_a.id == ref_b.id:
+            change = 'unchanged'
+        else:
+            change = 'updated'
+        return ProjectDiffEntry(change, ref_a, ref_b, path_a, path_b)
 
     def contents_dir(self, ccm_object):
         dir_id = ccm_object.id
@@ -0,0 +1,50 @@
+# -*- coding: utf-8 -*-
+
+from collections import namedtuple
+
+from ccm_backup_reader import ccm_utils
+
+
+StatusEntry = namedtuple('StatusEntry', ['time', 'status', 'user'])
+
+
+class StatusTimeline:
+    """ Immutable, parsed status_log of an object """
+
+    def __init__(self, entries):
+        self._entries = tuple(StatusEntry._make(entry) for entry in entries)
+
+        # last time each status was set
+        self._status_times = {}
+        for entry in self._entries:
+            self._status_times[entry.status] = entry.time
+
+    @classmethod
+    def from_status_log(cls, status_log):
+        if not status_log:
+            return cls([])
+        return cls(ccm_utils.parse_status_log(status_log))
+
+    @property
+    def entries(self):
+        return self._entries
+
+    @property
+    def status(self):
+        """ Current status, None for an empty timeline """
+        if not self._entries:
+            return None
+        return self._entries[-1].status
+
+    def status_time(self, status):
+        """ Last time the status was set, None if it never was """
+        return self._status_times.get(status)
+
+    def __iter__(self):
+        return iter(self._entries)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __repr__(self):
+        return "<{}({})>".format(type(self).__name__, list(self._entries))
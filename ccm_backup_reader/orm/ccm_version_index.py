@@ -0,0 +1,173 @@
+# -*- coding: utf-8 -*-
+
+import sqlite3
+from bisect import bisect_right
+from collections import defaultdict
+from datetime import datetime
+
+from ccm_backup_reader import ccm_utils
+from ccm_backup_reader.ccm_error import CcmError
+from ccm_backup_reader.orm.ccm_status_timeline import StatusTimeline
+
+
+# Table holding a persisted index in the backup database
+VERSION_INDEX_TABLE = 'ccm_version_index'
+
+# One row table holding the fingerprint of the status logs the persisted index was built from
+FINGERPRINT_TABLE = 'ccm_version_index_fingerprint'
+
+# Open profile of the sessions allowed to persist the index, the others may open the database immutable
+PERSIST_PROFILE = 'default'
+
+# Format of the times in the persisted table, sortable text
+PERSISTED_TIME_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+# Statuses of versions taking part in the index
+INDEXED_STATUSES = ('integrate', 'released')
+
+
+def version_time(timeline):
+    """ Time a version became current: its integrate time, or its release time when never integrated """
+    if timeline.status not in INDEXED_STATUSES:
+        return None
+    return timeline.status_time('integrate') or timeline.status_time('released')
+
+
+class VersionIndex:
+    """
+    Versions of each partial name, keyed by (subsystem, cvtype, name), sorted by the time they became current.
+    Only versions with status integrate or released are indexed.
+    """
+
+    def __init__(self, entries, fingerprint=None):
+        """
+        Build the index from (subsystem, cvtype, name, time, cv_id) entries.
+        fingerprint identifies the status logs the entries were read from, see fingerprint().
+        """
+        self._fingerprint = fingerprint
+        versions = defaultdict(list)
+        for subsystem, cvtype, name, time, cv_id in entries:
+            versions[(subsystem, cvtype, name)].append((time, cv_id))
+
+        self._times = {}
+        self._cv_ids = {}
+        for key, key_versions in versions.items():
+            key_versions.sort()
+            self._times[key] = [time for time, _ in key_versions]
+            self._cv_ids[key] = [cv_id for _, cv_id in key_versions]
+
+    @classmethod
+    def from_db(cls, ccm_db):
+        """
+        Build the index from the status logs, or load it when persisted in the database from the same status logs.
+        """
+        fingerprint = cls.fingerprint(ccm_db)
+        if cls._persisted_fingerprint(ccm_db) == fingerprint:
+            return cls.load(ccm_db, fingerprint)
+
+        sql_query = \
+            "SELECT cv.subsystem, cv.cvtype, cv.name, cv.id, attr.textval " + \
+            "FROM compver cv INNER JOIN attrib attr ON (attr.is_attr_of = cv.id AND attr.name = 'status_log')"
+        return cls(cls._entries_from_rows(ccm_db.query_sql(sql_query, stream=True)), fingerprint)
+
+    @staticmethod
+    def fingerprint(ccm_db):
+        """ (count, highest id, latest modify_time) of the status_log attribs, a refreshed backup changes it """
+        sql_query = \
+            "SELECT COUNT(*), MAX(id), MAX(modify_time) " + \
+            "FROM attrib " + \
+            "WHERE name = 'status_log'"
+        return tuple(ccm_db.query_sql(sql_query)[0])
+
+    @staticmethod
+    def _entries_from_rows(rows):
+        for subsystem, cvtype, name, cv_id, textval in rows:
+            status_log = ccm_utils.deserialize_textval(textval) if textval else None
+            time = version_time(StatusTimeline.from_status_log(status_log))
+            if time is not None:
+                yield subsystem, cvtype, name, time, cv_id
+
+    @classmethod
+    def is_persisted(cls, ccm_db):
+        """ Whether the database holds an index built from its current status logs """
+        return cls._persisted_fingerprint(ccm_db) == cls.fingerprint(ccm_db)
+
+    @staticmethod
+    def _persisted_fingerprint(ccm_db):
+        """ Fingerprint stored with the persisted index, None when there is none """
+        sql_query = \
+            "SELECT COUNT(*) " + \
+            "FROM sqlite_master " + \
+            "WHERE type = 'table' AND name IN (?, ?)"
+        if ccm_db.query_sql(sql_query, VERSION_INDEX_TABLE, FINGERPRINT_TABLE)[0][0] != 2:
+            return None
+        rows = ccm_db.query_sql("SELECT status_logs, max_id, max_modify_time FROM " + FINGERPRINT_TABLE)
+        return tuple(rows[0]) if rows else None
+
+    @classmethod
+    def load(cls, ccm_db, fingerprint=None):
+        sql_query = \
+            "SELECT subsystem, cvtype, name, time, cv_id " + \
+            "FROM " + VERSION_INDEX_TABLE
+        rows = ccm_db.query_sql(sql_query, stream=True)
+        return cls(((subsystem, cvtype, name, datetime.strptime(time, PERSISTED_TIME_FORMAT), cv_id)
+                    for subsystem, cvtype, name, time, cv_id in rows), fingerprint)
+
+    def save(self, ccm_db):
+        """
+        Persist the index in the backup database of ccm_db, replacing a previous one, with the fingerprint of the
+        status logs it was built from. This opens its own writable connection, so it is refused unless ccm_db uses
+        the default open profile: the others open the database immutable or read a copy in memory.
+        """
+        if ccm_db.profile != PERSIST_PROFILE:
+            raise CcmError("The version index can only be persisted with the '{}' open profile, not '{}'".format(
+                PERSIST_PROFILE, ccm_db.profile))
+        fingerprint = self._fingerprint if self._fingerprint is not None else self.fingerprint(ccm_db)
+
+        connection = sqlite3.connect(ccm_db.db_path)
+        try:
+            with connection:
+                connection.execute("DROP TABLE IF EXISTS " + VERSION_INDEX_TABLE)
+                connection.execute("DROP TABLE IF EXISTS " + FINGERPRINT_TABLE)
+                connection.execute(
+                    "CREATE TABLE " + VERSION_INDEX_TABLE + " (subsystem TEXT, cvtype TEXT, name TEXT, time TEXT, cv_id INTEGER)")
+                connection.executemany(
+                    "INSERT INTO " + VERSION_INDEX_TABLE + " (subsystem, cvtype, name, time, cv_id) VALUES (?, ?, ?, ?, ?)",
+                    self._rows())
+                connection.execute(
+                    "CREATE INDEX " + VERSION_INDEX_TABLE + "_key ON " + VERSION_INDEX_TABLE + " (subsystem, cvtype, name, time)")
+                connection.execute(
+                    "CREATE TABLE " + FINGERPRINT_TABLE + " (status_logs INTEGER, max_id INTEGER, max_modify_time INTEGER)")
+                connection.execute(
+                    "INSERT INTO " + FINGERPRINT_TABLE + " (status_logs, max_id, max_modify_time) VALUES (?, ?, ?)",
+                    fingerprint)
+        finally:
+            connection.close()
+
+    def _rows(self):
+        """ Rows of the persisted table """
+        for key, times in self._times.items():
+            subsystem, cvtype, name = key
+            for time, cv_id in zip(times, self._cv_ids[key]):
+                yield subsystem, cvtype, name, time.strftime(PERSISTED_TIME_FORMAT), cv_id
+
+    def __len__(self):
+        return len(self._times)
+
+    def __contains__(self, key):
+        return key in self._times
+
+    def versions(self, key):
+        """ (time, cv_id) of the versions of a partial name, in time order """
+        return list(zip(self._times.get(key, []), self._cv_ids.get(key, [])))
+
+    def version_at(self, key, timestamp):
+        """
+        cv_id of the version current at timestamp: the last version at or before it,
+        or the first version after it when there is none before. None for an unknown partial name.
+        """
+        times = self._times.get(key)
+        if not times:
+            return None
+        idx = bisect_right(times, timestamp) - 1
+        return self._cv_ids[key][max(idx, 0)]
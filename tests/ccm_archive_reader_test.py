@@ -0,0 +1,251 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import os.path
+import zipfile
+from io import BytesIO
+
+import pytest
+
+from ccm_backup_reader.ccm_archive_reader import CcmArchiveReader
+from ccm_backup_reader.ccm_blob_cache import CcmBlobCache
+from ccm_backup_reader.ccm_error import CcmError
+from ccm_backup_reader.ccm_lru_cache import LruCache
+from conftest import create_archive
+
+
+def version_data(idx):
+    lines = [b'line %d\n' % line for line in range(20)]
+    lines[idx % 20] = b'changed in version %d\n' % idx
+    return b''.join(lines) + b'version %d\n' % idx
+
+
+@pytest.fixture
+def archive_path(tmpdir):
+    # linear history 1..30, with a branch 10 -> 10.1.1
+    versions = [('main.c/1', None, version_data(1))]
+    for idx in range(2, 31):
+        versions.append(('main.c/{}'.format(idx), 'main.c/{}'.format(idx - 1), version_data(idx)))
+    versions.append(('main.c/10.1.1', 'main.c/10', b'branch\n'))
+
+    path = os.path.join(str(tmpdir), 'main.c')
+    create_archive(path, versions)
+    return path
+
+
+class TestCcmArchiveReader:
+
+    def test_extract_root(self, archive_path):
+        reader = CcmArchiveReader(archive_path)
+        assert reader.extract('main.c/1') == version_data(1)
+
+    def test_extract_chain(self, archive_path):
+        reader = CcmArchiveReader(archive_path)
+        for idx in (2, 17, 30):
+            assert reader.extract('main.c/{}'.format(idx)) == version_data(idx)
+        assert reader.extract('main.c/10.1.1') == b'branch\n'
+
+    def test_versions(self, archive_path):
+        reader = CcmArchiveReader(archive_path)
+        assert reader.versions[0] == 'main.c/1'
+        assert reader.versions[-1] == 'main.c/10.1.1'
+        assert len(reader.versions) == 31
+
+    def test_chain_entries(self, archive_path):
+        reader = CcmArchiveReader(archive_path)
+        entries = reader._find_entries_to_entry('main.c/10.1.1')
+        assert [entry['fullName'] for entry in entries] == ['main.c/10.1.1'] + ['main.c/{}'.format(idx) for idx in range(10, 0, -1)]
+        assert reader._find_entry_with_predecessor('main.c/29')['fullName'] == 'main.c/30'
+
+    def test_iter_versions(self, archive_path):
+        reader = CcmArchiveReader(archive_path, cache=None)
+        versions = dict(reader.iter_versions())
+        assert len(versions) == 31
+        for idx in range(1, 31):
+            assert versions['main.c/{}'.format(idx)] == version_data(idx)
+        assert versions['main.c/10.1.1'] == b'branch\n'
+
+    def test_iter_versions_missing_root(self, tmpdir):
+        path = os.path.join(str(tmpdir), 'broken.c')
+        create_archive(path, [('broken.c/1', None, b'one\n'), ('broken.c/2', 'broken.c/1', b'two\n')])
+        reader = CcmArchiveReader(path, cache=None)
+        del reader._entries['broken.c/1']
+        reader._full_names.remove('broken.c/1')
+        del reader._successors['broken.c/1']
+        with pytest.raises(CcmError):
+            list(reader.iter_versions())
+
+    @pytest.mark.parametrize('memory_size', [1 << 20, 0])
+    def test_extract_to(self, archive_path, monkeypatch, memory_size):
+        # with a memory size of 0 the predecessors are reconstructed in mmapped temporary files
+        monkeypatch.setattr('ccm_backup_reader.ccm_archive_reader.EXTRACT_TO_MEMORY_SIZE', memory_size)
+        reader = CcmArchiveReader(archive_path, cache=None)
+        for version in ('main.c/1', 'main.c/2', 'main.c/30', 'main.c/10.1.1'):
+            fileobj = BytesIO()
+            reader.extract_to(version, fileobj)
+            assert fileobj.getvalue() == reader.extract(version)
+
+    def test_extract_to_empty(self, tmpdir, monkeypatch):
+        monkeypatch.setattr('ccm_backup_reader.ccm_archive_reader.EXTRACT_TO_MEMORY_SIZE', 0)
+        path = os.path.join(str(tmpdir), 'empty.c')
+        create_archive(path, [('empty.c/1', None, b''), ('empty.c/2', 'empty.c/1', b''), ('empty.c/3', 'empty.c/2', b'three\n')])
+        reader = CcmArchiveReader(path, cache=None)
+        fileobj = BytesIO()
+        reader.extract_to('empty.c/3', fileobj)
+        assert fileobj.getvalue() == b'three\n'
+
+    @pytest.mark.parametrize('version', ['corrupt.c/2', 'corrupt.c/3'])
+    def test_extract_to_corrupt_patch(self, tmpdir, monkeypatch, version):
+        # the mmap of the source must still be closed, the patch error is reported
+        monkeypatch.setattr('ccm_backup_reader.ccm_archive_reader.EXTRACT_TO_MEMORY_SIZE', 0)
+        path = os.path.join(str(tmpdir), 'corrupt.c')
+        create_archive(path, [('corrupt.c/1', None, b'one\n'), ('corrupt.c/2', 'corrupt.c/1', b'two\n'),
+                              ('corrupt.c/3', 'corrupt.c/2', b'three\n')])
+        with zipfile.ZipFile(path) as zip_file:
+            contents = {name: zip_file.read(name) for name in zip_file.namelist()}
+        contents['corrupt.c/2'] = b'\xff\xff\xff\xff'
+        with zipfile.ZipFile(path, 'w') as zip_file:
+            for name, content in contents.items():
+                zip_file.writestr(name, content)
+
+        reader = CcmArchiveReader(path, cache=None)
+        with pytest.raises(CcmError):
+            reader.extract_to(version, BytesIO())
+
+    def test_composed_chain(self, archive_path, monkeypatch):
+        monkeypatch.setattr('ccm_backup_reader.ccm_archive_reader.COMPOSE_MIN_CHAIN', 5)
+        monkeypatch.setattr('ccm_backup_reader.ccm_archive_reader.COMPOSE_MIN_SIZE', 0)
+        reader = CcmArchiveReader(archive_path, cache=None)
+        assert reader.extract('main.c/30') == version_data(30)
+        assert reader.extract('main.c/10.1.1') == b'branch\n'
+
+    def test_unknown_version(self, archive_path):
+        reader = CcmArchiveReader(archive_path)
+        with pytest.raises(CcmError):
+            reader.extract('main.c/99')
+
+
+class TestVersionCache:
+
+    @staticmethod
+    def counting_reader(archive_path, cache):
+        reader = CcmArchiveReader(archive_path, cache=cache)
+        reader.patch_count = 0
+        apply_patch = reader._apply_patch
+
+        def counting_apply_patch(source, patch):
+            reader.patch_count += 1
+            return apply_patch(source, patch)
+
+        reader._apply_patch = counting_apply_patch
+        return reader
+
+    def test_consecutive_versions(self, archive_path):
+        cache = LruCache(1 << 20, weigher=len)
+        reader = self.counting_reader(archive_path, cache)
+        assert reader.extract('main.c/20') == version_data(20)
+        assert reader.patch_count == 19
+
+        assert reader.extract('main.c/21') == version_data(21)
+        assert reader.patch_count == 20
+
+        assert reader.extract('main.c/21') == version_data(21)
+        assert reader.patch_count == 20
+        assert reader.cache_stats()['hits'] == 2
+
+    def test_shared_between_readers(self, archive_path):
+        cache = LruCache(1 << 20, weigher=len)
+        self.counting_reader(archive_path, cache).extract('main.c/10')
+
+        reader = self.counting_reader(archive_path, cache)
+        assert reader.extract('main.c/10.1.1') == b'branch\n'
+        assert reader.patch_count == 1
+
+    def test_intermediate_versions_cached(self, archive_path, monkeypatch):
+        monkeypatch.setattr('ccm_backup_reader.ccm_archive_reader.VERSION_CACHE_INTERVAL', 4)
+        cache = LruCache(1 << 20, weigher=len)
+        reader = self.counting_reader(archive_path, cache)
+        reader.extract('main.c/30')
+        reader.patch_count = 0
+        assert reader.extract('main.c/10.1.1') == b'branch\n'
+        # from main.c/9, the fullName at index 8 in the chain
+        assert reader.patch_count == 2
+
+    def test_budget(self, archive_path):
+        cache = LruCache(len(version_data(1)) + 1, weigher=len)
+        reader = CcmArchiveReader(archive_path, cache=cache)
+        reader.extract('main.c/5')
+        reader.extract('main.c/6')
+        assert len(cache) == 1
+        assert cache.weight <= cache.capacity
+
+    def test_iter_versions_single_walk(self, archive_path):
+        cache = LruCache(1 << 20, weigher=len)
+        reader = self.counting_reader(archive_path, cache)
+        assert len(list(reader.iter_versions())) == 31
+        assert reader.patch_count == 30
+        assert len(cache) == 0
+
+    def test_extract_to_cached(self, archive_path):
+        cache = LruCache(1 << 20, weigher=len)
+        reader = self.counting_reader(archive_path, cache)
+        reader.extract('main.c/20')
+        reader.patch_count = 0
+
+        fileobj = BytesIO()
+        reader.extract_to('main.c/20', fileobj)
+        assert fileobj.getvalue() == version_data(20)
+        fileobj = BytesIO()
+        reader.extract_to('main.c/21', fileobj)
+        assert fileobj.getvalue() == version_data(21)
+        assert reader.patch_count == 0
+
+    def test_no_cache(self, archive_path):
+        reader = self.counting_reader(archive_path, None)
+        reader.extract('main.c/5')
+        reader.extract('main.c/5')
+        assert reader.patch_count == 8
+        assert reader.cache_stats() is None
+
+
+class TestBlobCache:
+
+    @staticmethod
+    def counting_reader(archive_path, blob_cache):
+        reader = TestVersionCache.counting_reader(archive_path, None)
+        reader._blob_cache = blob_cache
+        return reader
+
+    def test_extract(self, archive_path, tmpdir):
+        blob_cache = CcmBlobCache(os.path.join(str(tmpdir), 'blobs'))
+        reader = self.counting_reader(archive_path, blob_cache)
+        assert reader.extract('main.c/20') == version_data(20)
+        assert reader.patch_count == 19
+
+        # a new run
+        reader = self.counting_reader(archive_path, CcmBlobCache(blob_cache.directory))
+        assert reader.extract('main.c/20') == version_data(20)
+        fileobj = BytesIO()
+        reader.extract_to('main.c/20', fileobj)
+        assert fileobj.getvalue() == version_data(20)
+        assert reader.patch_count == 0
+
+    def test_iter_versions(self, archive_path, tmpdir):
+        blob_cache = CcmBlobCache(os.path.join(str(tmpdir), 'blobs'))
+        reader = self.counting_reader(archive_path, blob_cache)
+        first = dict(reader.iter_versions())
+        assert reader.patch_count == 30
+
+        reader = self.counting_reader(archive_path, blob_cache)
+        assert dict(reader.iter_versions()) == first
+        assert reader.patch_count == 0
+
+    def test_archive_changed(self, archive_path, tmpdir):
+        blob_cache = CcmBlobCache(os.path.join(str(tmpdir), 'blobs'))
+        CcmArchiveReader(archive_path, cache=None, blob_cache=blob_cache).extract('main.c/5')
+
+        stat = os.stat(archive_path)
+        os.utime(archive_path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+        reader = self.counting_reader(archive_path, blob_cache)
+        assert reader.extract('main.c/5') == version_data(5)
+        assert reader.patch_count == 4
@@ -0,0 +1,105 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import os
+import os.path
+import pickle
+import sqlite3
+
+import pytest
+
+from ccm_backup_reader import ccm_blob_cache
+from ccm_backup_reader.ccm_blob_cache import CcmBlobCache
+
+
+@pytest.fixture
+def cache_dir(tmpdir):
+    return os.path.join(str(tmpdir), 'blobs')
+
+
+class TestCcmBlobCache:
+
+    def test_put_get(self, cache_dir):
+        cache = CcmBlobCache(cache_dir)
+        cache.put('/st_root/main.c,v', 'main.c/1', 100, b'one\n')
+        assert cache.get('/st_root/main.c,v', 'main.c/1', 100) == b'one\n'
+        assert cache.get('/st_root/main.c,v', 'main.c/1', 200) is None
+        assert cache.get('/st_root/main.c,v', 'main.c/2', 100) is None
+        assert cache.versions('/st_root/main.c,v', 100) == {'main.c/1'}
+
+    def test_content_addressed(self, cache_dir):
+        cache = CcmBlobCache(cache_dir)
+        cache.put('/st_root/a.c,v', 'a.c/1', 100, b'same\n')
+        cache.put('/st_root/b.c,v', 'b.c/1', 100, b'same\n')
+        assert cache.stats()['versions'] == 2
+        assert cache.stats()['blobs'] == 1
+
+    def test_persistent(self, cache_dir):
+        CcmBlobCache(cache_dir).put('/st_root/main.c,v', 'main.c/1', 100, b'one\n')
+        assert CcmBlobCache(cache_dir).get('/st_root/main.c,v', 'main.c/1', 100) == b'one\n'
+
+    def test_eviction(self, cache_dir):
+        cache = CcmBlobCache(cache_dir, size_budget=10)
+        cache.put('/st_root/main.c,v', 'main.c/1', 100, b'11111')
+        cache.put('/st_root/main.c,v', 'main.c/2', 100, b'22222')
+        cache.get('/st_root/main.c,v', 'main.c/1', 100)
+        cache.put('/st_root/main.c,v', 'main.c/3', 100, b'33333')
+        assert cache.versions('/st_root/main.c,v', 100) == {'main.c/1', 'main.c/3'}
+        assert cache.stats()['size'] <= 10
+
+    def test_access_times_batched(self, cache_dir, monkeypatch):
+        monkeypatch.setattr(ccm_blob_cache, 'ACCESS_TIME_BATCH', 2)
+        clock = iter(range(1, 100))
+        monkeypatch.setattr(ccm_blob_cache.time, 'time', lambda: next(clock))
+        cache = CcmBlobCache(cache_dir)
+        cache.put('/st_root/main.c,v', 'main.c/1', 100, b'one\n')
+        cache.put('/st_root/main.c,v', 'main.c/2', 100, b'two\n')
+        assert self.access_times(cache_dir) == [1, 2]
+
+        cache.get('/st_root/main.c,v', 'main.c/1', 100)
+        assert self.access_times(cache_dir) == [1, 2]
+        cache.get('/st_root/main.c,v', 'main.c/2', 100)
+        assert self.access_times(cache_dir) == [3, 4]
+
+        cache.get('/st_root/main.c,v', 'main.c/1', 100)
+        cache.close()
+        assert self.access_times(cache_dir) == [4, 5]
+
+    @staticmethod
+    def access_times(cache_dir):
+        connection = sqlite3.connect(os.path.join(cache_dir, ccm_blob_cache.INDEX_NAME))
+        try:
+            return [row[0] for row in connection.execute("SELECT access_time FROM blobs ORDER BY access_time")]
+        finally:
+            connection.close()
+
+    def test_total_size(self, cache_dir):
+        cache = CcmBlobCache(cache_dir, size_budget=10)
+        cache.put('/st_root/a.c,v', 'a.c/1', 100, b'1111')
+        cache.put('/st_root/b.c,v', 'b.c/1', 100, b'1111')
+        assert cache.stats()['size'] == 4
+        cache.put('/st_root/a.c,v', 'a.c/2', 100, b'222')
+        cache.put('/st_root/a.c,v', 'a.c/3', 100, b'33333')
+        assert cache.stats()['size'] == 8
+        assert CcmBlobCache(cache_dir).stats()['size'] == 8
+
+    def test_too_large(self, cache_dir):
+        cache = CcmBlobCache(cache_dir, size_budget=4)
+        cache.put('/st_root/main.c,v', 'main.c/1', 100, b'11111')
+        assert cache.get('/st_root/main.c,v', 'main.c/1', 100) is None
+
+    def test_missing_blob(self, cache_dir):
+        cache = CcmBlobCache(cache_dir)
+        cache.put('/st_root/main.c,v', 'main.c/1', 100, b'one\n')
+        for directory, _, names in os.walk(os.path.join(cache_dir, 'blobs')):
+            for name in names:
+                os.unlink(os.path.join(directory, name))
+        assert cache.get('/st_root/main.c,v', 'main.c/1', 100) is None
+        assert cache.stats()['versions'] == 0
+
+    def test_pickle(self, cache_dir):
+        cache = CcmBlobCache(cache_dir, size_budget=1000)
+        cache.put('/st_root/main.c,v', 'main.c/1', 100, b'one\n')
+        copy = pickle.loads(pickle.dumps(cache))
+        assert copy.size_budget == 1000
+        assert copy.get('/st_root/main.c,v', 'main.c/1', 100) == b'one\n'
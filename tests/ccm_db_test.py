@@ -0,0 +1,173 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import os
+import sqlite3
+
+import pytest
+
+from ccm_backup_reader import CcmDb
+from ccm_backup_reader.ccm_archive_reader import CcmArchiveReaderCache
+from ccm_backup_reader.ccm_db import OPEN_PROFILES
+from ccm_backup_reader.ccm_error import CcmError
+from ccm_backup_reader.orm import CcmOrm
+
+
+class TestOpenProfiles:
+
+    @pytest.mark.parametrize('profile', sorted(OPEN_PROFILES.keys()))
+    def test_open(self, backup_path, profile):
+        db = CcmDb(backup_path, profile=profile)
+        assert db.profile == profile
+        assert db.delim() == '~'
+
+    @pytest.mark.parametrize('profile', ['readonly-fast', 'in-memory'])
+    def test_query_only(self, backup_path, profile):
+        db = CcmDb(backup_path, profile=profile)
+        with pytest.raises(sqlite3.DatabaseError):
+            db.query_sql("DELETE FROM compver")
+
+    def test_in_memory_without_backup(self, backup_path, monkeypatch):
+        # Python before 3.7 has no Connection.backup
+        connect = sqlite3.connect
+
+        class NoBackupConnection:
+
+            def __init__(self, connection):
+                self.iterdump = connection.iterdump
+                self.close = connection.close
+
+        def no_backup_connect(database, *args, **kwargs):
+            connection = connect(database, *args, **kwargs)
+            return connection if database == ':memory:' else NoBackupConnection(connection)
+
+        monkeypatch.setattr(sqlite3, 'connect', no_backup_connect)
+        db = CcmDb(backup_path, profile='in-memory')
+        assert db.delim() == '~'
+
+    def test_unknown_profile(self, backup_path):
+        with pytest.raises(CcmError):
+            CcmDb(backup_path, profile='unknown')
+
+
+class TestStreaming:
+
+    def test_query_stream(self, backup_path):
+        db = CcmDb(backup_path)
+        rows = db.query("type='csrc'", stream=True)
+        assert not isinstance(rows, list)
+
+        rows = list(rows)
+        assert sorted(row.cvid for row in rows) == [10, 11, 12, 13, 14]
+        assert rows[0].objectname == rows[0][1]
+        assert [dict(row._asdict()) for row in rows] == db.query("type='csrc'")
+
+    def test_query_sql_stream(self, backup_path):
+        db = CcmDb(backup_path)
+        rows = db.query_sql("SELECT id FROM compver WHERE cvtype = ? ORDER BY id", 'csrc', stream=True)
+        assert list(rows) == [(10, ), (11, ), (12, ), (13, ), (14, )]
+
+
+class TestQuery:
+
+    def test_query_function(self, backup_path):
+        db = CcmDb(backup_path)
+        rows = db.query("type='csrc' and is_member_of('proj~2:project:1')")
+        assert sorted(row['objectname'] for row in rows) == ['main.c~3:csrc:1', 'util.c~1:csrc:1']
+
+    def test_query_status(self, backup_path):
+        db = CcmDb(backup_path)
+        rows = db.query("name='main.c' and not status='integrate'")
+        assert [(row['objectname'], row['status']) for row in rows] == [('main.c~2.1.1:csrc:1', 'working')]
+
+    def test_query_without_status_log(self, backup_path):
+        # objects without a status_log attrib are returned, with status None, unless status is tested
+        db = CcmDb(backup_path)
+        rows = db.query("type='model'")
+        assert [(row['objectname'], row['status']) for row in rows] == [('base~1:model:base', None)]
+        assert db.query("type='model' and status='integrate'") == []
+        assert db.query("type='model' and not status='integrate'") == []
+
+    def test_query_columns(self, backup_path):
+        db = CcmDb(backup_path)
+        rows = list(db.query("name='README'", stream=True, columns=['objectname']))
+        assert rows[0].objectname == 'README~1:ascii:1'
+        assert rows[0].status is None
+
+    def test_query_hist_successor_of(self, backup_path):
+        db = CcmDb(backup_path)
+        rows = db.query("is_hist_successor_of('main.c~1:csrc:1')")
+        assert sorted(row['objectname'] for row in rows) == ['main.c~2.1.1:csrc:1', 'main.c~2:csrc:1', 'main.c~3:csrc:1']
+
+    def test_query_hist_predecessor_of(self, backup_path):
+        db = CcmDb(backup_path)
+        rows = db.query("is_hist_predecessor_of('main.c~3:csrc:1') and status='integrate'")
+        assert sorted(row['objectname'] for row in rows) == ['main.c~1:csrc:1', 'main.c~2:csrc:1']
+
+    def test_query_recursive_member_of(self, backup_path):
+        db = CcmDb(backup_path)
+        rows = db.query("is_recursive_member_of('proj~2:project:1')")
+        assert sorted(row['cvid'] for row in rows) == [12, 14, 15, 21, 42]
+
+        rows = db.query("is_member_of('proj~2:project:1')")
+        assert sorted(row['cvid'] for row in rows) == [12, 14, 21, 42]
+
+    def test_explain(self, backup_path):
+        db = CcmDb(backup_path)
+        sql_query, params, query_plan = db.explain("is_successor_of('main.c~2:csrc:1')")
+        assert params == ['~', 'main.c', '2', 'csrc', '1']
+        assert query_plan
+
+
+def is_closed(reader):
+    return reader._zip_file.fp is None
+
+
+class TestArchiveReaders:
+
+    def test_reader_shared(self, backup_path, st_root_archives):
+        db = CcmDb(backup_path, archive_readers=CcmArchiveReaderCache())
+        with db.archive_reader('1/csrc/main.c,v') as reader:
+            with db.archive_reader('1/csrc/main.c,v') as other:
+                assert other is reader
+            assert reader.extract('1/csrc/main.c/3') == b'one\ntwo\nthree\n'
+
+    def test_reader_replaced_on_mtime(self, backup_path, st_root_archives):
+        db = CcmDb(backup_path, archive_readers=CcmArchiveReaderCache())
+        with db.archive_reader('1/csrc/main.c,v') as reader:
+            archive_path = os.path.join(backup_path, 'st_root', '1', 'csrc', 'main.c,v')
+            stat = os.stat(archive_path)
+            os.utime(archive_path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+            with db.archive_reader('1/csrc/main.c,v') as other:
+                assert other is not reader
+            # still leased, not closed yet
+            assert reader.extract('1/csrc/main.c/3') == b'one\ntwo\nthree\n'
+        assert is_closed(reader)
+
+    def test_evicted_reader_closed(self, backup_path, st_root_archives):
+        db = CcmDb(backup_path, archive_readers=CcmArchiveReaderCache(capacity=1))
+        with db.archive_reader('1/csrc/main.c,v') as reader:
+            pass
+        assert not is_closed(reader)
+        with db.archive_reader('1/csrc/util.c,v') as other:
+            assert is_closed(reader)
+        assert not is_closed(other)
+
+    def test_clear_closes_readers(self, backup_path, st_root_archives):
+        archive_readers = CcmArchiveReaderCache()
+        db = CcmDb(backup_path, archive_readers=archive_readers)
+        with db.archive_reader('1/csrc/main.c,v') as reader:
+            archive_readers.clear()
+            assert not is_closed(reader)
+        assert is_closed(reader)
+
+    def test_missing_archive(self, backup_path):
+        db = CcmDb(backup_path, archive_readers=CcmArchiveReaderCache())
+        with pytest.raises(CcmError):
+            with db.archive_reader('1/csrc/missing.c,v'):
+                pass
+
+    def test_file_data(self, backup_path, st_root_archives):
+        db = CcmDb(backup_path, archive_readers=CcmArchiveReaderCache())
+        obj = CcmOrm(db).object_by_id(12)
+        assert obj.data == b'one\ntwo\nthree\n'
@@ -0,0 +1,86 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import pytest
+
+from ccm_backup_reader import CcmDb
+from ccm_backup_reader.ccm_error import CcmError
+from ccm_backup_reader.orm import CcmOrm
+from ccm_backup_reader.orm.ccm_history_graph import HistoryGraph
+
+
+#        /- 103 -\
+# 100 - 101       105 - 106
+#        \- 104 -/
+#         \- 107
+EDGES = [
+    (100, 101),
+    (101, 103),
+    (101, 104),
+    (103, 105),
+    (104, 105),
+    (105, 106),
+    (104, 107),
+]
+
+
+class TestHistoryGraph:
+
+    def test_neighbours(self):
+        graph = HistoryGraph(EDGES)
+        assert len(graph) == 7
+        assert graph.edge_count == 7
+        assert sorted(graph.successors(101)) == [103, 104]
+        assert sorted(graph.predecessors(105)) == [103, 104]
+        assert graph.successors(106) == []
+        assert graph.successors(999) == []
+        assert 999 not in graph
+
+    def test_chunked_sort(self, monkeypatch):
+        monkeypatch.setattr('ccm_backup_reader.orm.ccm_history_graph.SORT_CHUNK_SIZE', 3)
+        graph = HistoryGraph(EDGES)
+        assert list(graph._cv_ids) == [100, 101, 103, 104, 105, 106, 107]
+        assert sorted(graph.successors(101)) == [103, 104]
+        assert sorted(graph.predecessors(105)) == [103, 104]
+
+    def test_descendants(self):
+        graph = HistoryGraph(EDGES)
+        assert sorted(graph.descendants(101)) == [103, 104, 105, 106, 107]
+        assert graph.descendants(106) == []
+
+    def test_ancestors(self):
+        graph = HistoryGraph(EDGES)
+        assert sorted(graph.ancestors(105)) == [100, 101, 103, 104]
+
+    def test_topological_order(self):
+        graph = HistoryGraph(EDGES)
+        order = graph.topological_order()
+        assert sorted(order) == [100, 101, 103, 104, 105, 106, 107]
+        for from_cv, to_cv in EDGES:
+            assert order.index(from_cv) < order.index(to_cv)
+
+        assert graph.topological_order([106, 100, 104]) == [100, 104, 106]
+
+    def test_cycle(self):
+        graph = HistoryGraph(EDGES + [(106, 100)])
+        with pytest.raises(CcmError):
+            graph.topological_order()
+        assert sorted(graph.descendants(100)) == [100, 101, 103, 104, 105, 106, 107]
+
+    def test_common_ancestors(self):
+        graph = HistoryGraph(EDGES)
+        assert graph.common_ancestors(103, 107) == {100, 101}
+        assert graph.lowest_common_ancestors(103, 107) == {101}
+        assert graph.lowest_common_ancestors(104, 107) == {104}
+
+    def test_between(self):
+        graph = HistoryGraph(EDGES)
+        assert sorted(graph.between(100, 105)) == [101, 103, 104]
+        assert graph.between(103, 107) == []
+
+    def test_from_db(self, backup_path):
+        orm = CcmOrm(CcmDb(backup_path))
+        graph = orm.history_graph()
+        assert orm.history_graph() is graph
+        assert sorted(graph.descendants(10)) == [11, 12, 13]
+        assert graph.successors(40) == [41]
@@ -0,0 +1,56 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+
+from ccm_backup_reader.ccm_lru_cache import LruCache
+
+
+class TestLruCache:
+
+    def test_evicts_least_recently_used(self):
+        cache = LruCache(2)
+        cache.put('a', 1)
+        cache.put('b', 2)
+        assert cache.get('a') == 1
+        cache.put('c', 3)
+        assert 'a' in cache
+        assert 'b' not in cache
+        assert 'c' in cache
+        assert cache.evictions == 1
+
+    def test_weigher(self):
+        cache = LruCache(10, weigher=len)
+        cache.put('a', b'12345')
+        cache.put('b', b'123456')
+        assert 'a' not in cache
+        assert cache.weight == 6
+
+        cache.put('c', b'12345678901')
+        assert 'c' not in cache
+        assert cache.weight == 6
+
+    def test_stats(self):
+        cache = LruCache(2)
+        cache.put('a', 1)
+        cache.get('a')
+        cache.get('b')
+        stats = cache.stats()
+        assert stats['hits'] == 1
+        assert stats['misses'] == 1
+        assert stats['entries'] == 1
+
+    def test_on_evict(self):
+        dropped = []
+        cache = LruCache(1, weigher=len, on_evict=lambda key, value: dropped.append((key, value)))
+        cache.put('a', 'x')
+        cache.put('a', 'y')
+        assert dropped == [('a', 'x')]
+        cache.put('b', 'z')
+        assert dropped == [('a', 'x'), ('a', 'y')]
+        cache.put('c', 'too large')
+        assert dropped[-1] == ('c', 'too large')
+        assert cache.pop('b') == 'z'
+        cache.put('d', 'w')
+        cache.clear()
+        assert dropped[-1] == ('d', 'w')
+        assert len(dropped) == 4
@@ -0,0 +1,335 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import os.path
+from datetime import datetime
+
+import pytest
+
+from ccm_backup_reader import CcmDb
+from ccm_backup_reader.ccm_blob_cache import CcmBlobCache
+from ccm_backup_reader.ccm_error import CcmError
+from ccm_backup_reader.orm import CcmOrm
+from ccm_backup_reader.orm.ccm_objects import CcmDirectory
+from ccm_backup_reader.orm.ccm_objects import CcmObjectRef
+from ccm_backup_reader.orm.ccm_objects import CcmProject
+
+
+class CountingCcmDb(CcmDb):
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.query_count = 0
+
+    def query_sql(self, sql_query, *args, stream=False):
+        self.query_count += 1
+        return super().query_sql(sql_query, *args, stream=stream)
+
+
+@pytest.fixture
+def db(backup_path):
+    return CountingCcmDb(backup_path)
+
+
+@pytest.fixture
+def orm(db):
+    return CcmOrm(db)
+
+
+class TestIdentityMap:
+
+    def test_same_object(self, orm):
+        main_c = orm.object_by_fpn('main.c~2:csrc:1')
+        assert orm.object_by_id(11) is main_c
+        assert orm.object_by_fpn('main.c~1:csrc:1').successors[0] is main_c
+
+    def test_object_type(self, orm):
+        assert isinstance(orm.object_by_id(41), CcmProject)
+        assert isinstance(orm.object_by_id(21), CcmDirectory)
+
+    def test_unknown_object(self, orm):
+        assert orm.object_by_id(999) is None
+
+    def test_no_instance_dict(self, orm):
+        assert not hasattr(orm.object_by_id(41), '__dict__')
+        assert not hasattr(orm.object_by_id(12), '__dict__')
+
+
+class TestObjectRefs:
+
+    def test_partial_name_refs(self, orm):
+        refs = orm.objects_by_partial_name('1/csrc/main.c', refs=True)
+        assert all(isinstance(ref, CcmObjectRef) for ref in refs)
+        assert sorted(ref.version for ref in refs) == ['1', '2', '2.1.1', '3']
+        ref = [ref for ref in refs if ref.id == 12][0]
+        assert ref.full_name == '1/csrc/main.c/3'
+        assert ref.part_name == '1/csrc/main.c'
+        assert ref.type == 'csrc'
+
+    def test_related_refs(self, orm):
+        main_c = orm.object_by_id(11)
+        refs = main_c.related_to('successor', refs=True)
+        assert sorted(ref.id for ref in refs) == [12, 13]
+
+        orm.prefetch([main_c])
+        assert sorted(ref.id for ref in main_c.related_to('successor', refs=True)) == [12, 13]
+
+    def test_object_from_ref(self, orm):
+        ref = orm.objects_by_partial_name('1/dir/src', refs=True)[0]
+        obj = orm.object_from_ref(ref)
+        assert isinstance(obj, CcmDirectory)
+        assert obj is orm.object_by_id(ref.id)
+
+    def test_shared_strings(self, orm):
+        refs = orm.objects_by_partial_name('1/csrc/main.c', refs=True)
+        assert refs[0].cvtype is refs[1].cvtype
+        assert refs[0].subsystem is refs[1].subsystem
+        assert refs[0].owner is refs[1].owner
+        assert refs[0].name is refs[1].name
+
+    def test_row_only_payload(self, orm):
+        main_c = orm.objects_by_partial_name('1/csrc/main.c')[0]
+        assert main_c.status == 'integrate'
+        assert main_c.attribute('source') is main_c.attribute('source')
+        assert not hasattr(main_c, '__dict__')
+        assert {slot for cls in type(main_c).__mro__ for slot in getattr(cls, '__slots__', ())} == \
+            {'_orm', '_id', '_row', '__weakref__'}
+
+
+class TestRowCaching:
+
+    def test_fields_without_queries(self, db, orm):
+        main_c = orm.object_by_id(12)
+        db.delim()
+        count = db.query_count
+        assert main_c.four_part_name == 'main.c~3:csrc:1'
+        assert main_c.full_name == '1/csrc/main.c/3'
+        assert main_c.part_name == '1/csrc/main.c'
+        assert main_c.fpn == {'name': 'main.c', 'version': '3', 'type': 'csrc', 'instance': '1'}
+        assert main_c.owner == 'bob'
+        assert main_c.create_time == 1262600012
+        assert db.query_count == count
+
+    def test_release_cached(self, db, orm):
+        main_c = orm.object_by_id(12)
+        assert main_c.release.name == '2.0'
+        count = db.query_count
+        assert main_c.release is main_c.release
+        assert db.query_count == count
+
+    def test_release_name_without_queries(self, db, orm):
+        main_c = orm.object_by_id(12)
+        util_c = orm.object_by_id(14)
+        assert main_c.release.name == '2.0'
+        count = db.query_count
+        assert util_c.release is main_c.release
+        assert repr(main_c.release) == '<CcmRelease(2, 2.0)>'
+        assert db.query_count == count
+
+    def test_attributes_single_query(self, db, orm):
+        main_c = orm.object_by_id(12)
+        orm.release_names()
+        count = db.query_count
+        attributes = main_c.attributes
+        assert db.query_count == count + 1
+        assert attributes['release'] == '2.0'
+        assert attributes['owner'] == 'bob'
+        assert attributes['cvtype'] == 'csrc'
+        assert attributes['source'].startswith('ccm_delta')
+        assert 'status_log' in attributes
+
+    def test_attributes_without_attrib_rows(self, orm):
+        attributes = orm.object_by_id(13).attributes
+        assert attributes['name'] == 'main.c'
+        assert attributes['release'] == '2.0'
+
+    def test_attribute_single_query(self, db, orm):
+        main_c = orm.object_by_id(12)
+        count = db.query_count
+        assert main_c['source'].startswith('ccm_delta')
+        assert main_c['source'] is main_c['source']
+        assert db.query_count == count + 1
+        assert main_c['owner'] == 'bob'
+        assert db.query_count == count + 2
+
+    def test_missing_attribute(self, orm):
+        with pytest.raises(KeyError):
+            orm.object_by_id(13)['source']
+
+    def test_attribute_matches_attributes(self, orm):
+        main_c = orm.object_by_id(12)
+        attributes = main_c.attributes
+        for name in ('status_log', 'release', 'name', 'create_time', 'is_asm'):
+            assert main_c[name] == attributes[name]
+
+    def test_no_release(self, orm):
+        assert orm.object_by_id(1).release is None
+
+
+class TestProjectStructure:
+
+    def test_structure(self, db, orm):
+        project = orm.object_by_fpn('proj~2:project:1')
+        structure = {child.four_part_name: path for child, path in project.structure.items()}
+        assert structure == {
+            'src~2:dir:1': '/src',
+            'main.c~3:csrc:1': '/src/main.c',
+            'util.c~1:csrc:1': '/src/util.c',
+            'lib~1:project:1': '/lib',
+        }
+
+    def test_structure_single_query(self, db, orm):
+        project = orm.object_by_fpn('proj~1:project:1')
+        count = db.query_count
+        structure = {child.four_part_name: path for child, path in project.structure.items()}
+        assert structure == {
+            'src~1:dir:1': '/src',
+            'main.c~1:csrc:1': '/src/main.c',
+            'README~1:ascii:1': '/README',
+        }
+        assert db.query_count == count + 1
+
+    def test_iter_structure(self, orm):
+        project = orm.object_by_fpn('proj~2:project:1')
+        entries = project.iter_structure()
+        assert not isinstance(entries, list)
+        assert sorted(path for _, path in entries) == ['/lib', '/src', '/src/main.c', '/src/util.c']
+
+
+class TestProjectDiff:
+
+    def test_diff(self, db, orm):
+        project_a = orm.object_by_id(40)
+        project_b = orm.object_by_id(41)
+        count = db.query_count
+        entries = orm.diff_projects(project_a, project_b)
+        assert db.query_count == count + 1
+
+        changes = sorted((entry.change, entry.path_a, entry.path_b) for entry in entries)
+        assert changes == [
+            ('added', None, '/lib'),
+            ('added', None, '/src/util.c'),
+            ('removed', '/README', None),
+            ('updated', '/src', '/src'),
+            ('updated', '/src/main.c', '/src/main.c'),
+        ]
+        updated = {entry.ref_a.id: entry.ref_b.id for entry in entries if entry.change == 'updated'}
+        assert updated == {20: 21, 10: 12}
+
+    def test_diff_same_project(self, orm):
+        project = orm.object_by_id(41)
+        entries = list(orm.diff_projects(project, project, stream=True))
+        assert {entry.change for entry in entries} == {'unchanged'}
+        assert len(entries) == 4
+
+
+class TestPrefetch:
+
+    def test_served_from_memory(self, db, orm):
+        objects = [orm.object_by_id(cv_id) for cv_id in (10, 11, 12, 13)]
+        orm.prefetch(objects, ['successor', 'associated_cv'])
+        count = db.query_count
+        assert sorted(obj.id for obj in objects[1].successors) == [12, 13]
+        assert [obj.id for obj in objects[1].predecessors] == [10]
+        assert objects[2].successors == []
+        assert [obj.id for obj in objects[2].tasks] == [50]
+        assert objects[0].tasks == []
+        assert db.query_count == count
+
+    def test_other_relations_queried(self, db, orm):
+        project = orm.object_by_id(41)
+        orm.prefetch([project], ['successor'], direction='from')
+        count = db.query_count
+        assert [obj.id for obj in project.predecessors] == [40]
+        assert db.query_count == count
+        assert [obj.id for obj in project.baseline_project.successors] == [41]
+        assert db.query_count > count
+
+    def test_all_relations(self, db, orm):
+        project = orm.object_by_id(41)
+        orm.prefetch([project])
+        count = db.query_count
+        assert project.baseline_project.id == 40
+        assert project.tasks == []
+        assert db.query_count == count
+
+    def test_chunks(self, orm, monkeypatch):
+        monkeypatch.setattr('ccm_backup_reader.orm.ccm_orm.PREFETCH_CHUNK_SIZE', 2)
+        objects = [orm.object_by_id(cv_id) for cv_id in (10, 11, 12, 13, 50)]
+        orm.prefetch(objects, direction='to')
+        assert sorted(obj.id for obj in objects[4].associated_objects) == [11, 12]
+
+    def test_unknown_direction(self, orm):
+        with pytest.raises(ValueError):
+            orm.prefetch([], direction='sideways')
+
+
+class TestStatusTimeline:
+
+    def test_status(self, db, orm):
+        main_c = orm.object_by_id(13)
+        assert main_c.status == 'working'
+        count = db.query_count
+        assert main_c.status_time('working') == datetime(2010, 1, 6, 12, 0, 0)
+        assert main_c.integrate_time is None
+        assert db.query_count == count
+
+    def test_timeline_entries(self, orm):
+        task = orm.object_by_id(50)
+        assert [entry.status for entry in task.timeline] == ['task_assigned', 'completed']
+        assert task.timeline.entries[-1].user == 'bob'
+        assert task.completed_time == datetime(2010, 1, 6, 11, 30, 0)
+
+    def test_no_status_log(self, orm):
+        assert orm.object_by_id(1).status is None
+
+    def test_bulk_load(self, db, orm, monkeypatch):
+        monkeypatch.setattr('ccm_backup_reader.orm.ccm_orm.PREFETCH_CHUNK_SIZE', 2)
+        objects = [orm.object_by_id(cv_id) for cv_id in (1, 10, 12, 21, 41)]
+        count = db.query_count
+        orm.load_status_timelines(objects)
+        assert db.query_count == count + 3
+        assert [obj.status for obj in objects] == [None, 'integrate', 'integrate', 'integrate', 'integrate']
+        assert objects[3].integrate_time == datetime(2010, 1, 6, 11, 0, 0)
+        assert db.query_count == count + 3
+
+
+class TestExtractMany:
+
+    @pytest.mark.parametrize('workers', [1, 2])
+    def test_extract_many(self, orm, st_root_archives, workers):
+        objects = [orm.object_by_id(cv_id) for cv_id in (10, 11, 12, 13, 14)]
+        extracted = {ccm_object.id: data for ccm_object, data in orm.extract_many(objects, workers=workers)}
+        assert extracted == {
+            10: st_root_archives['1/csrc/main.c/1'],
+            11: st_root_archives['1/csrc/main.c/2'],
+            12: st_root_archives['1/csrc/main.c/3'],
+            13: None,
+            14: st_root_archives['1/csrc/util.c/1'],
+        }
+
+    def test_same_as_data(self, orm, st_root_archives):
+        objects = [orm.object_by_id(cv_id) for cv_id in (10, 12, 12)]
+        results = list(orm.extract_many(objects, workers=2, max_pending=1))
+        assert len(results) == 3
+        for ccm_object, data in results:
+            assert data == ccm_object.data
+
+    def test_missing_archive(self, orm):
+        with pytest.raises(CcmError):
+            list(orm.extract_many([orm.object_by_id(12)], workers=1))
+
+    @pytest.mark.parametrize('workers', [1, 2])
+    def test_blob_cache(self, backup_path, st_root_archives, tmpdir, workers):
+        blob_cache = CcmBlobCache(os.path.join(str(tmpdir), 'blobs'))
+        orm = CcmOrm(CcmDb(backup_path, blob_cache=blob_cache))
+        objects = [orm.object_by_id(cv_id) for cv_id in (10, 11, 12, 14)]
+        first = {ccm_object.id: data for ccm_object, data in orm.extract_many(objects, workers=workers)}
+        assert blob_cache.stats()['versions'] >= 4
+        assert blob_cache.get(os.path.join(backup_path, 'st_root', '1', 'csrc', 'util.c,v'), '1/csrc/util.c/1', os.stat(
+            os.path.join(backup_path, 'st_root', '1', 'csrc', 'util.c,v')).st_mtime_ns) == st_root_archives['1/csrc/util.c/1']
+        assert {ccm_object.id: data for ccm_object, data in orm.extract_many(objects, workers=workers)} == first
+
+    def test_object_sources(self, orm):
+        sources = orm.object_sources([orm.object_by_id(cv_id) for cv_id in (12, 13)])
+        assert sources == {12: ('ccm_delta', '1/csrc/main.c/3', '1/csrc/main.c,v')}
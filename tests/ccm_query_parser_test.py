@@ -3,6 +3,13 @@
 
 
 from ccm_backup_reader.ccm_query_parser import SqlQueryBuilder
+from ccm_backup_reader.ccm_query_parser import normalize_query
+
+
+COLUMNS = \
+"SELECT cv.id AS cvid, cv.name || ? || cv.version || ':' || cv.cvtype || ':' || cv.subsystem AS objectname, cv.name AS name, cv.version AS version, cv.subsystem AS instance, cv.cvtype AS type, cv.owner AS owner, cv.create_time AS create_time, ccm_status(st.textval) AS status "
+STATUS_JOIN = "LEFT JOIN attrib st ON (st.is_attr_of = cv.id AND st.name = 'status_log') "
+SELECT = COLUMNS + "FROM compver cv " + STATUS_JOIN + "WHERE "
 
 
 class TestQueryParser:
@@ -10,46 +17,61 @@ class TestQueryParser:
     def test_and(self):
         ccm_query = "name='name' and version='1' and type='ascii' and instance='1'"
         builder = SqlQueryBuilder('~')
-        sql_query = builder.build(ccm_query)
-        assert sql_query == "SELECT * FROM compver WHERE name = 'name' AND version = '1' AND type = 'ascii' AND instance = '1'"
+        sql_query, params = builder.build(ccm_query)
+        assert sql_query == SELECT + "cv.name = ? AND cv.cvtype = ? AND cv.subsystem = ? AND cv.version = ?"
+        assert params == ['~', 'name', 'ascii', '1', '1']
 
     def test_or(self):
         ccm_query = "name='name' or version='1' or type='ascii' or instance='1'"
         builder = SqlQueryBuilder('~')
-        sql_query = builder.build(ccm_query)
-        assert sql_query == "SELECT * FROM compver WHERE name = 'name' OR version = '1' OR type = 'ascii' OR instance = '1'"
+        sql_query, params = builder.build(ccm_query)
+        assert sql_query == SELECT + "cv.name = ? OR cv.version = ? OR cv.cvtype = ? OR cv.subsystem = ?"
+        assert params == ['~', 'name', '1', 'ascii', '1']
 
     def test_parens(self):
         ccm_query = "name='name' and (version='1' or version='2')"
         builder = SqlQueryBuilder('~')
-        sql_query = builder.build(ccm_query)
-        assert sql_query == "SELECT * FROM compver WHERE name = 'name' AND (version = '1' OR version = '2')"
+        sql_query, params = builder.build(ccm_query)
+        assert sql_query == SELECT + "cv.name = ? AND (cv.version = ? OR cv.version = ?)"
+        assert params == ['~', 'name', '1', '2']
+
+    def test_match(self):
+        ccm_query = "name match '*.c'"
+        builder = SqlQueryBuilder('~')
+        sql_query, params = builder.build(ccm_query)
+        assert sql_query == SELECT + "cv.name LIKE ?"
+        assert params == ['~', '%.c']
+
+    def test_quote_in_literal(self):
+        ccm_query = "name='it''s'"
+        builder = SqlQueryBuilder('~')
+        sql_query, params = builder.build(ccm_query)
+        assert sql_query == SELECT + "cv.name = ?"
+        assert params == ['~', "it's"]
 
     def test_function_call_is_successor_of(self):
         ccm_query = "is_successor_of('test.txt~7:ascii:1')"
         builder = SqlQueryBuilder('~')
-        sql_query = builder.build(ccm_query)
-        assert sql_query == \
-"SELECT * " + \
-"FROM compver " + \
-"WHERE id = (" + \
-    "SELECT to_cv " + \
+        sql_query, params = builder.build(ccm_query)
+        assert sql_query == COLUMNS + \
+"FROM (SELECT DISTINCT id FROM (" + \
+    "SELECT relate.to_cv AS id " + \
     "FROM compver INNER JOIN relate ON (compver.id = relate.from_cv) " + \
-    "WHERE compver.name = 'test.txt' AND compver.version = '7' AND compver.cvtype = 'ascii' AND compver.subsystem = '1' AND relate.name = 'successor'" + \
-")"
+    "WHERE compver.name = ? AND compver.version = ? AND compver.cvtype = ? AND compver.subsystem = ? AND relate.name = 'successor'" + \
+")) d INNER JOIN compver cv ON (cv.id = d.id) " + STATUS_JOIN.rstrip()
+        assert params == ['~', 'test.txt', '7', 'ascii', '1']
 
     def test_function_call_is_predecessor_of(self):
         ccm_query = "is_predecessor_of('test.txt~7:ascii:1')"
         builder = SqlQueryBuilder('~')
-        sql_query = builder.build(ccm_query)
-        assert sql_query == \
-"SELECT * " + \
-"FROM compver " + \
-"WHERE id = (" + \
-    "SELECT from_cv " + \
+        sql_query, params = builder.build(ccm_query)
+        assert sql_query == COLUMNS + \
+"FROM (SELECT DISTINCT id FROM (" + \
+    "SELECT relate.from_cv AS id " + \
     "FROM compver INNER JOIN relate ON (compver.id = relate.to_cv) " + \
-    "WHERE compver.name = 'test.txt' AND compver.version = '7' AND compver.cvtype = 'ascii' AND compver.subsystem = '1' AND relate.name = 'successor'" + \
-")"
+    "WHERE compver.name = ? AND compver.version = ? AND compver.cvtype = ? AND compver.subsystem = ? AND relate.name = 'successor'" + \
+")) d INNER JOIN compver cv ON (cv.id = d.id) " + STATUS_JOIN.rstrip()
+        assert params == ['~', 'test.txt', '7', 'ascii', '1']
 
     #def test_function_call_2(self):
     #    ccm_query = "is_child_of('test.txt~7:ascii:1', 'project_name~1:project:1')"
@@ -58,6 +80,86 @@ class TestQueryParser:
     #    assert sql_query == "SELECT * FROM compver INNER JOIN relate ON (id = relate.from_cv) WHERE name = 'test.txt' AND version = '7' AND cvtype = 'ascii' AND subsystem = '1'"
 
 
+class TestQueryPlanner:
+
+    def test_no_status_join_when_unused(self):
+        builder = SqlQueryBuilder('~')
+        sql_query, params = builder.build("name='a'", ['objectname'])
+        assert 'attrib' not in sql_query
+        assert 'NULL AS status' in sql_query
+        assert sql_query.endswith("FROM compver cv WHERE cv.name = ?")
+
+    def test_status_join_when_used_in_predicate(self):
+        builder = SqlQueryBuilder('~')
+        sql_query, params = builder.build("status='integrate'", ['objectname'])
+        assert STATUS_JOIN + "WHERE ccm_status(st.textval) = ?" in sql_query
+        assert params == ['~', 'integrate']
+
+    def test_attrib_join(self):
+        builder = SqlQueryBuilder('~')
+        sql_query, params = builder.build("task_synopsis match '*fix*'", ['cvid'])
+        assert sql_query.endswith("FROM compver cv LEFT JOIN attrib a0 ON (a0.is_attr_of = cv.id AND a0.name = ?) WHERE a0.textval LIKE ?")
+        assert params == ['task_synopsis', '%fix%']
+
+    def test_selective_predicates_first(self):
+        builder = SqlQueryBuilder('~')
+        sql_query, params = builder.build("status='integrate' and owner='bob' and name match '*.c' and type='csrc'", ['cvid'])
+        assert sql_query.endswith("WHERE cv.cvtype = ? AND cv.owner = ? AND cv.name LIKE ? AND ccm_status(st.textval) = ?")
+        assert params == ['csrc', 'bob', '%.c', 'integrate']
+
+    def test_function_in_disjunction(self):
+        builder = SqlQueryBuilder('~')
+        sql_query, params = builder.build("is_member_of('p~1:project:1') or name='a'", ['cvid'])
+        assert sql_query.endswith(
+            "FROM compver cv WHERE cv.id IN (" + \
+                "SELECT bind.has_child AS id " + \
+                "FROM compver cv1 INNER JOIN bind ON (cv1.id = bind.has_asm) " + \
+                "WHERE cv1.name = ? AND cv1.version = ? AND cv1.cvtype = ? AND cv1.subsystem = ?" + \
+            ") OR cv.name = ?")
+        assert params == ['p', '1', 'project', '1', 'a']
+
+    def test_recursive_function(self):
+        builder = SqlQueryBuilder('~')
+        sql_query, params = builder.build("is_hist_successor_of('a~1:csrc:1') and name='a'", ['cvid'])
+        assert sql_query.endswith(
+            "FROM (SELECT DISTINCT id FROM (" + \
+                "WITH RECURSIVE hist(id) AS (" + \
+                    "SELECT relate.to_cv " + \
+                    "FROM compver INNER JOIN relate ON (compver.id = relate.from_cv) " + \
+                    "WHERE compver.name = ? AND compver.version = ? AND compver.cvtype = ? AND compver.subsystem = ? AND relate.name = 'successor' " + \
+                    "UNION " + \
+                    "SELECT relate.to_cv " + \
+                    "FROM hist INNER JOIN relate ON (hist.id = relate.from_cv) " + \
+                    "WHERE relate.name = 'successor'" + \
+                ") SELECT id FROM hist" + \
+            ")) d INNER JOIN compver cv ON (cv.id = d.id) WHERE cv.name = ?")
+        assert params == ['a', '1', 'csrc', '1', 'a']
+
+    def test_nested_parens(self):
+        builder = SqlQueryBuilder('~')
+        sql_query, params = builder.build("not (name='a' or (name='b' and version='1'))", ['cvid'])
+        assert sql_query.endswith("WHERE NOT (cv.name = ? OR (cv.name = ? AND cv.version = ?))")
+        assert params == ['a', 'b', '1']
+
+
+class TestQueryCache:
+
+    def test_normalize_query(self):
+        shape, literals = normalize_query("name = 'a'  and   type='it''s'")
+        assert shape == "name = '#0' and type='#1'"
+        assert literals == ['a', "it's"]
+
+    def test_same_shape_reuses_compiled_query(self):
+        builder = SqlQueryBuilder('~')
+        sql_query_1, params_1 = builder.build("name='a' and type='csrc'")
+        sql_query_2, params_2 = builder.build("name='b' and type='dir'")
+        assert sql_query_1 == sql_query_2
+        assert params_1 == ['~', 'a', 'csrc']
+        assert params_2 == ['~', 'b', 'dir']
+        assert builder.cache.misses == 1
+        assert builder.cache.hits == 1
+
+
 
 
 if __name__ == '__main__':
@@ -0,0 +1,264 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import os
+import os.path
+
+import pytest
+
+from ccm_backup_reader import ccm_rcs
+from ccm_backup_reader.ccm_blob_cache import CcmBlobCache
+from ccm_backup_reader.ccm_rcs import RcsError
+from ccm_backup_reader.ccm_rcs import RcsFile
+from ccm_backup_reader.ccm_rcs import apply_diff
+from ccm_backup_reader.ccm_rcs import split_lines
+
+
+RCS_FILE = b"""head\t1.3;
+access;
+symbols
+\trelease_1:1.2;
+locks; strict;
+comment\t@# @;
+
+
+1.3
+date\t2010.01.06.10.00.00;\tauthor bob;\tstate Exp;
+branches;
+next\t1.2;
+
+1.2
+date\t2010.01.05.10.00.00;\tauthor alice;\tstate Exp;
+branches
+\t1.2.1.1;
+next\t1.1;
+
+1.1
+date\t2010.01.04.10.00.00;\tauthor alice;\tstate Exp;
+branches;
+next\t;
+
+1.2.1.1
+date\t2010.01.05.12.00.00;\tauthor bob;\tstate Exp;
+branches;
+next\t1.2.1.2;
+
+1.2.1.2
+date\t2010.01.05.13.00.00;\tauthor bob;\tstate Exp;
+branches;
+next\t;
+
+
+desc
+@main.c
+@
+
+
+1.3
+log
+@third
+@
+text
+@one
+two
+three $Id$
+@
+
+
+1.2
+log
+@second
+@
+text
+@d3 1
+@
+
+
+1.1
+log
+@first
+@
+text
+@d2 1
+a2 1
+zwei
+@
+
+
+1.2.1.1
+log
+@branch
+@
+text
+@a2 1
+branch @@ one
+@
+
+
+1.2.1.2
+log
+@branch again
+@
+text
+@d1 1
+@
+"""
+
+REVISIONS = {
+    '1.3': b'one\ntwo\nthree $Id$\n',
+    '1.2': b'one\ntwo\n',
+    '1.1': b'one\nzwei\n',
+    '1.2.1.1': b'one\ntwo\nbranch @ one\n',
+    '1.2.1.2': b'two\nbranch @ one\n',
+}
+
+
+EXPANDED_1_3 = b'one\ntwo\nthree $Id: main.c,v 1.3 2010/01/06 10:00:00 bob Exp $\n'
+
+
+@pytest.fixture
+def rcs_path(tmpdir):
+    path = os.path.join(str(tmpdir), 'main.c,v')
+    with open(path, 'wb') as fd:
+        fd.write(RCS_FILE)
+    return path
+
+
+class TestRcsFile:
+
+    def test_parse(self):
+        rcs_file = RcsFile(RCS_FILE)
+        assert rcs_file.head == '1.3'
+        assert sorted(rcs_file.revisions) == sorted(REVISIONS.keys())
+        assert rcs_file.deltas['1.2'].branches == ['1.2.1.1']
+        assert rcs_file.deltas['1.2'].author == 'alice'
+        assert rcs_file.deltas['1.1'].next is None
+
+    @pytest.mark.parametrize('rev', sorted(REVISIONS.keys()))
+    def test_revision(self, rev):
+        assert RcsFile(RCS_FILE).revision(rev) == REVISIONS[rev]
+
+    def test_iter_revisions(self):
+        revisions = list(RcsFile(RCS_FILE).iter_revisions())
+        assert dict(revisions) == REVISIONS
+        assert [rev for rev, _ in revisions][:2] == ['1.3', '1.2']
+
+    def test_unknown_revision(self):
+        with pytest.raises(RcsError):
+            RcsFile(RCS_FILE).revision('1.4')
+
+    def test_invalid_file(self):
+        with pytest.raises(RcsError):
+            RcsFile(b'head 1.1;\n1.1 date 2010.01.04.10.00.00; author a; state Exp; branches; next ;\ndesc @unterminated')
+
+    def test_needs_expansion(self):
+        rcs_file = RcsFile(RCS_FILE)
+        assert rcs_file.needs_expansion(REVISIONS['1.3'])
+        assert not rcs_file.needs_expansion(REVISIONS['1.2'])
+        assert not RcsFile(RCS_FILE.replace(b'locks; strict;', b'locks; strict;\nexpand @b@;')).needs_expansion(REVISIONS['1.3'])
+
+
+class TestExpandKeywords:
+
+    PATH = '/archive/main.c,v'
+
+    def expand(self, data, mode=None, rev='1.3'):
+        rcs_file = RcsFile(RCS_FILE)
+        rcs_file.expand = mode
+        return rcs_file.expand_keywords(data, rev, self.PATH)
+
+    def test_keywords(self):
+        data = b'$Author$ $Date$ $Revision$ $State$ $RCSfile$ $Source$ $Locker$ $Name$\n'
+        assert self.expand(data) == (b'$Author: bob $ $Date: 2010/01/06 10:00:00 $ $Revision: 1.3 $ $State: Exp $ ' +
+                                     b'$RCSfile: main.c,v $ $Source: /archive/main.c,v $ $Locker:  $ $Name:  $\n')
+
+    def test_id_header(self):
+        assert self.expand(b'$Id$ $Header: old $\n') == (
+            b'$Id: main.c,v 1.3 2010/01/06 10:00:00 bob Exp $ ' +
+            b'$Header: /archive/main.c,v 1.3 2010/01/06 10:00:00 bob Exp $\n')
+
+    @pytest.mark.parametrize('mode, expected', [
+        (b'kv', b'$Revision: 1.3 $\n'),
+        (b'kvl', b'$Revision: 1.3 $\n'),
+        (b'k', b'$Revision$\n'),
+        (b'v', b'1.3\n'),
+        (b'o', b'$Revision: 1.1 $\n'),
+        (b'b', b'$Revision: 1.1 $\n'),
+    ])
+    def test_modes(self, mode, expected):
+        assert self.expand(b'$Revision: 1.1 $\n', mode) == expected
+
+    def test_two_digit_year(self):
+        rcs_file = RcsFile(RCS_FILE.replace(b'2010.01.06.10.00.00', b'99.01.06.10.00.00'))
+        assert rcs_file.expand_keywords(b'$Date$', '1.3', self.PATH) == b'$Date: 1999/01/06 10:00:00 $'
+
+    def test_log(self):
+        data = b'/*\n * $Log$ $Revision$\n */\n'
+        assert self.expand(data, rev='1.2') == (
+            b'/*\n * $Log: main.c,v $ $Revision: 1.2 $\n' +
+            b' * Revision 1.2  2010/01/05 10:00:00  alice\n * second\n *\n */\n')
+
+    def test_log_multiline(self):
+        rcs_file = RcsFile(RCS_FILE.replace(b'@third\n@', b'@third\n\nwith details@'))
+        assert rcs_file.expand_keywords(b'# $Log$', '1.3', self.PATH) == (
+            b'# $Log: main.c,v $\n# Revision 1.3  2010/01/06 10:00:00  bob\n# third\n#\n# with details\n#\n')
+
+
+class TestDiff:
+
+    def test_split_lines(self):
+        assert split_lines(b'a\nb') == [b'a\n', b'b']
+        assert split_lines(b'a\n') == [b'a\n']
+        assert split_lines(b'') == []
+
+    def test_apply_diff(self):
+        lines = [b'1\n', b'2\n', b'3\n']
+        assert apply_diff(lines, b'd1 1\na3 2\n4\n5\n') == [b'2\n', b'3\n', b'4\n', b'5\n']
+
+    def test_invalid_diff(self):
+        with pytest.raises(RcsError):
+            apply_diff([b'1\n'], b'd2 1\n')
+        with pytest.raises(RcsError):
+            apply_diff([b'1\n'], b'x1 1\n')
+
+
+class TestCheckout:
+
+    def test_checkout(self, rcs_path, monkeypatch):
+        def fail(path, revision):
+            raise AssertionError('rcs co called')
+        monkeypatch.setattr(ccm_rcs, 'rcs_checkout', fail)
+        assert ccm_rcs.checkout(rcs_path, '1.1') == REVISIONS['1.1']
+        assert ccm_rcs.checkout(rcs_path, '1.3') == EXPANDED_1_3
+
+    def test_rcs_co(self, rcs_path, monkeypatch):
+        monkeypatch.setattr(ccm_rcs, 'rcs_checkout', lambda path, revision: b'expanded')
+        assert ccm_rcs.checkout(rcs_path, '1.1', rcs_co=True) == REVISIONS['1.1']
+        assert ccm_rcs.checkout(rcs_path, '1.3', rcs_co=True) == b'expanded'
+
+    @pytest.mark.parametrize('revisions', [['1.2.1.2'], sorted(REVISIONS.keys())])
+    def test_checkout_many(self, rcs_path, revisions):
+        found = ccm_rcs.checkout_many(rcs_path, revisions)
+        assert found == {rev: EXPANDED_1_3 if rev == '1.3' else REVISIONS[rev] for rev in revisions}
+
+    def test_blob_cache(self, rcs_path, tmpdir, monkeypatch):
+        blob_cache = CcmBlobCache(os.path.join(str(tmpdir), 'blobs'))
+        assert ccm_rcs.checkout(rcs_path, '1.1', blob_cache) == REVISIONS['1.1']
+
+        def fail(path):
+            raise AssertionError("RCS file parsed")
+
+        monkeypatch.setattr(ccm_rcs, 'open_rcs_file', fail)
+        assert ccm_rcs.checkout(rcs_path, '1.1', blob_cache) == REVISIONS['1.1']
+
+    def test_parsed_once(self, rcs_path):
+        assert ccm_rcs.open_rcs_file(rcs_path) is ccm_rcs.open_rcs_file(rcs_path)
+
+        stat = os.stat(rcs_path)
+        rcs_file = ccm_rcs.open_rcs_file(rcs_path)
+        os.utime(rcs_path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+        assert ccm_rcs.open_rcs_file(rcs_path) is not rcs_file
+
+    def test_missing_file(self, tmpdir):
+        with pytest.raises(RcsError):
+            ccm_rcs.checkout(os.path.join(str(tmpdir), 'missing.c,v'), '1.1')
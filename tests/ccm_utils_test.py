@@ -2,6 +2,8 @@
 # -*- coding: utf-8 -*-
 
 
+from datetime import datetime
+
 import ccm_backup_reader.ccm_utils as ccm_utils
 
 
@@ -28,3 +30,19 @@ class TestEscaping:
 
     def test_unescape_text_3(self):
         assert ccm_utils.unescape_text("a\\nb") == "a\\nb"
+
+
+class TestStatusLog:
+
+    def test_parse_status_log(self):
+        status_log = \
+            "Mon Jan 04 10:00:00 2010: Status set to 'working' by alice in role developer\n" + \
+            "Mon Jan 04 11:00:00 2010: Status set to 'integrate' by alice in role developer"
+        assert ccm_utils.parse_status_log(status_log) == [
+            (datetime(2010, 1, 4, 10, 0, 0), 'working', 'alice'),
+            (datetime(2010, 1, 4, 11, 0, 0), 'integrate', 'alice'),
+        ]
+
+    def test_parse_status_log_skips_other_lines(self):
+        status_log = "Mon Jan 04 10:00:00 2010: Attribute modified\n"
+        assert ccm_utils.parse_status_log(status_log) == []
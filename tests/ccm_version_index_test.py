@@ -0,0 +1,89 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import os.path
+import sqlite3
+from datetime import datetime
+
+import pytest
+
+from ccm_backup_reader import CcmDb
+from ccm_backup_reader.ccm_error import CcmError
+from ccm_backup_reader.orm import CcmOrm
+from ccm_backup_reader.orm.ccm_version_index import VersionIndex
+
+
+KEY = ('1', 'csrc', 'main.c')
+
+ENTRIES = [
+    ('1', 'csrc', 'main.c', datetime(2010, 1, 6, 11, 0, 0), 12),
+    ('1', 'csrc', 'main.c', datetime(2010, 1, 4, 11, 0, 0), 10),
+    ('1', 'csrc', 'main.c', datetime(2010, 1, 5, 11, 0, 0), 11),
+    ('1', 'csrc', 'util.c', datetime(2010, 1, 6, 11, 0, 0), 14),
+]
+
+
+class TestVersionIndex:
+
+    def test_versions_sorted(self):
+        index = VersionIndex(ENTRIES)
+        assert len(index) == 2
+        assert [cv_id for _, cv_id in index.versions(KEY)] == [10, 11, 12]
+
+    def test_version_at(self):
+        index = VersionIndex(ENTRIES)
+        assert index.version_at(KEY, datetime(2010, 1, 5, 11, 0, 0)) == 11
+        assert index.version_at(KEY, datetime(2010, 1, 5, 23, 0, 0)) == 11
+        assert index.version_at(KEY, datetime(2011, 1, 1)) == 12
+
+    def test_version_at_before_first(self):
+        index = VersionIndex(ENTRIES)
+        assert index.version_at(KEY, datetime(2009, 1, 1)) == 10
+
+    def test_unknown_key(self):
+        index = VersionIndex(ENTRIES)
+        assert index.version_at(('1', 'csrc', 'other.c'), datetime(2010, 1, 5)) is None
+
+    def test_from_db(self, backup_path):
+        index = VersionIndex.from_db(CcmDb(backup_path))
+        # main.c~2.1.1 is still working, not indexed
+        assert [cv_id for _, cv_id in index.versions(KEY)] == [10, 11, 12]
+        assert ('1', 'project', 'proj') in index
+
+    def test_persist(self, backup_path):
+        orm = CcmOrm(CcmDb(backup_path))
+        index = orm.version_index(persist=True)
+
+        db = CcmDb(backup_path)
+        assert VersionIndex.is_persisted(db)
+        loaded = VersionIndex.from_db(db)
+        assert loaded.versions(KEY) == index.versions(KEY)
+        assert len(loaded) == len(index)
+
+    def test_persist_refused_without_default_profile(self, backup_path):
+        orm = CcmOrm(CcmDb(backup_path, profile='readonly-fast'))
+        with pytest.raises(CcmError):
+            orm.version_index(persist=True)
+        assert not VersionIndex.is_persisted(CcmDb(backup_path))
+
+    def test_persisted_rebuilt_on_change(self, backup_path):
+        CcmOrm(CcmDb(backup_path)).version_index(persist=True)
+
+        # a refreshed backup: main.c~2.1.1 integrated
+        connection = sqlite3.connect(os.path.join(backup_path, 'DBdump.sqlite3'))
+        with connection:
+            connection.execute("INSERT INTO attrib (is_attr_of, name, textval) VALUES (?, 'status_log', ?)",
+                               (13, "Thu Jan 07 10:00:00 2010: Status set to 'integrate' by bob in role build_mgr"))
+            connection.execute("DELETE FROM attrib WHERE is_attr_of = 13 AND name = 'status_log' AND textval LIKE '%working%'")
+        connection.close()
+
+        db = CcmDb(backup_path)
+        assert not VersionIndex.is_persisted(db)
+        index = VersionIndex.from_db(db)
+        assert [cv_id for _, cv_id in index.versions(KEY)] == [10, 11, 12, 13]
+
+    def test_orm_version_at_timestamp(self, backup_path):
+        orm = CcmOrm(CcmDb(backup_path))
+        obj = orm.version_at_timestamp('1/csrc/main.c', datetime(2010, 1, 5, 12, 0, 0))
+        assert obj.four_part_name == 'main.c~2:csrc:1'
+        assert orm.version_at_timestamp('1/csrc/missing.c', datetime(2010, 1, 5)) is None
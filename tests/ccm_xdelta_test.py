@@ -0,0 +1,111 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import random
+
+import pytest
+
+from ccm_backup_reader.ccm_xdelta import ComposedPatch
+from ccm_backup_reader.ccm_xdelta import XDeltaError
+from ccm_backup_reader.ccm_xdelta import apply_patch
+from ccm_backup_reader.ccm_xdelta import apply_patch_stream
+from ccm_backup_reader.ccm_xdelta import compose_patches
+from ccm_backup_reader.ccm_xdelta import decode_instructions
+from ccm_backup_reader.ccm_xdelta import encode_instructions
+from ccm_backup_reader.ccm_xdelta import write_patch
+
+
+def random_instructions(rnd, source_size, count):
+    instructions = []
+    for _ in range(count):
+        if rnd.random() < 0.6:
+            offset = rnd.randrange(source_size)
+            length = rnd.randrange(0, min(source_size - offset, 20000) + 1)
+            instructions.append((True, length, offset))
+        else:
+            length = rnd.choice([0, 1, 63, 64, 100, 8191, 8192, 20000])
+            instructions.append((False, length, bytes(rnd.getrandbits(8) for _ in range(length))))
+    return instructions
+
+
+class TestXDelta:
+
+    @pytest.mark.parametrize('seed', range(10))
+    def test_appliers_agree(self, seed):
+        rnd = random.Random(seed)
+        source = bytes(rnd.getrandbits(8) for _ in range(50000))
+        patch = encode_instructions(random_instructions(rnd, len(source), 40))
+        assert apply_patch(source, patch) == apply_patch_stream(source, patch)
+
+    def test_roundtrip(self):
+        instructions = [(True, 5, 0), (False, 3, b'abc'), (True, 70, 1 << 20), (True, 1, (1 << 60) + 5)]
+        patch = encode_instructions(instructions)
+        decoded = list(decode_instructions(patch))
+        assert decoded[0] == (True, 5, 0)
+        assert decoded[1][:2] == (False, 3)
+        assert patch[decoded[1][2]:decoded[1][2] + 3] == b'abc'
+        assert decoded[2] == (True, 70, 1 << 20)
+        assert decoded[3] == (True, 1, (1 << 60) + 5)
+
+    def test_apply(self):
+        patch = encode_instructions([(True, 5, 6), (False, 1, b' '), (True, 5, 0)])
+        assert apply_patch(b'hello world', patch) == b'world hello'
+
+    def test_write_patch(self):
+        patch = encode_instructions([(True, 5, 6), (False, 1, b' '), (True, 300, 0)])
+        source = b'hello world' + b'x' * 300
+        parts = []
+        write_patch(bytearray(source), patch, parts.append)
+        assert b''.join(parts) == apply_patch(source, patch)
+        assert len(parts) == 3
+
+    def test_empty_patch(self):
+        assert apply_patch(b'source', b'') == b''
+
+    def test_copy_beyond_source(self):
+        patch = encode_instructions([(True, 10, 5)])
+        with pytest.raises(XDeltaError):
+            apply_patch(b'short', patch)
+
+    def test_truncated_patch(self):
+        patch = encode_instructions([(True, 1000, 1 << 30)])
+        with pytest.raises(XDeltaError):
+            apply_patch(b'', patch[:-1])
+        with pytest.raises(XDeltaError):
+            apply_patch(b'', encode_instructions([(False, 10, b'0123456789')])[:-1])
+
+
+class TestComposedPatch:
+
+    @pytest.mark.parametrize('seed', range(5))
+    def test_same_as_sequential(self, seed):
+        rnd = random.Random(seed)
+        base = bytes(rnd.getrandbits(8) for _ in range(20000))
+        data = base
+        patches = []
+        for _ in range(30):
+            patch = encode_instructions(random_instructions(rnd, len(data), 5))
+            patches.append(patch)
+            data = apply_patch(data, patch)
+        assert compose_patches(base, patches) == data
+
+    def test_materialized(self, monkeypatch):
+        monkeypatch.setattr('ccm_backup_reader.ccm_xdelta.COMPOSE_BYTES_PER_PIECE', 4)
+        patches = [encode_instructions([(True, 4, 0), (False, 1, b'%d' % idx)]) for idx in range(4)]
+        materialized = []
+        assert compose_patches(b'abcdefgh', patches, lambda idx, data: materialized.append((idx, data))) == b'abcd3'
+        assert materialized[0] == (0, b'abcd0')
+
+    def test_pieces_merged(self):
+        composed = ComposedPatch(10)
+        composed.add(encode_instructions([(True, 4, 0), (True, 6, 4)]))
+        assert len(composed) == 1
+        composed.add(encode_instructions([(True, 2, 0), (False, 1, b'x'), (True, 5, 5)]))
+        assert len(composed) == 3
+        assert composed.size == 8
+        assert composed.apply(b'0123456789') == b'01x56789'
+
+    def test_copy_beyond_target(self):
+        composed = ComposedPatch(5)
+        with pytest.raises(XDeltaError):
+            composed.add(encode_instructions([(True, 10, 0)]))
@@ -0,0 +1,202 @@
+# -*- coding: utf-8 -*-
+
+import os.path
+import sqlite3
+import zipfile
+
+import pytest
+
+from ccm_backup_reader.ccm_xdelta import encode_instructions
+
+
+SCHEMA = [
+    "CREATE TABLE attrib (id INTEGER PRIMARY KEY NOT NULL, name TEXT, modify_time INTEGER, textval TEXT, binval TEXT, strval TEXT, intval INTEGER, floatval TEXT, is_attr_of INTEGER, has_attype INTEGER);",
+    "CREATE TABLE bind (has_asm INTEGER, has_bound_bs INTEGER, has_child INTEGER, has_parent INTEGER, create_time INTEGER, sync_time INTEGER, wa_time INTEGER);",
+    "CREATE TABLE bsite (id INTEGER PRIMARY KEY NOT NULL, name TEXT, info TEXT, ui_info TEXT, is_bsite_of INTEGER, has_bstype INTEGER, has_next_bs INTEGER);",
+    "CREATE TABLE compver (id INTEGER PRIMARY KEY NOT NULL, status TEXT, create_time INTEGER, modify_time INTEGER, owner TEXT, is_asm INTEGER, is_model INTEGER, subsystem TEXT, cvtype TEXT, name TEXT, version TEXT, is_product INTEGER, ui_info INTEGER, release INTEGER, has_cvtype INTEGER, has_model INTEGER, has_super_type INTEGER, acc_key_0 INTEGER, acc_key_1 INTEGER, acc_key_2 INTEGER, acc_key_3 INTEGER, acc_key_4 INTEGER, acc_key_5 INTEGER, acc_key_6 INTEGER, acc_key_7 INTEGER, acc_key_8 INTEGER, acc_key_9 INTEGER, acc_key_10 INTEGER, acc_key_11 INTEGER, acc_key_12 INTEGER, acc_key_13 INTEGER, acc_key_14 INTEGER, acc_key_15 INTEGER, acc_key_16 INTEGER, acc_key_17 INTEGER, acc_key_18 INTEGER, acc_key_19 INTEGER);",
+    "CREATE TABLE control (id INTERGER PRIMARY KEY NOT NULL, nextid INTEGER, info TEXT);",
+    "CREATE TABLE relate (name TEXT, from_cv INTEGER, to_cv INTEGER, create_time INTEGER);",
+    "CREATE TABLE release (id INTEGER PRIMARY KEY NOT NULL, name TEXT);",
+    "CREATE TABLE acckeys (id INTEGER PRIMARY KEY NOT NULL, attr_name TEXT, attr_value TEXT);",
+]
+
+
+# id, name, version, cvtype, subsystem, owner, is_product
+COMPVERS = [
+    (1, 'base', '1', 'model', 'base', 'ccm_root', None),
+    (10, 'main.c', '1', 'csrc', '1', 'alice', 1),
+    (11, 'main.c', '2', 'csrc', '1', 'alice', 1),
+    (12, 'main.c', '3', 'csrc', '1', 'bob', 2),
+    (13, 'main.c', '2.1.1', 'csrc', '1', 'bob', 2),
+    (14, 'util.c', '1', 'csrc', '1', 'bob', 2),
+    (15, 'lib.h', '1', 'incl', '1', 'carol', 2),
+    (20, 'src', '1', 'dir', '1', 'alice', 1),
+    (21, 'src', '2', 'dir', '1', 'bob', 2),
+    (30, 'README', '1', 'ascii', '1', 'alice', 1),
+    (40, 'proj', '1', 'project', '1', 'alice', 1),
+    (41, 'proj', '2', 'project', '1', 'bob', 2),
+    (42, 'lib', '1', 'project', '1', 'carol', 2),
+    (50, '50', '1', 'task', 'probtrac', 'bob', 2),
+]
+
+# name, from_cv, to_cv
+RELATIONS = [
+    ('successor', 10, 11),
+    ('successor', 11, 12),
+    ('successor', 11, 13),
+    ('successor', 20, 21),
+    ('successor', 40, 41),
+    ('baseline_project', 41, 40),
+    ('associated_cv', 50, 11),
+    ('associated_cv', 50, 12),
+]
+
+# has_asm, has_parent, has_child
+BINDS = [
+    (40, 40, 20),
+    (40, 20, 10),
+    (40, 40, 30),
+    (41, 41, 21),
+    (41, 21, 12),
+    (41, 21, 14),
+    (41, 41, 42),
+    (42, 42, 15),
+]
+
+# is_bsite_of, info
+BSITES = [
+    (20, '1/csrc/main.c'),
+    (21, '1/csrc/main.c'),
+    (21, '1/csrc/util.c'),
+]
+
+STATUS_LOG = {
+    10: [('Mon Jan 04 10:00:00 2010', 'working', 'alice'), ('Mon Jan 04 11:00:00 2010', 'integrate', 'alice')],
+    11: [('Tue Jan 05 10:00:00 2010', 'working', 'alice'), ('Tue Jan 05 11:00:00 2010', 'integrate', 'alice')],
+    12: [('Wed Jan 06 10:00:00 2010', 'working', 'bob'), ('Wed Jan 06 11:00:00 2010', 'integrate', 'bob')],
+    13: [('Wed Jan 06 12:00:00 2010', 'working', 'bob')],
+    14: [('Wed Jan 06 10:30:00 2010', 'working', 'bob'), ('Wed Jan 06 11:00:00 2010', 'integrate', 'bob')],
+    15: [('Tue Jan 05 09:00:00 2010', 'working', 'carol'), ('Tue Jan 05 10:00:00 2010', 'integrate', 'carol')],
+    20: [('Mon Jan 04 10:00:00 2010', 'working', 'alice'), ('Mon Jan 04 11:00:00 2010', 'integrate', 'alice')],
+    21: [('Wed Jan 06 10:00:00 2010', 'working', 'bob'), ('Wed Jan 06 11:00:00 2010', 'integrate', 'bob')],
+    30: [('Mon Jan 04 10:00:00 2010', 'working', 'alice'), ('Mon Jan 04 11:00:00 2010', 'integrate', 'alice')],
+    40: [('Mon Jan 04 12:00:00 2010', 'prep', 'alice'), ('Mon Jan 04 13:00:00 2010', 'released', 'alice')],
+    41: [('Wed Jan 06 12:00:00 2010', 'prep', 'bob'), ('Wed Jan 06 13:00:00 2010', 'integrate', 'bob')],
+    42: [('Tue Jan 05 12:00:00 2010', 'prep', 'carol'), ('Tue Jan 05 13:00:00 2010', 'released', 'carol')],
+    50: [('Wed Jan 06 09:00:00 2010', 'task_assigned', 'bob'), ('Wed Jan 06 11:30:00 2010', 'completed', 'bob')],
+}
+
+
+# is_attr_of: (fullName in archive, archive path below st_root)
+SOURCES = {
+    10: ('1/csrc/main.c/1', '1/csrc/main.c,v'),
+    11: ('1/csrc/main.c/2', '1/csrc/main.c,v'),
+    12: ('1/csrc/main.c/3', '1/csrc/main.c,v'),
+    14: ('1/csrc/util.c/1', '1/csrc/util.c,v'),
+}
+
+# archive path below st_root: [(fullName, predecessor fullName or None, data)]
+ARCHIVES = {
+    '1/csrc/main.c,v': [
+        ('1/csrc/main.c/1', None, b'one\n'),
+        ('1/csrc/main.c/2', '1/csrc/main.c/1', b'one\ntwo\n'),
+        ('1/csrc/main.c/3', '1/csrc/main.c/2', b'one\ntwo\nthree\n'),
+        ('1/csrc/main.c/2.1.1', '1/csrc/main.c/2', b'one\ntwo\nbranch\n'),
+    ],
+    '1/csrc/util.c,v': [
+        ('1/csrc/util.c/1', None, b'util\n'),
+    ],
+}
+
+
+def status_log_text(entries):
+    lines = ["{}: Status set to '{}' by {} in role build_mgr".format(time, status, user) for time, status, user in entries]
+    return '\n'.join(lines)
+
+
+def create_backup_db(db_path):
+    connection = sqlite3.connect(db_path)
+    for statement in SCHEMA:
+        connection.execute(statement)
+
+    connection.executemany("INSERT INTO release (id, name) VALUES (?, ?)", [(1, '1.0'), (2, '2.0')])
+    for cv_id, name, version, cvtype, subsystem, owner, is_product in COMPVERS:
+        status = STATUS_LOG[cv_id][-1][1] if cv_id in STATUS_LOG else None
+        connection.execute(
+            "INSERT INTO compver (id, status, create_time, modify_time, owner, is_asm, is_model, subsystem, cvtype, name, version, is_product) " +
+            "VALUES (?, ?, ?, ?, ?, 0, 0, ?, ?, ?, ?, ?)",
+            (cv_id, status, 1262600000 + cv_id, 1262600000 + cv_id, owner, subsystem, cvtype, name, version, is_product))
+    connection.executemany("INSERT INTO relate (name, from_cv, to_cv) VALUES (?, ?, ?)", RELATIONS)
+    connection.executemany("INSERT INTO bind (has_asm, has_parent, has_child) VALUES (?, ?, ?)", BINDS)
+    connection.executemany("INSERT INTO bsite (is_bsite_of, info) VALUES (?, ?)", BSITES)
+
+    attribs = [(1, 'delimiter', '~', '~')]
+    for cv_id, entries in sorted(STATUS_LOG.items()):
+        attribs.append((cv_id, 'status_log', status_log_text(entries), None))
+    for cv_id, (version, archive) in sorted(SOURCES.items()):
+        attribs.append((cv_id, 'source', 'ccm_delta\n{}\n{}'.format(version, archive), None))
+    connection.executemany("INSERT INTO attrib (is_attr_of, name, textval, strval) VALUES (?, ?, ?, ?)", attribs)
+
+    connection.commit()
+    connection.close()
+
+
+def make_patch(source, target):
+    """ XDelta patch copying the common prefix and suffix from source and inserting the rest """
+    prefix = 0
+    while prefix < min(len(source), len(target)) and source[prefix] == target[prefix]:
+        prefix += 1
+    suffix = 0
+    while suffix < min(len(source), len(target)) - prefix and source[-suffix - 1] == target[-suffix - 1]:
+        suffix += 1
+
+    instructions = []
+    if prefix:
+        instructions.append((True, prefix, 0))
+    middle = target[prefix:len(target) - suffix]
+    if middle:
+        instructions.append((False, len(middle), middle))
+    if suffix:
+        instructions.append((True, suffix, len(source) - suffix))
+    return encode_instructions(instructions)
+
+
+def create_archive(archive_path, versions):
+    """
+    Write a ccm_delta archive, versions are (fullName, predecessor fullName or None, data).
+    Versions without predecessor are stored in full, the others as patch on their predecessor.
+    """
+    data = {full_name: content for full_name, _, content in versions}
+    header = ['<archive>']
+    with zipfile.ZipFile(archive_path, 'w') as zip_file:
+        for full_name, predecessor, content in versions:
+            header.append('<entry>')
+            header.append('<fullName>{}</fullName>'.format(full_name))
+            if predecessor is None:
+                zip_file.writestr(full_name, content)
+            else:
+                header.append('<predecessor>{}</predecessor>'.format(predecessor))
+                header.append('<deltaFormat>XDELTA</deltaFormat>')
+                zip_file.writestr(full_name, make_patch(data[predecessor], content))
+            header.append('</entry>')
+        header.append('</archive>')
+        zip_file.writestr('META-INF/ARCHIVE-HEADER', ''.join(header))
+
+
+@pytest.fixture
+def backup_path(tmpdir):
+    path = str(tmpdir)
+    create_backup_db(os.path.join(path, 'DBdump.sqlite3'))
+    return path
+
+
+@pytest.fixture
+def st_root_archives(backup_path):
+    """ Writes the ARCHIVES below st_root of the backup, returns their contents by fullName """
+    contents = {}
+    for archive, versions in ARCHIVES.items():
+        path = os.path.join(backup_path, 'st_root', archive)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        create_archive(path, versions)
+        contents.update((full_name, data) for full_name, _, data in versions)
+    return contents